@@ -1,9 +1,15 @@
 ﻿from __future__ import annotations
 
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator
 
 from app.config import settings
 
+if TYPE_CHECKING:
+    from app.text_match import PhraseMatcher
+
+LABELS = ("A", "B", "C")
+
 
 @dataclass(frozen=True)
 class GenerateContext:
@@ -15,12 +21,29 @@ class GenerateContext:
     ng_tags: list[str]
     ng_free_phrases: list[str]
     tuning: dict | None
+    # 以下は profile_cache がユーザー設定（etag）単位で事前計算したもの
+    profile_prompt: str | None = None
+    ng_matcher: PhraseMatcher | None = None
 
 
 class AiClient:
     async def generate_abc(self, history_text: str, ctx: GenerateContext) -> list[str]:
         raise NotImplementedError
 
+    async def generate_abc_stream(self, history_text: str, ctx: GenerateContext) -> AsyncIterator[tuple[str, str]]:
+        """確定した案から順に (label, text) を返す。既定は一括生成の結果をそのまま流す"""
+        texts = await self.generate_abc(history_text, ctx)
+        for label, text in zip(LABELS, texts):
+            yield label, text
+
+    def render_profile_prompt(self, ctx: GenerateContext) -> str | None:
+        """combo_id/tuning 以外の設定だけで決まるプロンプト部分（キャッシュ用）。無ければ None"""
+        return None
+
+    async def aclose(self) -> None:
+        """プロバイダが保持する接続プール等を閉じる"""
+        return None
+
 
 class DummyAiClient(AiClient):
     async def generate_abc(self, history_text: str, ctx: GenerateContext) -> list[str]:
@@ -39,11 +62,39 @@ class DummyAiClient(AiClient):
         return [a, b, c]
 
 
-def get_ai_client() -> AiClient:
-    # settings 側のスイッチに合わせて選択（既存設計に合わせて最低限）
+# プロバイダごとに1つだけ生成して使い回す（接続プール/keep-aliveを共有するため）
+_registry: dict[str, AiClient] = {}
+
+
+def _provider_name() -> str:
     provider = getattr(settings, "ai_provider", None) or getattr(settings, "AI_PROVIDER", None)
-    if provider and str(provider).lower() == "openai":
+    return str(provider or "dummy").lower()
+
+
+def _build_client(provider: str) -> AiClient:
+    if provider == "openai":
         # 循環import回避のためローカルimport
-        from app.ai_client_openai import OpenAiClient
-        return OpenAiClient()
+        from app.ai_client_openai import OpenAiChatClient
+        return OpenAiChatClient()
     return DummyAiClient()
+
+
+def get_ai_client() -> AiClient:
+    provider = _provider_name()
+    client = _registry.get(provider)
+    if client is None:
+        client = _build_client(provider)
+        _registry[provider] = client
+    return client
+
+
+async def startup_ai_clients() -> None:
+    """起動時（lifespan）に既定プロバイダのクライアントを作っておく"""
+    get_ai_client()
+
+
+async def shutdown_ai_clients() -> None:
+    clients = list(_registry.values())
+    _registry.clear()
+    for client in clients:
+        await client.aclose()
@@ -1,14 +1,34 @@
 from __future__ import annotations
 
 import json
+import logging
 import re
-from typing import List
+import time
+from typing import AsyncIterator, List
 
-from openai import AsyncOpenAI
+import httpx
+from fastapi import HTTPException
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
-from app.ai_client import AiClient, GenerateContext
+from app import metrics
+from app.ai_client import AiClient, GenerateContext, LABELS
 from app.config import settings
 from app.errors import err
+from app.prompts import (
+    CACHE_MIN_PREFIX_TOKENS,
+    PROMPT_VERSION,
+    cache_key,
+    refill_hint,
+    regen_hint,
+    static_prefix,
+    system_instructions,
+    user_input,
+    user_section,
+)
+from app.text_match import PhraseMatcher
+from app.token_budget import budget_for, count_tokens
+
+log = logging.getLogger(__name__)
 
 
 _RX_LABEL = re.compile(r"^\s*([ABC])[\s:：.-]+(.*)$")
@@ -45,137 +65,226 @@ def _truncate(s: str, n: int = 300) -> str:
     return s[:n] + "..."
 
 
-def _contains_any(text: str, needles: list[str]) -> bool:
-    t = text or ""
-    for n in needles:
-        if not n:
-            continue
-        if n in t:
-            return True
-    return False
+def _violates_ng(a: str, b: str, c: str, ctx: GenerateContext) -> bool:
+    if not ctx.ng_free_phrases:
+        return False
+    matcher = ctx.ng_matcher if ctx.ng_matcher is not None else PhraseMatcher(ctx.ng_free_phrases)
+    return any(matcher.search(t) for t in (a, b, c))
 
 
-def _violates_ng(a: str, b: str, c: str, ng_free_phrases: list[str]) -> bool:
-    if not ng_free_phrases:
-        return False
-    return _contains_any(a, ng_free_phrases) or _contains_any(b, ng_free_phrases) or _contains_any(c, ng_free_phrases)
+_PLACEHOLDERS = PhraseMatcher(["○○", "〇〇", "{name}", "[name]"])
 
 
 def _has_placeholder(a: str, b: str, c: str) -> bool:
-    bad = ["○○", "〇〇", "{name}", "[name]"]
-    return _contains_any(a, bad) or _contains_any(b, bad) or _contains_any(c, bad)
+    return any(_PLACEHOLDERS.search(t) for t in (a, b, c))
+
 
+class _AbcStreamParser:
+    """Structured Outputs の JSON を逐次パースし、値の文字列が閉じたキーから順に返す"""
 
-def _length_guidance(pref: str | None) -> str:
-    if pref == "long":
-        return "各案は3〜5文を目安。『気遣いの一文』＋『次に進める軽い提案（候補日/時間/質問1つ）』を必ず入れる。"
-    return "各案は2〜3文を目安。短すぎる一言返信は禁止。"
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._str_start = -1
+        self._expect_key = False
+        self._key: str | None = None
+
+    def feed(self, delta: str) -> list[tuple[str, str]]:
+        out: list[tuple[str, str]] = []
+        self._buf += delta
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        raw = buf[self._str_start : i + 1]
+                        try:
+                            value = json.loads(raw)
+                        except Exception:
+                            value = None
+                        if self._expect_key:
+                            self._key = value
+                        elif self._key is not None and value is not None:
+                            out.append((self._key, value))
+                            self._key = None
+            elif ch == '"':
+                self._in_str = True
+                self._str_start = i
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+            elif ch in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and ch == ":":
+                self._expect_key = False
+            elif self._depth == 1 and ch == ",":
+                self._expect_key = True
+                self._key = None
+            i += 1
+        self._pos = i
+        return out
+
+
+_SCHEMA = {
+    "name": "abc_candidates",
+    "description": "A/B/Cの返信案を必ず返す",
+    "schema": {
+        "type": "object",
+        "properties": {"A": {"type": "string"}, "B": {"type": "string"}, "C": {"type": "string"}},
+        "required": ["A", "B", "C"],
+        "additionalProperties": False,
+    },
+    "strict": True,
+}
+
+
+def _schema(labels: list[str]) -> dict:
+    """labels のキーだけを返させるスキーマ（ストリームで欠けた案の再生成用）"""
+    props = {label: {"type": "string"} for label in labels}
+    return {**_SCHEMA, "schema": {**_SCHEMA["schema"], "properties": props, "required": list(labels)}}
+
+
+def _messages(system_instructions: str, user_input: str, extra_system: str | None) -> list[dict]:
+    if not extra_system:
+        return [
+            {"role": "system", "content": system_instructions},
+            {"role": "user", "content": user_input},
+        ]
+    return [
+        {"role": "system", "content": system_instructions + "\n\n【再生成指示】\n" + extra_system},
+        {"role": "user", "content": user_input},
+    ]
+
+
+def _upstream_error(e: Exception):
+    return err(
+        "AI_UPSTREAM_ERROR",
+        "AI呼び出しに失敗しました",
+        {"type": e.__class__.__name__, "message": _truncate(str(e))},
+        status_code=502,
+    )
+
+
+def _record_usage(usage, mode: str) -> None:
+    """入力/キャッシュ済み/出力トークン数を記録する（プロンプトキャッシュのヒット率確認用）"""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    prompt = int(getattr(usage, "prompt_tokens", 0) or 0)
+    cached = int(getattr(details, "cached_tokens", 0) or 0)
+    completion = int(getattr(usage, "completion_tokens", 0) or 0)
+    model = settings.openai_model
+    metrics.AI_TOKENS.inc("openai", model, "prompt", value=prompt)
+    metrics.AI_TOKENS.inc("openai", model, "cached", value=cached)
+    metrics.AI_TOKENS.inc("openai", model, "completion", value=completion)
+    log.info(
+        "ai_usage",
+        extra={
+            "model": model,
+            "prompt_version": PROMPT_VERSION,
+            "mode": mode,
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "completion_tokens": completion,
+        },
+    )
+
+
+async def _count_http_attempt(response: httpx.Response) -> None:
+    # SDK 内部のリトライも1回ずつ数える（ステータス別）
+    metrics.AI_HTTP_REQUESTS.inc("openai", str(response.status_code))
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except Exception:
+        return False
+    return True
 
 
 class OpenAiChatClient(AiClient):
     def __init__(self) -> None:
         if not settings.openai_api_key:
             raise RuntimeError("OPENAI_API_KEY is required for AI_PROVIDER=openai")
-        self._client = AsyncOpenAI(api_key=settings.openai_api_key)
-
-    async def generate_abc(self, history_text: str, ctx: GenerateContext) -> List[str]:
-        ng_lines: list[str] = []
-        if ctx.ng_tags:
-            ng_lines.append(f"NGタグ: {', '.join(ctx.ng_tags)}")
-        if ctx.ng_free_phrases:
-            ng_lines.append("NG表現: " + " / ".join(ctx.ng_free_phrases))
-
-        profile: list[str] = []
-        if ctx.relationship_type:
-            profile.append(f"関係性: {ctx.relationship_type}")
-        if ctx.true_self_type:
-            profile.append(f"本来の自分: {ctx.true_self_type}")
-        if ctx.night_self_type:
-            profile.append(f"夜の自分: {ctx.night_self_type}")
-        if ctx.reply_length_pref:
-            profile.append(f"長さ: {ctx.reply_length_pref}")
-        profile.append(f"コンボID: {ctx.combo_id}")
-
-        system_instructions = (
-            settings.openai_instructions
-            + "\n\n【A/B/Cの役割（固定）】\n"
-            + "- A：おすすめ（最も自然で刺さる）。相手の温度感に合わせつつ、次に進める“軽い一手”を入れる。\n"
-            + "- B：無難（角が立たない）。丁寧で安全運転、確認質問は1つまで。\n"
-            + "- C：攻め（距離を詰める/提案強め）。ただし圧はかけない、断定しない。\n"
-            + "\n【長さ】\n"
-            + _length_guidance(ctx.reply_length_pref)
-            + "\n"
-            + "\n【制約】\n"
-            + "- 出力は必ず3案（A/B/C）。それぞれ狙いを変えて“別案”にする。\n"
-            + "- 断定せず提案として書く（命令・詰問・強要は禁止）。\n"
-            + "- 記号や箇条書き多用は避ける（会話文）。\n"
-            + "- 相手の名前が不明なら「○○」などのプレースホルダは使わない。\n"
-            + (("- " + "\n- ".join(ng_lines) + "\n") if ng_lines else "")
-            + (("【プロファイル】\n" + "\n".join(profile) + "\n") if profile else "")
+        self._http = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=settings.openai_max_connections,
+                max_keepalive_connections=settings.openai_max_keepalive_connections,
+                keepalive_expiry=settings.openai_keepalive_expiry_seconds,
+            ),
+            timeout=httpx.Timeout(settings.openai_timeout_seconds, connect=settings.openai_connect_timeout_seconds),
+            http2=settings.openai_http2 and _h2_available(),
+            event_hooks={"response": [_count_http_attempt]},
         )
-
-        schema = {
-            "name": "abc_candidates",
-            "description": "A/B/Cの返信案を必ず返す",
-            "schema": {
-                "type": "object",
-                "properties": {"A": {"type": "string"}, "B": {"type": "string"}, "C": {"type": "string"}},
-                "required": ["A", "B", "C"],
-                "additionalProperties": False,
-            },
-            "strict": True,
-        }
-
-        user_input = (
-            "以下はトーク履歴。文脈を読んで返信案を作って。\n"
-            "----\n"
-            f"{history_text}\n"
-            "----\n"
-            "出力は JSON で、必ずキー A/B/C を含めてください。\n"
+        self._client = AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            http_client=self._http,
+            max_retries=settings.openai_max_retries,
         )
-
-        def _messages(extra_system: str | None) -> list[dict]:
-            if not extra_system:
-                return [
-                    {"role": "system", "content": system_instructions},
-                    {"role": "user", "content": user_input},
-                ]
-            return [
-                {"role": "system", "content": system_instructions + "\n\n【再生成指示】\n" + extra_system},
-                {"role": "user", "content": user_input},
-            ]
-
-        for attempt in range(2):
-            regen_hint = None
-            if attempt == 1:
-                regen_hint = (
-                    "前回の出力に禁止表現/プレースホルダが含まれました。"
-                    "次の文字列は絶対に含めないでください: "
-                    + (" / ".join(ctx.ng_free_phrases) if ctx.ng_free_phrases else "(なし)")
-                    + "。"
-                    "また、相手の名前が不明なら○○などのプレースホルダは使わないでください。"
-                )
-
+        # 固定プレフィックスだけで最小長に届いているか（届かなければ全ユーザー共通のキャッシュは効かない）
+        prefix_tokens = count_tokens(static_prefix())
+        if prefix_tokens < CACHE_MIN_PREFIX_TOKENS:
+            log.warning(
+                "prompt_prefix_below_cache_minimum",
+                extra={"prefix_tokens": prefix_tokens, "min_tokens": CACHE_MIN_PREFIX_TOKENS},
+            )
+
+    def render_profile_prompt(self, ctx: GenerateContext) -> str | None:
+        return user_section(ctx)
+
+    async def aclose(self) -> None:
+        await self._client.close()
+
+    async def _create(self, messages: list[dict], schema: dict = _SCHEMA, **kw):
+        kw.setdefault("max_completion_tokens", budget_for().output)
+        mode = "stream" if kw.get("stream") else "sync"
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
             try:
                 resp = await self._client.chat.completions.create(
                     model=settings.openai_model,
-                    messages=_messages(regen_hint),
+                    messages=messages,
                     response_format={"type": "json_schema", "json_schema": schema},
+                    **kw,
                 )
             except Exception:
+                metrics.AI_RETRIES.inc("openai", "schema_fallback")
                 try:
                     resp = await self._client.chat.completions.create(
                         model=settings.openai_model,
-                        messages=_messages(regen_hint),
+                        messages=messages,
                         response_format={"type": "json_object"},
+                        **kw,
                     )
                 except Exception as e2:
-                    raise err(
-                        "AI_UPSTREAM_ERROR",
-                        "AI呼び出しに失敗しました",
-                        {"type": e2.__class__.__name__, "message": _truncate(str(e2))},
-                        status_code=502,
-                    ) from e2
+                    raise _upstream_error(e2) from e2
+            outcome = "ok"
+            return resp
+        finally:
+            # ストリームはヘッダ受信（最初の応答）までの時間
+            metrics.AI_UPSTREAM_DURATION.observe(time.perf_counter() - t0, "openai", mode, outcome)
+
+    async def generate_abc(self, history_text: str, ctx: GenerateContext) -> List[str]:
+        system = system_instructions(ctx)
+        user = user_input(history_text)
+
+        for attempt in range(2):
+            hint = regen_hint(ctx) if attempt == 1 else None
+            resp = await self._create(_messages(system, user, hint), extra_body={"prompt_cache_key": cache_key(ctx)})
+            _record_usage(getattr(resp, "usage", None), "sync")
 
             out = (resp.choices[0].message.content or "").strip()
 
@@ -192,6 +301,7 @@ class OpenAiChatClient(AiClient):
 
             if not a or not b or not c:
                 if attempt == 0:
+                    metrics.AI_RETRIES.inc("openai", "bad_output")
                     continue
                 raise err(
                     "AI_BAD_OUTPUT",
@@ -200,8 +310,9 @@ class OpenAiChatClient(AiClient):
                     status_code=502,
                 )
 
-            if _violates_ng(a, b, c, ctx.ng_free_phrases) or _has_placeholder(a, b, c):
+            if _violates_ng(a, b, c, ctx) or _has_placeholder(a, b, c):
                 if attempt == 0:
+                    metrics.AI_RETRIES.inc("openai", "ng_regenerate")
                     continue
                 raise err(
                     "AI_BAD_OUTPUT",
@@ -213,3 +324,88 @@ class OpenAiChatClient(AiClient):
             return [a, b, c]
 
         raise err("AI_BAD_OUTPUT", "AI出力の生成に失敗しました", status_code=502)
+
+    async def generate_abc_stream(self, history_text: str, ctx: GenerateContext) -> AsyncIterator[tuple[str, str]]:
+        messages = _messages(system_instructions(ctx), user_input(history_text), None)
+        stream = await self._create(
+            messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            extra_body={"prompt_cache_key": cache_key(ctx)},
+        )
+
+        parser = _AbcStreamParser()
+        sent: dict[str, str] = {}
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    _record_usage(chunk.usage, "stream")
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                for label, value in parser.feed(delta):
+                    text = str(value).strip()
+                    if label not in LABELS or label in sent or not text:
+                        continue
+                    # NG/プレースホルダを含む案は流さず、後段の再生成で差し替える
+                    if _violates_ng(text, "", "", ctx) or _has_placeholder(text, "", ""):
+                        continue
+                    sent[label] = text
+                    yield label, text
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                raise
+            raise _upstream_error(e) from e
+        finally:
+            # 呼び出し側が途中でやめた/切断した場合も上流の接続を閉じる（生成が続いて課金されないように）
+            await stream.close()
+
+        if len(sent) == len(LABELS):
+            return
+        # 欠けた案（パース不能/禁止表現）だけを非ストリームで再生成する
+        metrics.AI_RETRIES.inc("openai", "stream_refill")
+        for label, text in (await self._refill(history_text, ctx, sent)).items():
+            yield label, text
+
+    async def _refill(self, history_text: str, ctx: GenerateContext, kept: dict[str, str]) -> dict[str, str]:
+        missing = [label for label in LABELS if label not in kept]
+        messages = _messages(system_instructions(ctx), user_input(history_text), refill_hint(ctx, kept, missing))
+
+        for attempt in range(2):
+            resp = await self._create(messages, schema=_schema(missing), extra_body={"prompt_cache_key": cache_key(ctx)})
+            _record_usage(getattr(resp, "usage", None), "sync")
+
+            out = (resp.choices[0].message.content or "").strip()
+            try:
+                obj = json.loads(out)
+                got = {label: str(obj.get(label) or "").strip() for label in missing}
+            except Exception:
+                got = {}
+
+            if len(got) != len(missing) or not all(got.values()):
+                if attempt == 0:
+                    metrics.AI_RETRIES.inc("openai", "bad_output")
+                    continue
+                raise err(
+                    "AI_BAD_OUTPUT",
+                    "AI出力形式が不正です",
+                    {"message": "json/label parse failed"},
+                    status_code=502,
+                )
+
+            if any(_violates_ng(t, "", "", ctx) or _has_placeholder(t, "", "") for t in got.values()):
+                if attempt == 0:
+                    metrics.AI_RETRIES.inc("openai", "ng_regenerate")
+                    continue
+                raise err(
+                    "AI_BAD_OUTPUT",
+                    "AI出力に禁止表現が含まれました",
+                    {"message": "ng/placeholder violation"},
+                    status_code=502,
+                )
+
+            return got
+
+        raise err("AI_BAD_OUTPUT", "AI出力の生成に失敗しました", status_code=502)
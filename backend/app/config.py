@@ -13,12 +13,48 @@ class Settings(BaseSettings):
 
     session_ttl_seconds: int = 30 * 24 * 3600
 
+    # token -> (user_id, plan) キャッシュ
+    auth_cache_ttl_seconds: int = 300
+    auth_cache_local_ttl_seconds: int = 30
+    auth_cache_local_max_entries: int = 10000
+
+    # user_id -> settings ETag キャッシュ（条件付き GET 用）
+    settings_etag_cache_ttl_seconds: int = 7 * 24 * 3600
+    # (user_id, etag) -> コンパイル済み生成プロファイル（プロセス内 LRU）
+    profile_cache_max_entries: int = 10000
+
     migration_code_ttl_seconds: int = 10 * 60
     migration_ticket_ttl_seconds: int = 15 * 60
     migration_lock_ttl_seconds: int = 60 * 60
     idempotency_ttl_seconds: int = 24 * 3600
+    # 処理中マーカーの TTL。処理中はリーダーが TTL/3 ごとに延長する（延長は最長 max 秒まで）
+    idempotency_inflight_ttl_seconds: int = 120
+    idempotency_inflight_max_seconds: int = 15 * 60
+    idempotency_wait_seconds: int = 30
 
+    # リクエストサイズの上限（モデルに渡す量はトークン予算で別に制御する）
     generate_max_chars: int = 20000
+    # トーク履歴の圧縮（直近はそのまま、その前は1発言を短く切って別枠に収める）
+    # 履歴の総量はモデルごとのトークン予算（model_token_budgets の history）で決まる
+    history_older_ratio: float = 0.25
+    history_older_line_chars: int = 40
+
+    # safety gate（空なら同梱の app/safety_lexicon.json）
+    safety_lexicon_path: str = ""
+    safety_lexicon_reload_seconds: float = 5.0
+    safety_offload_min_chars: int = 4000
+
+    # 長い履歴の要約キャッシュ（app/services/summary_cache.py）。要約プロンプトを変えたら namespace を変える
+    summary_cache_namespace: str = "sum-1"
+    summary_cache_ttl_seconds: int = 30 * 60
+    summary_chunk_min_tokens: int = 300
+    summary_chunk_max_tokens: int = 1500
+    summary_chunk_avg_turns: int = 12
+    # 新しく要約する部分が長いときの map-reduce（1回の要約に渡す上限と同時実行数）
+    summary_map_tokens: int = 6000
+    summary_map_concurrency: int = 8
+
+    singleflight_wait_seconds: int = 60
 
     rl_auth_ip_limit: int = 10
     rl_auth_ip_window_seconds: int = 600
@@ -40,6 +76,11 @@ class Settings(BaseSettings):
     free_generate_daily_limit: int = 3
     pro_generate_daily_limit: int = 100
 
+    # 日次回数台帳（Redis 上のカウンタ → usage_daily へ write-behind）
+    quota_counter_ttl_seconds: int = 2 * 24 * 3600
+    quota_flush_interval_seconds: float = 5.0
+    quota_flush_batch_size: int = 500
+
 
     # AI
     ai_provider: str = "dummy"  # dummy/openai
@@ -52,10 +93,86 @@ class Settings(BaseSettings):
         "NGワードやNG表現が指定されていれば絶対に含めない。"
     )
 
-    database_url: str = "sqlite+aiosqlite:///./permy.db"
+    # OpenAI 接続プール（プロセスで1つの AsyncOpenAI を共有）
+    openai_timeout_seconds: float = 60.0
+    openai_connect_timeout_seconds: float = 5.0
+    openai_max_retries: int = 2
+    openai_max_connections: int = 100
+    openai_max_keepalive_connections: int = 20
+    openai_keepalive_expiry_seconds: float = 30.0
+    openai_http2: bool = True
+
+    # モデルごとのトークン予算（app/token_budget.py）。JSON で上書き可。未登録のモデルは default_token_budget
+    #   context: コンテキスト長 / output: 出力上限（推論モデルは推論トークンも含む）
+    #   history: トーク履歴に使う入力トークン / summarize_over: これを超えたら要約（旧 /api/talk/assist）
+    default_token_budget: dict[str, int] = {"context": 128000, "output": 1500, "history": 2000}
+    model_token_budgets: dict[str, dict[str, int]] = {
+        "gpt-5.2": {"context": 400000, "output": 4000, "history": 2000},
+        "gpt-4.1-mini": {"context": 1047576, "output": 512, "history": 3600, "summarize_over": 7200},
+    }
+    # 固定プロンプト/ユーザー設定のために履歴とは別に空けておく分
+    prompt_reserve_tokens: int = 1500
+
+    # retention（python -m app.scripts.retention）
+    retention_usage_days: int = 400
+    retention_anonymous_inactive_days: int = 90
+    retention_batch_size: int = 500
+    retention_pause_ms: int = 50
+
+    database_url: str = "sqlite+aiosqlite:///./permy.db"  # postgresql+asyncpg://... も可
+
+    # SQLite プロファイル
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_mmap_size_bytes: int = 256 * 1024 * 1024
+    sqlite_cache_size_kib: int = 64 * 1024
+
+    # Postgres(asyncpg) プロファイル
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout_seconds: float = 10.0
+    db_pool_recycle_seconds: int = 1800
+    db_pool_pre_ping: bool = True
+    pg_statement_cache_size: int = 512
+    pg_command_timeout_seconds: float = 10.0
     redis_url: str = "redis://localhost:6379/0"
 
+    # 状態ストア: redis / memory（プロセス内, REDIS_DISABLED=true と同じ）/ sqlite（複数ワーカー共有のローカルファイル）
+    state_backend: str = "redis"
+    local_state_path: str = "./permy_state.db"
+    local_state_busy_timeout_ms: int = 5000
+    local_state_sweep_interval_seconds: float = 5.0
+    local_state_poll_seconds: float = 0.2
+
+    # REDIS_DISABLED=true 時のプロセス内ストア
+    memory_redis_max_keys: int = 200_000
+    memory_redis_sweep_interval_seconds: float = 1.0
+
     uvicorn_access_log: bool = False
 
+    # GET /metrics（Prometheus 形式）。Authorization: Bearer <token> を要求する。未設定なら 404（公開しない）
+    metrics_token: str = ""
+
+    # リクエスト単位のサンプリングプロファイラ（両方未設定ならミドルウェア自体を入れない）
+    #   profile_secret: 署名付き X-Profile-Token で明示的に採取（python -m app.scripts.profile_token）
+    #   profile_sample_rate: ランダムに採取する割合。採取しても profile_slow_ms 未満なら捨てる
+    profile_secret: str = ""
+    profile_sample_rate: float = 0.0
+    profile_slow_ms: float = 1000.0
+    profile_interval_ms: float = 5.0
+    profile_max_depth: int = 64
+    profile_max_concurrent: int = 2
+    profile_dir: str = "./profiles"
+
+    # ログ（JSON 1行1レコード。キューに積んでバックグラウンドでまとめて書く）
+    log_level: str = "INFO"
+    log_file: str = ""  # 空なら stderr
+    log_queue_max: int = 10000  # 溢れた分は捨てて log_dropped で件数を出す
+    log_batch_max: int = 500
+    log_flush_interval_seconds: float = 1.0
+    log_rotate_max_bytes: int = 50 * 1024 * 1024
+    log_rotate_interval_seconds: float = 24 * 3600
+    log_backup_count: int = 7
+
 
 settings = Settings()
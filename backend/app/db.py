@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
 
 from app.config import settings
@@ -10,7 +12,62 @@ class Base(DeclarativeBase):
     pass
 
 
-engine = create_async_engine(settings.database_url, echo=False, future=True)
+def _sqlite_engine(url: str) -> AsyncEngine:
+    """SQLite プロファイル：接続ごとに WAL/synchronous/mmap/cache/busy_timeout を適用"""
+    eng = create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        connect_args={"timeout": settings.sqlite_busy_timeout_ms / 1000},
+    )
+
+    @event.listens_for(eng.sync_engine, "connect")
+    def _on_connect(dbapi_conn, _record) -> None:
+        cur = dbapi_conn.cursor()
+        try:
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+            cur.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+            cur.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size_bytes)}")
+            # 負値は KiB 指定
+            cur.execute(f"PRAGMA cache_size={-int(settings.sqlite_cache_size_kib)}")
+            cur.execute("PRAGMA temp_store=MEMORY")
+            cur.execute("PRAGMA foreign_keys=ON")
+        finally:
+            cur.close()
+
+    return eng
+
+
+def _postgres_engine(url: str) -> AsyncEngine:
+    """Postgres(asyncpg) プロファイル：プールサイズ/pre-ping/recycle/ステートメントキャッシュ"""
+    return create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout_seconds,
+        pool_recycle=settings.db_pool_recycle_seconds,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        connect_args={
+            "statement_cache_size": settings.pg_statement_cache_size,
+            "command_timeout": settings.pg_command_timeout_seconds,
+            "server_settings": {"application_name": settings.app_name},
+        },
+    )
+
+
+def create_engine_for(url: str) -> AsyncEngine:
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return _sqlite_engine(url)
+    if backend == "postgresql":
+        return _postgres_engine(url)
+    return create_async_engine(url, echo=False, future=True, pool_pre_ping=settings.db_pool_pre_ping)
+
+
+engine = create_engine_for(settings.database_url)
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
@@ -3,5 +3,15 @@ from __future__ import annotations
 from fastapi import HTTPException
 
 
-def err(code: str, message: str, detail: dict | None = None, status_code: int = 400) -> HTTPException:
-    return HTTPException(status_code=status_code, detail={"error": {"code": code, "message": message, "detail": detail or {}}})
+def err(
+    code: str,
+    message: str,
+    detail: dict | None = None,
+    status_code: int = 400,
+    headers: dict[str, str] | None = None,
+) -> HTTPException:
+    return HTTPException(
+        status_code=status_code,
+        detail={"error": {"code": code, "message": message, "detail": detail or {}}},
+        headers=headers,
+    )
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+
+from app.redis_client import redis_client
+from app.errors import err
+
+# GCRA（Generic Cell Rate Algorithm）。キーごとに TAT（理論到着時刻, ms）だけを保持する。
+# 複数キーを1往復・原子的に判定し、全キーが通る場合のみ更新する（部分消費しない）。
+_GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local allowed = 1
+local retry = 0
+local remaining = -1
+local tats = {}
+for i = 1, #KEYS do
+  local limit = tonumber(ARGV[2 * i - 1])
+  local window = tonumber(ARGV[2 * i])
+  local interval = window / limit
+  local tat = tonumber(redis.call('GET', KEYS[i]) or now)
+  if tat < now then tat = now end
+  local new_tat = tat + interval
+  local allow_at = new_tat - window
+  if now < allow_at then
+    allowed = 0
+    if allow_at - now > retry then retry = allow_at - now end
+  else
+    local rem = math.floor((now - allow_at) / interval)
+    if remaining < 0 or rem < remaining then remaining = rem end
+  end
+  tats[i] = new_tat
+end
+if allowed == 1 then
+  for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], tats[i], 'PX', math.ceil(tats[i] - now))
+  end
+else
+  remaining = 0
+end
+return {allowed, math.ceil(retry), remaining}
+"""
+
+_script = None
+
+
+@dataclass(frozen=True)
+class Rule:
+    key: str
+    limit: int
+    window_seconds: int
+
+
+@dataclass(frozen=True)
+class LimitResult:
+    allowed: bool
+    retry_after_ms: int
+    remaining: int
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, math.ceil(self.retry_after_ms / 1000)) if not self.allowed else 0
+
+
+async def check(rules: list[Rule]) -> LimitResult:
+    """全ルールを1往復で判定する（消費は全ルールが通った場合のみ）"""
+    keys = [f"gcra:{r.key}" for r in rules]
+    args: list[int] = []
+    for r in rules:
+        args += [max(1, int(r.limit)), int(r.window_seconds) * 1000]
+
+    if hasattr(redis_client, "gcra"):
+        allowed, retry_ms, remaining = await redis_client.gcra(keys, args)
+    else:
+        global _script
+        if _script is None:
+            _script = redis_client.register_script(_GCRA_LUA)
+        allowed, retry_ms, remaining = await _script(keys=keys, args=args)
+    return LimitResult(allowed=bool(int(allowed)), retry_after_ms=int(retry_ms), remaining=max(0, int(remaining)))
+
+
+async def enforce(rules: list[Rule]) -> LimitResult:
+    res = await check(rules)
+    if not res.allowed:
+        raise err(
+            "RATE_LIMITED",
+            "回数制限です",
+            {"retry_after": res.retry_after_seconds},
+            status_code=429,
+            headers={"Retry-After": str(res.retry_after_seconds)},
+        )
+    return res
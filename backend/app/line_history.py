@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from app.token_budget import ModelBudget, count_tokens, estimate_tokens, is_exact
+
+# LINE のトーク履歴（エクスポート/コピー）を発言単位に分解し、モデルに渡す前に圧縮する。
+# - ヘッダ・日付行・システム行（参加/退出/送信取消など）は捨てる
+# - [スタンプ] [写真] などのメディアは短い記号にし、同じ人の連続は「×N」にまとめる
+# - 直近はトークン予算いっぱいまでそのまま、それより古い分は1発言を短く切って別枠の予算に収める
+# 形式を認識できない行はそのまま1発言として扱う（貼り付け元が LINE でなくても壊さない）。
+
+# 2024/01/01(月) / 2024.01.01 月曜日 / 2024年1月1日(月)
+_RX_DATE = re.compile(r"^\s*(\d{4})[/.年](\d{1,2})[/.月](\d{1,2})日?\s*(?:\(.+?\)|（.+?）|[月火水木金土日]曜日)?\s*$")
+# 12:00<TAB>名前<TAB>本文 / 午後1:05 名前 本文
+_RX_MSG = re.compile(r"^\s*((?:午前|午後)?\d{1,2}:\d{2})[\t ]+([^\t]*?)\t(.*)$")
+_RX_MSG_SPACE = re.compile(r"^\s*((?:午前|午後)?\d{1,2}:\d{2}) (\S+) (.*)$")
+_RX_HEADER = re.compile(r"^\s*(\[LINE\]|保存日時[:：])")
+
+_MEDIA = {
+    "[スタンプ]": "[スタンプ]",
+    "[写真]": "[写真]",
+    "[動画]": "[動画]",
+    "[ファイル]": "[ファイル]",
+    "[ボイスメッセージ]": "[音声]",
+    "[位置情報]": "[位置情報]",
+    "[連絡先]": "[連絡先]",
+    "[ノート]": "[ノート]",
+    "[アルバム]": "[アルバム]",
+    "[Sticker]": "[スタンプ]",
+    "[Photo]": "[写真]",
+    "[Video]": "[動画]",
+}
+_RX_SYSTEM = re.compile(
+    r"(メッセージの送信を取り消しました|unsent a message"
+    r"|がグループに参加しました|がグループを退会しました|をグループに招待しました|がグループから退会させました"
+    r"|がアルバム.*を(作成|追加)しました|がノートに投稿しました|がグループ名を.*に変更しました)"
+)
+_RX_CALL = re.compile(r"^☎\s*(通話時間|不在着信|キャンセル|応答なし|Call time|Missed call)")
+
+
+@dataclass(frozen=True)
+class Turn:
+    speaker: str | None
+    text: str
+
+
+@dataclass(frozen=True)
+class Compacted:
+    text: str
+    original_chars: int
+    compact_chars: int
+    original_tokens: int
+    compact_tokens: int
+    turns: int  # 解析できた発言数（まとめた後）
+    recent_turns: int  # そのまま残した直近の発言数
+    older_turns: int  # 短縮して残した古い発言数
+    dropped_lines: int  # 捨てたヘッダ/日付/システム行
+
+
+def _classify(body: str) -> str | None:
+    """本文を正規化する。捨てる行は None"""
+    body = body.strip()
+    if not body:
+        return None
+    if _RX_SYSTEM.search(body):
+        return None
+    if _RX_CALL.match(body):
+        return "[通話]"
+    return _MEDIA.get(body, body)
+
+
+class _Parser:
+    def __init__(self) -> None:
+        self.dropped = 0
+
+    def parse(self, lines: Iterable[str]) -> Iterator[Turn]:
+        """行を順に読み、発言を逐次返す（複数行の発言は次の発言行までまとめる）"""
+        speaker: str | None = None
+        buf: list[str] = []
+        for raw in lines:
+            line = raw.rstrip("\r\n")
+            if _RX_HEADER.match(line) or _RX_DATE.match(line):
+                self.dropped += 1
+                continue
+            m = _RX_MSG.match(line) or _RX_MSG_SPACE.match(line)
+            if m:
+                if buf:
+                    yield from self._emit(speaker, buf)
+                speaker, buf = m.group(2).strip(), [m.group(3)]
+                continue
+            if not line.strip():
+                continue
+            if speaker is None:
+                # 形式不明の行は1行を1発言として扱う
+                yield from self._emit(None, [line])
+                continue
+            # 改行を含む発言の続き
+            buf.append(line)
+        if buf:
+            yield from self._emit(speaker, buf)
+
+    def _emit(self, speaker: str | None, buf: list[str]) -> Iterator[Turn]:
+        body = _classify("\n".join(x.strip('"') for x in buf))
+        if body is None or speaker == "":
+            self.dropped += 1
+            return
+        yield Turn(speaker, body)
+
+
+def _collapse(turns: Iterable[Turn]) -> list[Turn]:
+    """同じ人の連続したメディアを「[スタンプ]×3」にまとめる"""
+    out: list[Turn] = []
+    run = 0
+    for t in turns:
+        if out and t.speaker == out[-1].speaker and t.text.startswith("[") and out[-1].text.split("×")[0] == t.text:
+            run += 1
+            out[-1] = Turn(t.speaker, f"{t.text}×{run}")
+            continue
+        run = 1
+        out.append(t)
+    return out
+
+
+def _tail_within(line: str, tokens: int) -> str:
+    """1発言だけで予算を超えるときは末尾（新しい側）を残す"""
+    n = min(len(line), tokens)
+    while n > 0 and estimate_tokens(line[-n:]) > tokens:
+        n = n * 3 // 4
+    return "…" + line[-n:] if n < len(line) else line
+
+
+def _line(t: Turn, limit: int | None = None) -> str:
+    text = t.text.replace("\n", " / ")
+    if limit is not None and len(text) > limit:
+        text = text[:limit] + "…"
+    return f"{t.speaker}: {text}" if t.speaker else text
+
+
+def parse_turns(raw: str) -> list[Turn]:
+    """トーク履歴を発言の並びにする（ノイズ行を捨て、連続メディアをまとめた後）"""
+    return _collapse(_Parser().parse(raw.splitlines()))
+
+
+def format_turn(t: Turn) -> str:
+    return _line(t)
+
+
+def compact(raw: str, recent_tokens: int, older_tokens: int, older_line_chars: int = 40) -> Compacted:
+    """トーク履歴を圧縮する。直近 recent_tokens 分はそのまま、その前は older_tokens 分だけ短縮して残す"""
+    parser = _Parser()
+    turns = _collapse(parser.parse(raw.splitlines()))
+
+    recent: list[str] = []
+    used = 0
+    i = len(turns)
+    while i > 0:
+        line = _line(turns[i - 1])
+        cost = estimate_tokens(line) + 1
+        if used + cost > recent_tokens:
+            if recent:
+                break
+            line = _tail_within(line, recent_tokens)
+            cost = estimate_tokens(line) + 1
+        recent.append(line)
+        used += cost
+        i -= 1
+    recent.reverse()
+
+    older: list[str] = []
+    used = 0
+    while i > 0:
+        line = _line(turns[i - 1], older_line_chars)
+        cost = estimate_tokens(line) + 1
+        if used + cost > older_tokens:
+            break
+        older.append(line)
+        used += cost
+        i -= 1
+    older.reverse()
+
+    parts: list[str] = []
+    if i > 0:
+        parts.append(f"（これより前の {i} 件は省略）")
+    if older:
+        parts.append("【以前のやりとり（抜粋）】")
+        parts.extend(older)
+        parts.append("【直近のやりとり】")
+    parts.extend(recent)
+    text = "\n".join(parts)
+
+    return Compacted(
+        text=text,
+        original_chars=len(raw),
+        compact_chars=len(text),
+        original_tokens=estimate_tokens(raw),
+        compact_tokens=estimate_tokens(text),
+        turns=len(turns),
+        recent_turns=len(recent),
+        older_turns=len(older),
+        dropped_lines=parser.dropped,
+    )
+
+
+def compact_to_budget(raw: str, budget: ModelBudget, older_line_chars: int = 40) -> Compacted:
+    """モデルの履歴予算に収まるように圧縮する。正確なトークナイザがあれば結果を数え直し、超過分だけ縮めて1回やり直す"""
+    c = compact(raw, budget.history_recent, budget.history_older, older_line_chars)
+    if not is_exact(budget.model):
+        return c
+    n = count_tokens(c.text, budget.model)
+    if n <= budget.history:
+        return c
+    scale = budget.history / n
+    return compact(raw, int(budget.history_recent * scale), int(budget.history_older * scale), older_line_chars)
@@ -1,11 +1,27 @@
 from __future__ import annotations
 
+import atexit
+import datetime as dt
+import json
 import logging
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import TextIO
 
+from app.config import settings
 
-class NoBodyFilter(logging.Filter):
-    """本文混入を防ぐ保険フィルタ（MUST）"""
-    BLOCK_KEYS = {
+# ログは JSON 1行1レコード。呼び出し側（リクエスト処理）では
+#   本文キーの伏せ字 → メッセージ確定 → 有界キューへ put_nowait
+# だけを行い、整形と書き込みはバックグラウンドのスレッドがまとめて行う。
+# キューが溢れたら捨てて数える（ログがリクエストの遅延要因にならないことを優先）。
+
+REDACTED = "[REDACTED]"
+_BLOCK_KEYS = frozenset(
+    {
         "body",
         "request_body",
         "response_body",
@@ -15,24 +31,255 @@ class NoBodyFilter(logging.Filter):
         "text",
         "history_text",
     }
+)
+
+
+def redact(record: logging.LogRecord) -> None:
+    """本文になり得るキーを伏せ字にする（集合演算1回で判定）"""
+    d = record.__dict__
+    if not _BLOCK_KEYS.isdisjoint(d):
+        for k in _BLOCK_KEYS.intersection(d):
+            d[k] = REDACTED
+    args = record.args
+    if type(args) is dict and not _BLOCK_KEYS.isdisjoint(args):
+        record.args = {k: (REDACTED if k in _BLOCK_KEYS else v) for k, v in args.items()}
+
+
+class NoBodyFilter(logging.Filter):
+    """本文混入を防ぐ保険フィルタ（MUST）"""
+    BLOCK_KEYS = _BLOCK_KEYS
 
     def filter(self, record: logging.LogRecord) -> bool:
         try:
-            if isinstance(record.args, dict):
-                for k in list(record.args.keys()):
-                    if k in self.BLOCK_KEYS:
-                        record.args[k] = "[REDACTED]"
-            for k in self.BLOCK_KEYS:
-                if hasattr(record, k):
-                    setattr(record, k, "[REDACTED]")
+            redact(record)
         except Exception:
             pass
         return True
 
 
-def configure_logging() -> None:
+# LogRecord 標準の属性（これ以外は extra として出力する）
+_STD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _STD_ATTRS:
+                out[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.Handler):
+    """伏せ字とメッセージ確定だけをして有界キューに積む"""
+
+    def __init__(self, q: queue.Queue, formatter: JsonFormatter) -> None:
+        super().__init__()
+        self._q = q
+        self._fmt = formatter
+        self.dropped = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            redact(record)
+            # 引数や例外は呼び出し側のオブジェクトを参照しているので、ここで文字列にしておく
+            if record.args:
+                record.msg = record.getMessage()
+                record.args = None
+            if record.exc_info:
+                record.exc_text = self._fmt.formatException(record.exc_info)
+                record.exc_info = None
+            self._q.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class _RotatingFile:
+    """サイズ/経過時間でローテートする追記ファイル"""
+
+    def __init__(self, path: Path, max_bytes: int, interval_seconds: float, backups: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval_seconds
+        self.backups = backups
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+
+    def _open(self) -> None:
+        self._f = self.path.open("a", encoding="utf-8")
+        self._size = self._f.tell()
+        self._opened = time.monotonic()
+
+    def _rotate(self) -> None:
+        self._f.close()
+        stamp = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%d-%H%M%S")
+        target = self.path.with_name(f"{self.path.name}.{stamp}")
+        n = 1
+        while target.exists():
+            target = self.path.with_name(f"{self.path.name}.{stamp}.{n}")
+            n += 1
+        os.replace(self.path, target)
+        old = sorted(self.path.parent.glob(f"{self.path.name}.*"), key=lambda p: p.stat().st_mtime)
+        for p in old[: max(0, len(old) - self.backups)]:
+            p.unlink(missing_ok=True)
+        self._open()
+
+    def write(self, data: str) -> None:
+        if self._size and (
+            (self.max_bytes and self._size + len(data) > self.max_bytes)
+            or (self.interval and time.monotonic() - self._opened > self.interval)
+        ):
+            self._rotate()
+        self._f.write(data)
+        self._f.flush()
+        self._size += len(data.encode("utf-8"))
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class _Stream:
+    def __init__(self, stream: TextIO) -> None:
+        self._s = stream
+
+    def write(self, data: str) -> None:
+        self._s.write(data)
+        self._s.flush()
+
+    def close(self) -> None:
+        pass
+
+
+_STOP = object()
+
+
+class LogPipeline:
+    """有界キュー + バッチ書き込みスレッド。path が None なら stderr に書く"""
+
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        *,
+        max_queue: int | None = None,
+        batch_max: int | None = None,
+        flush_interval: float | None = None,
+    ) -> None:
+        self._q: queue.Queue = queue.Queue(max_queue or settings.log_queue_max)
+        self._fmt = JsonFormatter()
+        self.handler = _QueueHandler(self._q, self._fmt)
+        self._batch_max = batch_max or settings.log_batch_max
+        self._flush_interval = flush_interval or settings.log_flush_interval_seconds
+        if path:
+            self._sink: _RotatingFile | _Stream = _RotatingFile(
+                Path(path),
+                settings.log_rotate_max_bytes,
+                settings.log_rotate_interval_seconds,
+                settings.log_backup_count,
+            )
+        else:
+            self._sink = _Stream(sys.stderr)
+        self._reported_drops = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+    def _drop_notice(self) -> str | None:
+        n = self.handler.dropped - self._reported_drops
+        if n <= 0:
+            return None
+        self._reported_drops += n
+        rec = logging.LogRecord(__name__, logging.WARNING, __file__, 0, "log_dropped", None, None)
+        rec.dropped = n
+        rec.dropped_total = self._reported_drops
+        return self._fmt.format(rec)
+
+    def _write(self, batch: list[logging.LogRecord]) -> None:
+        lines = []
+        for r in batch:
+            try:
+                lines.append(self._fmt.format(r))
+            except Exception:
+                # 整形できないレコードは捨てる（書き込みスレッドを止めない）
+                continue
+        notice = self._drop_notice()
+        if notice:
+            lines.append(notice)
+        if lines:
+            try:
+                self._sink.write("\n".join(lines) + "\n")
+            except Exception:
+                pass
+
+    def _run(self) -> None:
+        q = self._q
+        stopping = False
+        while True:
+            try:
+                first = q.get(timeout=self._flush_interval)
+            except queue.Empty:
+                if stopping:
+                    return
+                self._write([])
+                continue
+            batch: list[logging.LogRecord] = []
+            if first is _STOP:
+                stopping = True
+            else:
+                batch.append(first)
+            while len(batch) < self._batch_max:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+            self._write(batch)
+            if stopping and q.empty():
+                return
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """残りを書き切って止める"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._q.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._sink.close()
+
+
+_pipeline: LogPipeline | None = None
+
+
+def configure_logging() -> LogPipeline:
+    global _pipeline
     root = logging.getLogger()
-    root.setLevel(logging.INFO)
-    root.addFilter(NoBodyFilter())
-    logging.getLogger("uvicorn.error").addFilter(NoBodyFilter())
-    logging.getLogger("uvicorn.access").addFilter(NoBodyFilter())
+    root.setLevel(settings.log_level.upper())
+    if _pipeline is None:
+        _pipeline = LogPipeline(settings.log_file or None)
+        # 既存のハンドラ（basicConfig 等）は外し、全ロガーのレコードをパイプラインに流す
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(_pipeline.handler)
+        atexit.register(_pipeline.stop)
+        # uvicorn は自前のハンドラで書くので、そちらにも伏せ字をかける
+        logging.getLogger("uvicorn.error").addFilter(NoBodyFilter())
+        logging.getLogger("uvicorn.access").addFilter(NoBodyFilter())
+    return _pipeline
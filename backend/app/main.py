@@ -1,12 +1,19 @@
 from __future__ import annotations
 
 import logging
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
 from app.config import settings
+from app.ai_client import startup_ai_clients, shutdown_ai_clients
+from app.services import auth_cache, quota
+from app import metrics
 from app.logging_conf import configure_logging
 from app.middleware.request_id import RequestIdMiddleware
+from app.middleware.timing import RequestTimingMiddleware
+from app.middleware.profiler import ProfilerMiddleware
 from app.middleware.no_cache import NoCacheMiddleware
 
 from app.routes.health import router as health_router
@@ -15,13 +22,33 @@ from app.routes.auth import router as auth_router
 from app.routes.settings import router as settings_router
 from app.routes.generate import router as generate_router
 from app.routes.migration import router as migration_router
+from app.routes.metrics import router as metrics_router
 
 
-configure_logging()
+log_pipeline = configure_logging()
+metrics.register_callback("log_dropped_total", "Log records dropped because the log queue was full", lambda: log_pipeline.dropped, "counter")
 log = logging.getLogger(__name__)
 
-app = FastAPI(title=settings.app_name)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup_ai_clients()
+    await auth_cache.start()
+    await quota.start()
+    try:
+        yield
+    finally:
+        await quota.stop()
+        await auth_cache.stop()
+        await shutdown_ai_clients()
+
+
+app = FastAPI(title=settings.app_name, lifespan=lifespan)
+
+# 内側から: プロファイラ（有効時のみ）→ 計測（request_id を読む）→ request_id 付与 → no-cache
+if settings.profile_secret or settings.profile_sample_rate > 0:
+    app.add_middleware(ProfilerMiddleware)
+app.add_middleware(RequestTimingMiddleware)
 app.add_middleware(RequestIdMiddleware)
 app.add_middleware(NoCacheMiddleware)
 
@@ -31,6 +58,7 @@ app.include_router(auth_router)
 app.include_router(settings_router)
 app.include_router(generate_router)
 app.include_router(migration_router)
+app.include_router(metrics_router)
 
 
 @app.exception_handler(Exception)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+# 軽量なメトリクス（プロセス内）。
+# - stage("safety") で囲んだ区間をリクエスト単位に記録し、Server-Timing ヘッダとリクエストログに出す
+# - 同じ値を Prometheus 形式のヒストグラム/カウンタに積み、/metrics で返す
+# 値はワーカープロセスごと（複数ワーカーでは各プロセスをスクレイプするか、合算側で集計する）。
+
+# 秒単位のバケット（ステージは sub-ms から、上流呼び出しは数十秒まで）
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, value: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for lv, v in list(self._values.items()):
+            yield f"{self.name}{_fmt_labels(self.labels, lv)} {_num(v)}"
+
+
+_INF = 'le="+Inf"'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = STAGE_BUCKETS) -> None:
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = buckets
+        # labels -> [バケットごとの件数..., +Inf の件数, 合計, 件数]
+        self._series: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        s = self._series.get(labels)
+        if s is None:
+            s = self._series.setdefault(labels, [0] * (len(self.buckets) + 3))
+        s[bisect_left(self.buckets, value)] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for lv, s in list(self._series.items()):
+            acc = 0
+            for i, le in enumerate(self.buckets):
+                acc += s[i]
+                bound = f'le="{le}"'
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, lv, bound)} {_num(acc)}"
+            acc += s[len(self.buckets)]
+            yield f"{self.name}_bucket{_fmt_labels(self.labels, lv, _INF)} {_num(acc)}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, lv)} {_num(s[-2])}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, lv)} {_num(s[-1])}"
+
+
+class _Gauge:
+    """スクレイプ時に値を読むゲージ/カウンタ"""
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], float]) -> None:
+        self.name, self.help, self.kind, self.fn = name, help, kind, fn
+
+    def render(self) -> Iterator[str]:
+        try:
+            v = self.fn()
+        except Exception:
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield f"{self.name} {_num(v)}"
+
+
+_registry: list[Counter | Histogram | _Gauge] = []
+
+
+def counter(name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+    m = Counter(name, help, labels)
+    _registry.append(m)
+    return m
+
+
+def histogram(name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = STAGE_BUCKETS) -> Histogram:
+    m = Histogram(name, help, labels, buckets)
+    _registry.append(m)
+    return m
+
+
+def register_callback(name: str, help: str, fn: Callable[[], float], kind: str = "gauge") -> None:
+    _registry[:] = [m for m in _registry if m.name != name]
+    _registry.append(_Gauge(name, help, kind, fn))
+
+
+def render() -> str:
+    """Prometheus テキスト形式（0.0.4）"""
+    lines: list[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- 標準のメトリクス ----
+
+HTTP_DURATION = histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"))
+STAGE_DURATION = histogram("request_stage_duration_seconds", "Latency of each request stage", ("stage",))
+AI_UPSTREAM_DURATION = histogram("ai_upstream_duration_seconds", "Upstream model call latency", ("provider", "mode", "outcome"))
+AI_HTTP_REQUESTS = counter("ai_http_requests_total", "HTTP attempts to the model provider (includes SDK retries)", ("provider", "status"))
+AI_RETRIES = counter("ai_retries_total", "Application-level model call retries", ("provider", "reason"))
+AI_TOKENS = counter("ai_tokens_total", "Model token usage", ("provider", "model", "kind"))
+
+
+# ---- リクエスト単位のステージ計測 ----
+
+# [(ステージ名, 秒)]。RequestTimingMiddleware がリクエストごとに新しいリストを入れる
+_stages: ContextVar[list[tuple[str, float]] | None] = ContextVar("request_stages", default=None)
+
+
+class stage:
+    """with stage("safety"): ... の区間を記録する"""
+
+    __slots__ = ("name", "_t0")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> "stage":
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        record(self.name, time.perf_counter() - self._t0)
+
+
+def record(name: str, seconds: float) -> None:
+    STAGE_DURATION.observe(seconds, name)
+    stages = _stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+def begin_request() -> list[tuple[str, float]]:
+    stages: list[tuple[str, float]] = []
+    _stages.set(stages)
+    return stages
+
+
+def summarize(stages: list[tuple[str, float]]) -> dict[str, float]:
+    """ステージ名ごとの合計（ミリ秒）。同じステージが複数回あれば足す"""
+    out: dict[str, float] = {}
+    for name, sec in stages:
+        out[name] = out.get(name, 0.0) + sec * 1e3
+    return out
+
+
+def server_timing(by_stage: dict[str, float], total_ms: float | None = None) -> str:
+    parts = [f"{name};dur={ms:.2f}" for name, ms in by_stage.items()]
+    if total_ms is not None:
+        parts.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(parts)
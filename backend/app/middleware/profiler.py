@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable
+
+import anyio
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app import profiler
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+
+class ProfilerMiddleware(BaseHTTPMiddleware):
+    """署名付き X-Profile-Token かサンプリングで選ばれたリクエストのスタックを採取する。
+
+    PROFILE_SAMPLE_RATE と PROFILE_SECRET が両方未設定なら app.main はこのミドルウェアを追加しない。
+    """
+
+    async def dispatch(self, request: Request, call_next):
+        forced = profiler.verify(request.headers.get("X-Profile-Token"))
+        if not forced and not (settings.profile_sample_rate > 0 and random.random() < settings.profile_sample_rate):
+            return await call_next(request)
+        if not profiler.try_begin():
+            return await call_next(request)
+
+        sampler = profiler.Sampler(
+            threading.get_ident(),
+            settings.profile_interval_ms / 1e3,
+            settings.profile_max_depth,
+        )
+        t0 = time.perf_counter()
+        sampler.start()
+        try:
+            response: Response = await call_next(request)
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await self._finish(request, sampler, t0, forced)
+            raise
+
+        # ボディ（ストリーム含む）を送り終えるまで採取する。ボディが一度も読まれずに終わっても必ず止める
+        return _Profiled(response, lambda: self._finish(request, sampler, t0, forced))
+
+    async def _finish(self, request: Request, sampler: profiler.Sampler, t0: float, forced: bool) -> None:
+        try:
+            await asyncio.to_thread(sampler.stop)
+            elapsed_ms = (time.perf_counter() - t0) * 1e3
+            rid = getattr(request.state, "request_id", "") or ""
+            # 明示的に要求されたもの以外は遅いリクエストだけ残す
+            if not rid or not sampler.stacks or (not forced and elapsed_ms < settings.profile_slow_ms):
+                return
+            path = await asyncio.to_thread(profiler.write, rid, sampler.folded())
+            log.info(
+                "profile_written",
+                extra={"request_id": rid, "elapsed_ms": round(elapsed_ms, 1), "samples": sampler.samples, "path": str(path)},
+            )
+        except Exception:
+            log.exception("profile_failed")
+        finally:
+            profiler.end()
+
+
+class _Profiled:
+    """レスポンスの送出が終わった時点で finish を呼ぶ（切断・キャンセル・ボディ未送出でも呼ぶ）"""
+
+    def __init__(self, response: Response, finish: Callable[[], Awaitable[None]]) -> None:
+        self._response = response
+        self._finish = finish
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self._response(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self._finish()
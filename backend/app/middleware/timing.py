@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app import metrics
+
+log = logging.getLogger(__name__)
+
+
+class RequestTimingMiddleware(BaseHTTPMiddleware):
+    """ステージ計測の器を用意し、Server-Timing ヘッダ/リクエストログ/HTTP ヒストグラムに出す"""
+
+    async def dispatch(self, request: Request, call_next):
+        stages = metrics.begin_request()
+        t0 = time.perf_counter()
+        response: Response = await call_next(request)
+        elapsed = time.perf_counter() - t0
+
+        route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+        metrics.HTTP_DURATION.observe(elapsed, request.method, route, str(response.status_code))
+        if route == "/metrics":
+            return response
+
+        by_stage = metrics.summarize(stages)
+        response.headers["Server-Timing"] = metrics.server_timing(by_stage, elapsed * 1e3)
+        if by_stage:
+            log.info(
+                "request_timing",
+                extra={
+                    "request_id": getattr(request.state, "request_id", ""),
+                    "route": route,
+                    "status": response.status_code,
+                    "total_ms": round(elapsed * 1e3, 2),
+                    "stages_ms": {k: round(v, 2) for k, v in by_stage.items()},
+                },
+            )
+        return response
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db import Base, engine as default_engine
+
+import app.models  # noqa: F401  モデル登録（create_all用）
+
+log = logging.getLogger(__name__)
+
+# (version, name, statements)。追加のみ・書き換え禁止。DDL は SQLite/Postgres 共通で書く
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, "baseline", []),  # テーブル自体は Base.metadata.create_all
+    (
+        2,
+        "retention_indexes",
+        [
+            # retention: usage_daily を日付で古い順に消す / users を作成日時で走査する
+            "CREATE INDEX IF NOT EXISTS ix_usage_daily_date ON usage_daily (date)",
+            "CREATE INDEX IF NOT EXISTS ix_users_created_at ON users (created_at)",
+        ],
+    ),
+    (
+        3,
+        "maintenance_state",
+        [
+            # retention ジョブの再開位置（カーソル）など
+            "CREATE TABLE IF NOT EXISTS maintenance_state (k VARCHAR(64) PRIMARY KEY, v VARCHAR(255) NOT NULL)",
+        ],
+    ),
+]
+
+
+async def current_version(engine: AsyncEngine = default_engine) -> int:
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations "
+                "(version INTEGER PRIMARY KEY, name VARCHAR(64) NOT NULL, applied_at VARCHAR(32) NOT NULL)"
+            )
+        )
+        row = await conn.execute(text("SELECT MAX(version) FROM schema_migrations"))
+        return int(row.scalar() or 0)
+
+
+async def migrate(engine: AsyncEngine = default_engine) -> list[int]:
+    """未適用のマイグレーションを順に1つずつトランザクションで適用する。戻り値は適用した version"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    applied: list[int] = []
+    version = await current_version(engine)
+    for v, name, statements in MIGRATIONS:
+        if v <= version:
+            continue
+        async with engine.begin() as conn:
+            for sql in statements:
+                await conn.execute(text(sql))
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": v, "n": name, "t": dt.datetime.now(dt.timezone.utc).isoformat()},
+            )
+        log.info("migration_applied", extra={"version": v, "migration": name})
+        applied.append(v)
+    return applied
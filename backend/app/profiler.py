@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from app.config import settings
+
+# リクエスト単位のサンプリングプロファイラ（オプトイン）。
+# 対象リクエストの間だけ別スレッドで一定間隔にスタックを採取し、folded 形式
+# （"スレッド;関数 (ファイル:行);... 件数"。flamegraph.pl / speedscope でそのまま読める）で書き出す。
+# 記録するのは関数名・ファイル名・行番号だけで、引数やローカル変数（= 本文）は一切見ない。
+# asyncio は1スレッドで複数リクエストを交互に処理するため、同時に動いていた他のリクエストの処理も混ざる。
+
+# 採取するスレッド: イベントループのスレッドと、to_thread のワーカー（asyncio_N）
+_WORKER_PREFIX = "asyncio"
+# 待機中のスタック（イベントループの select / ワーカーの待ち）は数えない
+_IDLE_LEAVES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+_active = 0
+_active_lock = threading.Lock()
+
+
+def sign(expires_at: int, secret: str | None = None) -> str:
+    """X-Profile-Token の値（"期限:署名"）を作る"""
+    key = (secret or settings.profile_secret).encode("utf-8")
+    sig = hmac.new(key, f"profile:{expires_at}".encode("ascii"), hashlib.sha256).hexdigest()
+    return f"{expires_at}:{sig}"
+
+
+def verify(token: str | None, now: float | None = None) -> bool:
+    if not token or not settings.profile_secret:
+        return False
+    exp, _, sig = token.partition(":")
+    if not exp.isdigit() or int(exp) < (now or time.time()):
+        return False
+    return hmac.compare_digest(sign(int(exp)).encode("ascii"), token.encode("ascii", "replace"))
+
+
+def safe_name(request_id: str) -> str:
+    """X-Request-Id（クライアント指定もあり得る）をファイル名に使える形にする"""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", request_id)[:64].lstrip(".") or "request"
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """start() から stop() までの間、対象スレッドのスタックを数える"""
+
+    def __init__(self, loop_thread_id: int, interval: float, max_depth: int) -> None:
+        self._loop_tid = loop_thread_id
+        self._interval = interval
+        self._max_depth = max_depth
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _targets(self) -> dict[int, str]:
+        out = {}
+        for t in threading.enumerate():
+            if t.ident == self._loop_tid:
+                out[t.ident] = "loop"
+            elif t.ident is not None and t.name.startswith(_WORKER_PREFIX):
+                out[t.ident] = "worker"
+        return out
+
+    def _run(self) -> None:
+        targets = self._targets()
+        refresh = time.monotonic() + 0.5
+        while not self._stop.wait(self._interval):
+            if time.monotonic() > refresh:
+                targets = self._targets()
+                refresh = time.monotonic() + 0.5
+            frames = sys._current_frames()
+            self.samples += 1
+            for tid, kind in targets.items():
+                f = frames.get(tid)
+                if f is None:
+                    continue
+                code = f.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                labels: list[str] = []
+                while f is not None and len(labels) < self._max_depth:
+                    labels.append(_frame_label(f.f_code))
+                    f = f.f_back
+                labels.append(kind)
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+def try_begin() -> bool:
+    """同時に採取するリクエスト数の上限を守る"""
+    global _active
+    with _active_lock:
+        if _active >= settings.profile_max_concurrent:
+            return False
+        _active += 1
+        return True
+
+
+def end() -> None:
+    global _active
+    with _active_lock:
+        _active -= 1
+
+
+def write(request_id: str, folded: str) -> Path:
+    d = Path(settings.profile_dir)
+    d.mkdir(parents=True, exist_ok=True)
+    # X-Request-Id はクライアントが決められるので、サーバ側で時刻と乱数を付けて上書き/推測されないようにする
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    path = d / f"{stamp}-{secrets.token_hex(4)}-{safe_name(request_id)}.folded"
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(folded, encoding="utf-8")
+    os.replace(tmp, path)
+    return path
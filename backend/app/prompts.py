@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from functools import lru_cache
+
+from app.ai_client import GenerateContext
+from app.config import settings
+
+# A/B/C 生成プロンプト。上流のプロンプトキャッシュ（先頭一致）が効くように
+#   1. 全ユーザー共通の固定プレフィックス（PROMPT_VERSION で管理。文言を変えたら版を上げる）
+#   2. 長さ/コンボIDごとのテンプレート（組み合わせは数通り）
+#   3. ユーザーごとのデータ（NG/プロファイル。profile_cache でユーザー×etag 単位にキャッシュ）
+# の順に並べる。可変部分を前に置くと以降がすべてキャッシュ対象外になる。
+PROMPT_VERSION = "abc-2"
+
+# 上流のプロンプトキャッシュは先頭 1024 トークン以上の一致で効く。固定プレフィックスだけではこれに届かないので、
+# キャッシュが効くのはテンプレート/ユーザー設定/履歴まで含めて一致する場合（同じユーザーの再生成など）
+CACHE_MIN_PREFIX_TOKENS = 1024
+
+
+@lru_cache(maxsize=1)
+def static_prefix() -> str:
+    """全リクエストでバイト単位に同一の先頭部分"""
+    return (
+        settings.openai_instructions
+        + "\n\n【A/B/Cの役割（固定）】\n"
+        + "- A：おすすめ（最も自然で刺さる）。相手の温度感に合わせつつ、次に進める“軽い一手”を入れる。\n"
+        + "- B：無難（角が立たない）。丁寧で安全運転、確認質問は1つまで。\n"
+        + "- C：攻め（距離を詰める/提案強め）。ただし圧はかけない、断定しない。\n"
+        + "\n【制約】\n"
+        + "- 出力は必ず3案（A/B/C）。それぞれ狙いを変えて“別案”にする。\n"
+        + "- 断定せず提案として書く（命令・詰問・強要は禁止）。\n"
+        + "- 記号や箇条書き多用は避ける（会話文）。\n"
+        + "- 相手の名前が不明なら「○○」などのプレースホルダは使わない。\n"
+        + "- 後述の【ユーザー設定】にNGタグ/NG表現があれば必ず避ける。\n"
+        + f"\n（prompt {PROMPT_VERSION}）\n"
+    )
+
+
+def cache_key(ctx: GenerateContext) -> str:
+    """prompt_cache_key。固定プレフィックスとテンプレートが同じリクエストを同じキャッシュに寄せる（ユーザーは含めない）"""
+    return f"{PROMPT_VERSION}:{ctx.reply_length_pref or '-'}:{ctx.combo_id}"
+
+
+def length_guidance(pref: str | None) -> str:
+    if pref == "long":
+        return "各案は3〜5文を目安。『気遣いの一文』＋『次に進める軽い提案（候補日/時間/質問1つ）』を必ず入れる。"
+    return "各案は2〜3文を目安。短すぎる一言返信は禁止。"
+
+
+@lru_cache(maxsize=64)
+def template(reply_length_pref: str | None, combo_id: int) -> str:
+    """長さ/コンボIDごとの部分"""
+    return "\n【長さ】\n" + length_guidance(reply_length_pref) + "\n" + f"コンボID: {combo_id}\n"
+
+
+def user_section(ctx: GenerateContext) -> str:
+    """ユーザーごとの部分（combo_id/tuning には依存しない）"""
+    lines: list[str] = []
+    if ctx.ng_tags:
+        lines.append(f"NGタグ: {', '.join(ctx.ng_tags)}")
+    if ctx.ng_free_phrases:
+        lines.append("NG表現: " + " / ".join(ctx.ng_free_phrases))
+    if ctx.relationship_type:
+        lines.append(f"関係性: {ctx.relationship_type}")
+    if ctx.true_self_type:
+        lines.append(f"本来の自分: {ctx.true_self_type}")
+    if ctx.night_self_type:
+        lines.append(f"夜の自分: {ctx.night_self_type}")
+    if ctx.reply_length_pref:
+        lines.append(f"長さ: {ctx.reply_length_pref}")
+    if not lines:
+        return ""
+    return "\n【ユーザー設定】\n" + "".join(line + "\n" for line in lines)
+
+
+def system_instructions(ctx: GenerateContext) -> str:
+    user = ctx.profile_prompt if ctx.profile_prompt is not None else user_section(ctx)
+    return static_prefix() + template(ctx.reply_length_pref, ctx.combo_id) + user
+
+
+def user_input(history_text: str) -> str:
+    return (
+        "以下はトーク履歴。文脈を読んで返信案を作って。\n"
+        "----\n"
+        f"{history_text}\n"
+        "----\n"
+        "出力は JSON で、必ずキー A/B/C を含めてください。\n"
+    )
+
+
+def regen_hint(ctx: GenerateContext) -> str:
+    return (
+        "前回の出力に禁止表現/プレースホルダが含まれました。"
+        "次の文字列は絶対に含めないでください: "
+        + (" / ".join(ctx.ng_free_phrases) if ctx.ng_free_phrases else "(なし)")
+        + "。"
+        "また、相手の名前が不明なら○○などのプレースホルダは使わないでください。"
+    )
+
+
+def refill_hint(ctx: GenerateContext, kept: dict[str, str], missing: list[str]) -> str:
+    """ストリームで欠けた案だけを作り直すときの指示"""
+    lines = [f"{'/'.join(missing)} の案だけを作り直し、そのキーだけの JSON で返してください。"]
+    if kept:
+        lines.append("採用済みの案（これと内容が重ならないようにする）: " + " / ".join(f"{k}: {v}" for k, v in kept.items()))
+    lines.append(regen_hint(ctx))
+    return "\n".join(lines)
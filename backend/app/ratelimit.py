@@ -1,17 +1,8 @@
 from __future__ import annotations
 
-from fastapi import HTTPException
-from app.redis_client import redis_client
+from app.limiter import Rule, enforce
 
 
 async def fixed_window_limit(key: str, limit: int, window_seconds: int) -> None:
-    pipe = redis_client.pipeline()
-    pipe.incr(key)
-    pipe.ttl(key)
-    count, ttl = await pipe.execute()
-
-    if ttl == -1:
-        await redis_client.expire(key, window_seconds)
-
-    if int(count) > int(limit):
-        raise HTTPException(status_code=429, detail={"error": {"code": "RATE_LIMITED", "message": "回数制限です", "detail": {}}})
+    """互換用。実体は app.limiter の GCRA（窓境界での2倍バースト無し・1往復）"""
+    await enforce([Rule(key, limit, window_seconds)])
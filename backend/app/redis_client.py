@@ -1,6 +1,12 @@
 from __future__ import annotations
 
+import asyncio
+import heapq
+import math
 import os
+import sys
+import time
+from collections import OrderedDict
 from typing import Any, Optional
 
 try:
@@ -11,69 +17,309 @@ except Exception:
 from app.config import settings
 
 
+def gcra_decide(now: int, stored: list[str | None], args: list[int]) -> tuple[int, int, int, list[float]]:
+    """GCRA 判定（ローカル実装共通）。戻り値: (allowed, retry_ms, remaining, 新TAT一覧)"""
+    allowed, retry, remaining = 1, 0.0, -1
+    tats: list[float] = []
+    for i, raw in enumerate(stored):
+        limit, window = args[2 * i], args[2 * i + 1]
+        interval = window / limit
+        tat = max(float(raw or now), now)
+        new_tat = tat + interval
+        allow_at = new_tat - window
+        if now < allow_at:
+            allowed = 0
+            retry = max(retry, allow_at - now)
+        else:
+            rem = math.floor((now - allow_at) / interval)
+            remaining = rem if remaining < 0 else min(remaining, rem)
+        tats.append(new_tat)
+    if not allowed:
+        remaining = 0
+    return allowed, math.ceil(retry), remaining, tats
+
+
 class _MemoryRedis:
-    def __init__(self):
-        self._kv: dict[str, str] = {}
-        self._set: dict[str, set[str]] = {}
-        self._ttl: dict[str, int] = {}
+    """REDIS_DISABLED 用のプロセス内ストア。
+
+    期限は monotonic 時刻で持ち、アクセス時の遅延失効＋ヒープ駆動のバックグラウンド掃除で消す。
+    キー数が上限を超えたら最も古く使われたキーから追い出す（LRU）。
+    """
+
+    def __init__(self, max_keys: int | None = None, sweep_interval: float | None = None):
+        # 値は str（文字列）または set[str]（集合）。並び順が LRU 順
+        self._data: OrderedDict[str, str | set[str]] = OrderedDict()
+        self._deadline: dict[str, float] = {}
+        self._heap: list[tuple[float, str]] = []
+        self._subs: dict[str, set[asyncio.Queue]] = {}
+        self._max_keys = max_keys if max_keys is not None else settings.memory_redis_max_keys
+        self._sweep_interval = sweep_interval if sweep_interval is not None else settings.memory_redis_sweep_interval_seconds
+        self._sweeper: asyncio.Task | None = None
+        self.expired_keys = 0
+        self.evicted_keys = 0
+
+    # ---- 期限・LRU の内部処理 ----
+
+    def _remove(self, key: str) -> None:
+        self._data.pop(key, None)
+        self._deadline.pop(key, None)
+
+    def _alive(self, key: str) -> bool:
+        dl = self._deadline.get(key)
+        if dl is not None and dl <= time.monotonic():
+            self._remove(key)
+            self.expired_keys += 1
+            return False
+        return key in self._data
+
+    def _touch(self, key: str) -> None:
+        self._data.move_to_end(key)
+
+    def _store(self, key: str, value: str | set[str]) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while self._max_keys and len(self._data) > self._max_keys:
+            old, _ = self._data.popitem(last=False)
+            self._deadline.pop(old, None)
+            self.evicted_keys += 1
+
+    def _set_deadline(self, key: str, seconds: float) -> None:
+        dl = time.monotonic() + seconds
+        self._deadline[key] = dl
+        heapq.heappush(self._heap, (dl, key))
+        if len(self._heap) > 2 * len(self._deadline) + 1024:
+            # 期限の更新で溜まった古いエントリを捨てる
+            self._heap = [(d, k) for k, d in self._deadline.items()]
+            heapq.heapify(self._heap)
+        self._ensure_sweeper()
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is not None and not self._sweeper.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._sweeper = loop.create_task(self._sweep_loop())
+
+    def sweep(self, limit: int = 1000) -> int:
+        """期限切れキーをヒープ順に最大 limit 件消す"""
+        now = time.monotonic()
+        n = 0
+        while self._heap and self._heap[0][0] <= now and n < limit:
+            dl, key = heapq.heappop(self._heap)
+            if self._deadline.get(key) == dl:
+                self._remove(key)
+                self.expired_keys += 1
+                n += 1
+        return n
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            if self.sweep() >= 1000:
+                await asyncio.sleep(0)
+                continue
+            wait = self._sweep_interval
+            if self._heap:
+                wait = min(wait, max(0.0, self._heap[0][0] - time.monotonic()))
+            await asyncio.sleep(wait)
+
+    def _str(self, key: str) -> str | None:
+        if not self._alive(key):
+            return None
+        v = self._data[key]
+        return v if isinstance(v, str) else None
+
+    # ---- Redis 互換 API ----
 
     async def get(self, key: str) -> Optional[str]:
-        return self._kv.get(key)
+        v = self._str(key)
+        if v is not None:
+            self._touch(key)
+        return v
 
-    async def set(self, key: str, value: str, ex: int | None = None, nx: bool = False) -> bool:
-        if nx and key in self._kv:
+    async def set(self, key: str, value: str, ex: int | None = None, nx: bool = False, px: int | None = None) -> bool:
+        if nx and self._alive(key):
             return False
-        self._kv[key] = value
+        self._store(key, str(value))
+        # Redis と同じく、期限指定なしの SET は既存の期限を消す
+        self._deadline.pop(key, None)
         if ex is not None:
-            self._ttl[key] = ex
+            self._set_deadline(key, ex)
+        elif px is not None:
+            self._set_deadline(key, px / 1000)
         return True
 
     async def delete(self, key: str) -> int:
-        n = 1 if key in self._kv else 0
-        self._kv.pop(key, None)
-        self._ttl.pop(key, None)
-        self._set.pop(key, None)
+        n = 1 if self._alive(key) else 0
+        self._remove(key)
         return n
 
     async def incr(self, key: str) -> int:
-        v = int(self._kv.get(key) or "0") + 1
-        self._kv[key] = str(v)
+        v = int(self._str(key) or "0") + 1
+        self._store(key, str(v))
+        return v
+
+    async def decr(self, key: str) -> int:
+        v = int(self._str(key) or "0") - 1
+        self._store(key, str(v))
         return v
 
+    async def incr_below(self, key: str, limit: int, ex: int) -> list[int]:
+        """値が limit 未満なら +1。戻り値 [1=加算/0=上限/-1=キー無し, 値]"""
+        raw = self._str(key)
+        if raw is None:
+            return [-1, 0]
+        v = int(raw)
+        if v >= limit:
+            return [0, v]
+        v += 1
+        self._store(key, str(v))
+        self._set_deadline(key, ex)
+        return [1, v]
+
+    async def set_if_newer(self, key: str, version: int, value: str, ex: int) -> int:
+        """保存中の "version|value" より新しい version のときだけ上書き。戻り値 1=更新/0=据え置き"""
+        raw = self._str(key)
+        if raw is not None and int(raw.split("|", 1)[0]) >= version:
+            return 0
+        self._store(key, f"{version}|{value}")
+        self._set_deadline(key, ex)
+        return 1
+
     async def expire(self, key: str, seconds: int) -> bool:
-        if key in self._kv or key in self._set:
-            self._ttl[key] = seconds
-            return True
-        return False
+        if not self._alive(key):
+            return False
+        self._set_deadline(key, seconds)
+        return True
 
     async def ttl(self, key: str) -> int:
-        return self._ttl.get(key, -1)
+        if not self._alive(key):
+            return -2
+        dl = self._deadline.get(key)
+        if dl is None:
+            return -1
+        return max(0, math.ceil(dl - time.monotonic()))
 
     async def exists(self, key: str) -> int:
-        return 1 if (key in self._kv or key in self._set) else 0
+        return 1 if self._alive(key) else 0
 
     async def sadd(self, key: str, member: str) -> int:
-        s = self._set.setdefault(key, set())
+        s = self._data.get(key) if self._alive(key) else None
+        if not isinstance(s, set):
+            s = set()
+            self._store(key, s)
+        else:
+            self._touch(key)
         before = len(s)
         s.add(member)
         return 1 if len(s) > before else 0
 
     async def smembers(self, key: str) -> set[str]:
-        return set(self._set.get(key, set()))
+        if not self._alive(key):
+            return set()
+        s = self._data[key]
+        return set(s) if isinstance(s, set) else set()
+
+    async def spop(self, key: str, count: int = 1) -> list[str]:
+        if not self._alive(key):
+            return []
+        s = self._data[key]
+        if not isinstance(s, set):
+            return []
+        out = [s.pop() for _ in range(min(count, len(s)))]
+        if not s:
+            self._remove(key)
+        return out
+
+    async def dbsize(self) -> int:
+        self.sweep()
+        return len(self._data)
+
+    async def info(self, section: str | None = None) -> dict[str, Any]:
+        """キー数と概算メモリ（バイト）。Redis の INFO に寄せたキー名で返す"""
+        self.sweep()
+        used = sys.getsizeof(self._data) + sys.getsizeof(self._deadline) + sys.getsizeof(self._heap)
+        for k, v in self._data.items():
+            used += sys.getsizeof(k)
+            if isinstance(v, set):
+                used += sys.getsizeof(v) + sum(sys.getsizeof(m) for m in v)
+            else:
+                used += sys.getsizeof(v)
+        return {
+            "used_memory": used,
+            "keys": len(self._data),
+            "expires": len(self._deadline),
+            "expired_keys": self.expired_keys,
+            "evicted_keys": self.evicted_keys,
+            "maxkeys": self._max_keys,
+        }
+
+    async def gcra(self, keys: list[str], args: list[int]) -> list[int]:
+        """app.limiter の Lua スクリプトと同じ判定（複数キーを原子的に）"""
+        now = int(time.time() * 1000)
+        allowed, retry, remaining, tats = gcra_decide(now, [self._str(k) for k in keys], args)
+        if allowed:
+            for key, new_tat in zip(keys, tats):
+                await self.set(key, repr(new_tat), ex=max(1, math.ceil((new_tat - now) / 1000)))
+        return [allowed, retry, remaining]
+
+    async def publish(self, channel: str, message: str) -> int:
+        queues = self._subs.get(channel, set())
+        for q in queues:
+            q.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(queues)
+
+    def pubsub(self):
+        return _MemoryPubSub(self)
 
     def pipeline(self):
         return _MemoryPipeline(self)
 
 
+class _MemoryPubSub:
+    """redis.asyncio の PubSub 互換（subscribe/listen/unsubscribe/aclose）の最小実装"""
+
+    def __init__(self, r: _MemoryRedis):
+        self._r = r
+        self._q: asyncio.Queue = asyncio.Queue()
+        self._channels: set[str] = set()
+
+    async def subscribe(self, *channels: str) -> None:
+        for ch in channels:
+            self._r._subs.setdefault(ch, set()).add(self._q)
+            self._channels.add(ch)
+
+    async def unsubscribe(self, *channels: str) -> None:
+        for ch in channels or tuple(self._channels):
+            self._r._subs.get(ch, set()).discard(self._q)
+            self._channels.discard(ch)
+
+    async def listen(self):
+        while True:
+            yield await self._q.get()
+
+    async def aclose(self) -> None:
+        await self.unsubscribe()
+
+
 class _MemoryPipeline:
     def __init__(self, r: _MemoryRedis):
         self._r = r
         self._ops: list[tuple[str, tuple[Any, ...], dict[str, Any]]] = []
 
+    def get(self, *a, **kw):
+        self._ops.append(("get", a, kw))
+        return self
+
     def incr(self, *a, **kw):
         self._ops.append(("incr", a, kw))
         return self
 
+    def decr(self, *a, **kw):
+        self._ops.append(("decr", a, kw))
+        return self
+
     def ttl(self, *a, **kw):
         self._ops.append(("ttl", a, kw))
         return self
@@ -90,6 +336,14 @@ class _MemoryPipeline:
         self._ops.append(("set", a, kw))
         return self
 
+    def sadd(self, *a, **kw):
+        self._ops.append(("sadd", a, kw))
+        return self
+
+    def exists(self, *a, **kw):
+        self._ops.append(("exists", a, kw))
+        return self
+
     async def execute(self):
         out = []
         for name, a, kw in self._ops:
@@ -99,6 +353,13 @@ class _MemoryPipeline:
 
 
 def _create_client():
+    backend = (settings.state_backend or "redis").lower()
+    if backend == "sqlite":
+        # 複数ワーカーで共有するローカル状態（Redisサーバ不要）
+        from app.redis_sqlite import SqliteRedis
+        return SqliteRedis(settings.local_state_path)
+    if backend == "memory":
+        return _MemoryRedis()
     if os.getenv("REDIS_DISABLED", "").lower() in ("1", "true", "yes"):
         return _MemoryRedis()
     if redis is None:
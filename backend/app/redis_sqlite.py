@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from app.config import settings
+from app.redis_client import gcra_decide
+
+# STATE_BACKEND=sqlite 用。1台のマシン上の複数 uvicorn ワーカーで
+# セッション/レート制限/冪等キー等を共有するための、SQLite(WAL) ファイル上の Redis 互換ストア。
+# 期限は全プロセスで共有するため壁時計（epoch 秒）で持つ。
+
+_SCHEMA = (
+    # t: 's'=文字列, 'z'=集合（メンバーは smem）
+    "CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, t TEXT NOT NULL, v TEXT NOT NULL, exp REAL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS kv_exp ON kv(exp) WHERE exp IS NOT NULL",
+    "CREATE TABLE IF NOT EXISTS smem (k TEXT NOT NULL, m TEXT NOT NULL, PRIMARY KEY (k, m)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, ch TEXT NOT NULL, msg TEXT NOT NULL, ts REAL NOT NULL)",
+)
+
+_EVENT_RETENTION_SECONDS = 60.0
+
+Op = tuple[Callable[..., Any], tuple[Any, ...], dict[str, Any], bool]
+
+
+def _row(c: sqlite3.Connection, now: float, key: str) -> tuple[str, str, float | None] | None:
+    r = c.execute("SELECT t, v, exp FROM kv WHERE k = ?", (key,)).fetchone()
+    if r is None:
+        return None
+    if r[2] is not None and r[2] <= now:
+        return None
+    return r
+
+
+def _drop(c: sqlite3.Connection, key: str) -> None:
+    c.execute("DELETE FROM kv WHERE k = ?", (key,))
+    c.execute("DELETE FROM smem WHERE k = ?", (key,))
+
+
+def _put(c: sqlite3.Connection, key: str, t: str, v: str, exp: float | None) -> None:
+    c.execute(
+        "INSERT INTO kv (k, t, v, exp) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(k) DO UPDATE SET t = excluded.t, v = excluded.v, exp = excluded.exp",
+        (key, t, v, exp),
+    )
+
+
+def _op_get(c, now, key):
+    r = _row(c, now, key)
+    return r[1] if r and r[0] == "s" else None
+
+
+def _op_set(c, now, key, value, ex=None, nx=False, px=None):
+    if nx and _row(c, now, key) is not None:
+        return False
+    exp = now + ex if ex is not None else (now + px / 1000 if px is not None else None)
+    c.execute("DELETE FROM smem WHERE k = ?", (key,))
+    _put(c, key, "s", str(value), exp)
+    return True
+
+
+def _op_delete(c, now, key):
+    n = 1 if _row(c, now, key) is not None else 0
+    _drop(c, key)
+    return n
+
+
+def _op_incr(c, now, key):
+    r = _row(c, now, key)
+    v = int(r[1] if r and r[0] == "s" else 0) + 1
+    _put(c, key, "s", str(v), r[2] if r else None)
+    return v
+
+
+def _op_decr(c, now, key):
+    r = _row(c, now, key)
+    v = int(r[1] if r and r[0] == "s" else 0) - 1
+    _put(c, key, "s", str(v), r[2] if r else None)
+    return v
+
+
+def _op_incr_below(c, now, key, limit, ex):
+    r = _row(c, now, key)
+    if r is None or r[0] != "s":
+        return [-1, 0]
+    v = int(r[1])
+    if v >= limit:
+        return [0, v]
+    _put(c, key, "s", str(v + 1), now + ex)
+    return [1, v + 1]
+
+
+def _op_set_if_newer(c, now, key, version, value, ex):
+    r = _row(c, now, key)
+    if r is not None and r[0] == "s" and int(r[1].split("|", 1)[0]) >= version:
+        return 0
+    c.execute("DELETE FROM smem WHERE k = ?", (key,))
+    _put(c, key, "s", f"{version}|{value}", now + ex)
+    return 1
+
+
+def _op_expire(c, now, key, seconds):
+    if _row(c, now, key) is None:
+        return False
+    c.execute("UPDATE kv SET exp = ? WHERE k = ?", (now + seconds, key))
+    return True
+
+
+def _op_ttl(c, now, key):
+    r = _row(c, now, key)
+    if r is None:
+        return -2
+    if r[2] is None:
+        return -1
+    return max(0, math.ceil(r[2] - now))
+
+
+def _op_exists(c, now, key):
+    return 1 if _row(c, now, key) is not None else 0
+
+
+def _op_sadd(c, now, key, member):
+    r = _row(c, now, key)
+    if r is None or r[0] != "z":
+        _drop(c, key)
+        _put(c, key, "z", "", None)
+    cur = c.execute("INSERT OR IGNORE INTO smem (k, m) VALUES (?, ?)", (key, str(member)))
+    return cur.rowcount
+
+
+def _op_smembers(c, now, key):
+    r = _row(c, now, key)
+    if r is None or r[0] != "z":
+        return set()
+    return {m for (m,) in c.execute("SELECT m FROM smem WHERE k = ?", (key,))}
+
+
+def _op_spop(c, now, key, count):
+    r = _row(c, now, key)
+    if r is None or r[0] != "z":
+        return []
+    out = [m for (m,) in c.execute("SELECT m FROM smem WHERE k = ? LIMIT ?", (key, count))]
+    c.executemany("DELETE FROM smem WHERE k = ? AND m = ?", [(key, m) for m in out])
+    if c.execute("SELECT 1 FROM smem WHERE k = ? LIMIT 1", (key,)).fetchone() is None:
+        _drop(c, key)
+    return out
+
+
+def _op_publish(c, now, channel, message):
+    c.execute("INSERT INTO events (ch, msg, ts) VALUES (?, ?, ?)", (channel, str(message), now))
+    return 0
+
+
+def _op_gcra(c, now, keys, args):
+    now_ms = int(now * 1000)
+    allowed, retry, remaining, tats = gcra_decide(now_ms, [_op_get(c, now, k) for k in keys], args)
+    if allowed:
+        for key, new_tat in zip(keys, tats):
+            c.execute("DELETE FROM smem WHERE k = ?", (key,))
+            _put(c, key, "s", repr(new_tat), new_tat / 1000)
+    return [allowed, retry, remaining]
+
+
+def _op_sweep(c, now, limit):
+    rows = c.execute("SELECT k FROM kv WHERE exp IS NOT NULL AND exp <= ? LIMIT ?", (now, limit)).fetchall()
+    for (k,) in rows:
+        _drop(c, k)
+    c.execute("DELETE FROM events WHERE ts <= ?", (now - _EVENT_RETENTION_SECONDS,))
+    return len(rows)
+
+
+class SqliteRedis:
+    """redis_client と同じ async インターフェース（get/set NX EX/incr/expire/sadd/smembers/pipeline 等）"""
+
+    def __init__(self, path: str, sweep_interval: float | None = None):
+        self._path = path
+        self._sweep_interval = sweep_interval if sweep_interval is not None else settings.local_state_sweep_interval_seconds
+        # 接続は専用スレッド1本に閉じ込める（sqlite3 の接続はスレッド間で共有しない）
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-state")
+        self._conn: sqlite3.Connection | None = None
+        self._sweeper: asyncio.Task | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        c = sqlite3.connect(self._path, isolation_level=None, timeout=settings.local_state_busy_timeout_ms / 1000)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute(f"PRAGMA busy_timeout={int(settings.local_state_busy_timeout_ms)}")
+        for ddl in _SCHEMA:
+            c.execute(ddl)
+        self._conn = c
+        return c
+
+    def _tx(self, ops: list[Op]) -> list[Any]:
+        c = self._conn or self._connect()
+        write = any(w for _, _, _, w in ops)
+        # 書き込みは IMMEDIATE で最初から書き込みロックを取り、プロセス間で直列化する
+        c.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            now = time.time()
+            out = [fn(c, now, *a, **kw) for fn, a, kw, _ in ops]
+            c.execute("COMMIT")
+            return out
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+
+    async def _run(self, ops: list[Op]) -> list[Any]:
+        self._ensure_sweeper()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._tx, ops)
+
+    async def _one(self, fn: Callable[..., Any], *a: Any, write: bool = False, **kw: Any) -> Any:
+        return (await self._run([(fn, a, kw, write)]))[0]
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is not None and not self._sweeper.done():
+            return
+        self._sweeper = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                n = await self._one(_op_sweep, 500, write=True)
+            except Exception:
+                n = 0
+            await asyncio.sleep(0 if n >= 500 else self._sweep_interval)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._one(_op_get, key)
+
+    async def set(self, key: str, value: str, ex: int | None = None, nx: bool = False, px: int | None = None) -> bool:
+        return await self._one(_op_set, key, value, ex=ex, nx=nx, px=px, write=True)
+
+    async def delete(self, key: str) -> int:
+        return await self._one(_op_delete, key, write=True)
+
+    async def incr(self, key: str) -> int:
+        return await self._one(_op_incr, key, write=True)
+
+    async def decr(self, key: str) -> int:
+        return await self._one(_op_decr, key, write=True)
+
+    async def incr_below(self, key: str, limit: int, ex: int) -> list[int]:
+        return await self._one(_op_incr_below, key, limit, ex, write=True)
+
+    async def set_if_newer(self, key: str, version: int, value: str, ex: int) -> int:
+        return await self._one(_op_set_if_newer, key, version, value, ex, write=True)
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        return await self._one(_op_expire, key, seconds, write=True)
+
+    async def ttl(self, key: str) -> int:
+        return await self._one(_op_ttl, key)
+
+    async def exists(self, key: str) -> int:
+        return await self._one(_op_exists, key)
+
+    async def sadd(self, key: str, member: str) -> int:
+        return await self._one(_op_sadd, key, member, write=True)
+
+    async def smembers(self, key: str) -> set[str]:
+        return await self._one(_op_smembers, key)
+
+    async def spop(self, key: str, count: int = 1) -> list[str]:
+        return await self._one(_op_spop, key, count, write=True)
+
+    async def gcra(self, keys: list[str], args: list[int]) -> list[int]:
+        return await self._one(_op_gcra, keys, args, write=True)
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self._one(_op_publish, channel, message, write=True)
+
+    def pubsub(self):
+        return _SqlitePubSub(self)
+
+    def pipeline(self):
+        return _SqlitePipeline(self)
+
+    async def dbsize(self) -> int:
+        def _count(c, now):
+            return c.execute("SELECT COUNT(*) FROM kv WHERE exp IS NULL OR exp > ?", (now,)).fetchone()[0]
+
+        return await self._one(_count)
+
+    async def info(self, section: str | None = None) -> dict[str, Any]:
+        def _info(c, now):
+            keys = c.execute("SELECT COUNT(*) FROM kv WHERE exp IS NULL OR exp > ?", (now,)).fetchone()[0]
+            expires = c.execute("SELECT COUNT(*) FROM kv WHERE exp > ?", (now,)).fetchone()[0]
+            pages = c.execute("PRAGMA page_count").fetchone()[0]
+            page_size = c.execute("PRAGMA page_size").fetchone()[0]
+            return {"used_memory": pages * page_size, "keys": keys, "expires": expires, "path": self._path}
+
+        return await self._one(_info)
+
+
+class _SqlitePipeline:
+    """キューした操作を1トランザクションでまとめて実行する"""
+
+    _WRITES = {"set", "delete", "incr", "decr", "expire", "sadd"}
+    _OPS = {
+        "get": _op_get,
+        "set": _op_set,
+        "delete": _op_delete,
+        "incr": _op_incr,
+        "decr": _op_decr,
+        "expire": _op_expire,
+        "ttl": _op_ttl,
+        "exists": _op_exists,
+        "sadd": _op_sadd,
+        "smembers": _op_smembers,
+    }
+
+    def __init__(self, r: SqliteRedis):
+        self._r = r
+        self._ops: list[Op] = []
+
+    def __getattr__(self, name: str):
+        fn = self._OPS.get(name)
+        if fn is None:
+            raise AttributeError(name)
+
+        def queue(*a, **kw):
+            self._ops.append((fn, a, kw, name in self._WRITES))
+            return self
+
+        return queue
+
+    async def execute(self):
+        ops, self._ops = self._ops, []
+        if not ops:
+            return []
+        return await self._r._run(ops)
+
+
+class _SqlitePubSub:
+    """events テーブルをポーリングする PubSub（プロセス間で届く）"""
+
+    def __init__(self, r: SqliteRedis):
+        self._r = r
+        self._channels: set[str] = set()
+        self._last_id: int | None = None
+
+    async def subscribe(self, *channels: str) -> None:
+        self._channels.update(channels)
+        if self._last_id is None:
+            self._last_id = await self._r._one(lambda c, now: c.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0])
+
+    async def unsubscribe(self, *channels: str) -> None:
+        for ch in channels or tuple(self._channels):
+            self._channels.discard(ch)
+
+    async def listen(self):
+        while True:
+            channels = sorted(self._channels)
+            if channels:
+                marks = ",".join("?" for _ in channels)
+                rows = await self._r._one(
+                    lambda c, now: c.execute(
+                        f"SELECT id, ch, msg FROM events WHERE id > ? AND ch IN ({marks}) ORDER BY id",
+                        (self._last_id or 0, *channels),
+                    ).fetchall()
+                )
+                for rid, ch, msg in rows:
+                    self._last_id = rid
+                    yield {"type": "message", "channel": ch, "data": msg}
+            await asyncio.sleep(settings.local_state_poll_seconds)
+
+    async def aclose(self) -> None:
+        await self.unsubscribe()
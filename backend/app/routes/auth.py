@@ -8,7 +8,7 @@ from app.db import get_db
 from app.models import User, UserSettings, PlanStatus
 from app.schemas import AuthAnonymousResponse
 from app.security import create_session
-from app.ratelimit import fixed_window_limit
+from app.limiter import Rule, enforce
 from app.utils import etag_for_json
 
 router = APIRouter()
@@ -25,9 +25,10 @@ async def auth_anonymous(
     device_fingerprint: str | None = Header(default=None, alias="X-Device-Fingerprint"),
 ):
     ip = _client_ip(request)
-    await fixed_window_limit(f"rl:auth:ip:{ip}:10m", settings.rl_auth_ip_limit, settings.rl_auth_ip_window_seconds)
+    rules = [Rule(f"rl:auth:ip:{ip}", settings.rl_auth_ip_limit, settings.rl_auth_ip_window_seconds)]
     if device_fingerprint:
-        await fixed_window_limit(f"rl:auth:df:{device_fingerprint}:10m", settings.rl_auth_df_limit, settings.rl_auth_df_window_seconds)
+        rules.append(Rule(f"rl:auth:df:{device_fingerprint}", settings.rl_auth_df_limit, settings.rl_auth_df_window_seconds))
+    await enforce(rules)
 
     user = User()
     db.add(user)
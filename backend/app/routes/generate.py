@@ -1,38 +1,38 @@
 from __future__ import annotations
 
 import datetime as dt
-from fastapi import APIRouter, Depends, Header, Request
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable
+
+import anyio
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
 
+from app import metrics
 from app.db import get_db
 from app.schemas import GenerateRequest, GenerateResponse, Candidate, DailyInfo
 from app.security import get_auth_context, AuthContext
 from app.config import settings
-from app.ratelimit import fixed_window_limit
+from app.limiter import Rule, enforce
 from app.errors import err
-from app.safety_gate import check as safety_check
-from app.ai_client import get_ai_client, GenerateContext
-from app.models import UserSettings
-from app.services.usage import get_or_create_usage
-from app.services.idempotency import acquire
+from app.line_history import compact_to_budget
+from app.safety_gate import check_async as safety_check
+from app.ai_client import get_ai_client, GenerateContext, LABELS
+from app.services import idempotency, profile_cache, quota, singleflight
+from app.token_budget import budget_for
+from app.utils import etag_for_json
 from app.utils_time import jst_today_ymd
 
 router = APIRouter()
+log = logging.getLogger(__name__)
 
 
 def _daily_limit(plan: str) -> int:
     return settings.pro_generate_daily_limit if plan == "pro" else settings.free_generate_daily_limit
 
 
-def _to_list(v) -> list[str]:
-    if v is None:
-        return []
-    if isinstance(v, list):
-        return [str(x) for x in v]
-    return [str(v)]
-
-
 def _blocked_candidates(reason: str) -> list[str]:
     a = (
         "ごめんね、その内容はこのアプリでは手伝えないよ。"
@@ -44,103 +44,310 @@ def _blocked_candidates(reason: str) -> list[str]:
     return [a, b, c]
 
 
-@router.post("/generate", response_model=GenerateResponse)
-async def generate(
-    req: GenerateRequest,
-    request: Request,
-    idempotency_key: str | None = Header(default=None, alias="Idempotency-Key"),
-    db: AsyncSession = Depends(get_db),
-    auth: AuthContext = Depends(get_auth_context),
-):
-    rid = getattr(request.state, "request_id", None) or ""
+def _daily(limit: int, used: int) -> DailyInfo:
+    return DailyInfo(date=jst_today_ymd(), limit=limit, used=used, remaining=max(0, limit - used))
+
+
+def _meta_pro(plan: str) -> dict | None:
+    if plan != "pro":
+        return None
+    return {
+        "like": {"value": 55, "note": "推定"},
+        "risk": {"value": 20, "note": "推定"},
+    }
+
 
+def _validate(req: GenerateRequest, auth: AuthContext) -> None:
     if len(req.history_text) > settings.generate_max_chars:
         raise err("VALIDATION_FAILED", "入力が長すぎます", {"max_chars": settings.generate_max_chars}, status_code=422)
 
     if auth.plan != "pro" and req.combo_id not in (0, 1):
         raise err("PLAN_REQUIRED", "有料版のみ対応しています", {"combo_id": req.combo_id}, status_code=403)
 
-    await fixed_window_limit(
-        f"rl:generate:user:{auth.user_id}:1m",
-        settings.rl_generate_minute_limit,
-        settings.rl_generate_minute_window_seconds,
-    )
 
-    if idempotency_key:
-        ok = await acquire(auth.user_id, idempotency_key)
-        if not ok:
-            raise err("RATE_LIMITED", "同じリクエストが処理中です", {"idempotency": "replay"}, status_code=429)
+def _fingerprint(req: GenerateRequest) -> str:
+    # 同一キーで内容が異なる再送を検出するためのハッシュ（本文は保存しない）
+    return etag_for_json({"h": req.history_text, "c": req.combo_id, "t": req.tuning})
+
+
+async def _begin_idempotency(auth: AuthContext, idempotency_key: str, fp: str) -> dict | None:
+    """処理権を得たら None、完了済みならそのレスポンスを返す"""
+    with metrics.stage("idempotency"):
+        res = await idempotency.acquire(auth.user_id, idempotency_key, fp)
+    if res.mismatch:
+        raise err("IDEMPOTENCY_KEY_REUSED", "同じIdempotency-Keyで異なるリクエストです", status_code=422)
+    if res.in_progress:
+        raise err("RATE_LIMITED", "同じリクエストが処理中です", {"idempotency": "in_progress"}, status_code=429)
+    return res.response
+
+
+async def _check_limits(auth: AuthContext, db: AsyncSession) -> tuple[quota.Reservation, int]:
+    """レート制限の後、日次枠を1回分確保する（AI失敗時は quota.refund で返す）"""
+    with metrics.stage("ratelimit"):
+        await enforce([Rule(f"rl:generate:user:{auth.user_id}", settings.rl_generate_minute_limit, settings.rl_generate_minute_window_seconds)])
 
-    usage = await get_or_create_usage(db, auth.user_id, auth.plan)
     limit = _daily_limit(auth.plan)
-    used = int(usage.generate_count)
-    if used >= limit:
-        raise err("DAILY_LIMIT_REACHED", "本日の上限に達しました", {"limit": limit, "used": used}, status_code=429)
+    with metrics.stage("quota"):
+        res = await quota.reserve(db, auth.user_id, auth.plan, limit)
+    if not res.allowed:
+        raise err("DAILY_LIMIT_REACHED", "本日の上限に達しました", {"limit": limit, "used": res.used}, status_code=429)
+    return res, limit
+
+
+async def _load_context(db: AsyncSession, auth: AuthContext, req: GenerateRequest) -> tuple[GenerateContext, str | None]:
+    with metrics.stage("settings"):
+        profile = await profile_cache.load(db, auth.user_id)
+    ctx = profile_cache.for_request(profile, req.combo_id, req.tuning if auth.plan == "pro" else None)
+    return ctx, profile.etag
+
 
-    why = safety_check(req.history_text)
+def _compact_history(history_text: str, rid: str) -> str:
+    """モデルに渡す前にトーク履歴を圧縮する（安全チェック/冪等性の照合は元の本文で行う）"""
+    budget = budget_for()
+    with metrics.stage("history"):
+        c = compact_to_budget(history_text, budget, settings.history_older_line_chars)
+    log.info(
+        "history_compacted",
+        extra={
+            "request_id": rid,
+            "chars_in": c.original_chars,
+            "chars_out": c.compact_chars,
+            "tokens_in": c.original_tokens,
+            "tokens_out": c.compact_tokens,
+            "tokens_budget": budget.history,
+            "turns": c.turns,
+            "recent_turns": c.recent_turns,
+            "older_turns": c.older_turns,
+            "dropped_lines": c.dropped_lines,
+        },
+    )
+    return c.text
+
+
+async def _generate(req: GenerateRequest, rid: str, db: AsyncSession, auth: AuthContext) -> GenerateResponse:
+    res, limit = await _check_limits(auth, db)
+
+    with metrics.stage("safety"):
+        why = await safety_check(req.history_text)
     if why:
+        # ブロック時は回数に数えない
+        await quota.refund(auth.user_id, auth.plan, res)
         texts = _blocked_candidates(why)
-        daily = DailyInfo(date=jst_today_ymd(), limit=limit, used=used, remaining=max(0, limit - used))
-        candidates = [
-            Candidate(label="A", text=texts[0]),
-            Candidate(label="B", text=texts[1]),
-            Candidate(label="C", text=texts[2]),
-        ]
+        candidates = [Candidate(label=label, text=text) for label, text in zip(LABELS, texts)]
         return GenerateResponse(
             request_id=rid,
             plan=auth.plan,
-            daily=daily,
+            daily=_daily(limit, res.used - 1),
             candidates=candidates,
             model_hint="blocked",
             timestamp=dt.datetime.now(dt.timezone.utc).isoformat(),
             meta_pro=None,
         )
 
-    row = await db.execute(select(UserSettings).where(UserSettings.user_id == auth.user_id))
-    st = row.scalar_one_or_none()
-    s = st.settings_json if (st and isinstance(st.settings_json, dict)) else {}
-
-    ctx = GenerateContext(
-        true_self_type=s.get("true_self_type"),
-        night_self_type=s.get("night_self_type"),
-        relationship_type=s.get("relationship_type"),
-        reply_length_pref=s.get("reply_length_pref"),
-        combo_id=req.combo_id,
-        ng_tags=_to_list(s.get("ng_tags")),
-        ng_free_phrases=_to_list(s.get("ng_free_phrases")),
-        tuning=req.tuning if auth.plan == "pro" else None,
-    )
+    try:
+        ctx, settings_etag = await _load_context(db, auth, req)
+        history = _compact_history(req.history_text, rid)
 
-    texts = await get_ai_client().generate_abc(req.history_text, ctx)
-    if not isinstance(texts, list) or len(texts) != 3:
-        raise err("INTERNAL_ERROR", "生成に失敗しました", status_code=500)
+        # ダブルタップ等の同一内容の同時リクエストは上流呼び出しを共有する
+        key = singleflight.flight_key(auth.user_id, history, req.combo_id, settings_etag, ctx.tuning)
+        with metrics.stage("ai"):
+            texts, shared = await singleflight.run(key, lambda: get_ai_client().generate_abc(history, ctx))
+        if not isinstance(texts, list) or len(texts) != 3:
+            raise err("INTERNAL_ERROR", "生成に失敗しました", status_code=500)
+    except BaseException:
+        await quota.refund(auth.user_id, auth.plan, res)
+        raise
 
-    usage.generate_count = int(usage.generate_count) + 1
-    usage.plan_at_time = auth.plan
-    await db.commit()
+    used = res.used
+    if shared:
+        # 同時の同一リクエストの結果を受け取っただけ（上流は1回）→ 回数はリーダー側だけに数える
+        await quota.refund(auth.user_id, auth.plan, res)
+        used -= 1
 
-    used2 = int(usage.generate_count)
-    daily = DailyInfo(date=jst_today_ymd(), limit=limit, used=used2, remaining=max(0, limit - used2))
-
-    candidates = [
-        Candidate(label="A", text=texts[0]),
-        Candidate(label="B", text=texts[1]),
-        Candidate(label="C", text=texts[2]),
-    ]
-
-    meta_pro = None
-    if auth.plan == "pro":
-        meta_pro = {
-            "like": {"value": 55, "note": "推定"},
-            "risk": {"value": 20, "note": "推定"},
-        }
+    candidates = [Candidate(label=label, text=text) for label, text in zip(LABELS, texts)]
 
     return GenerateResponse(
         request_id=rid,
         plan=auth.plan,
-        daily=daily,
+        daily=_daily(limit, used),
         candidates=candidates,
         model_hint=settings.ai_provider,
         timestamp=dt.datetime.now(dt.timezone.utc).isoformat(),
-        meta_pro=meta_pro,
+        meta_pro=_meta_pro(auth.plan),
     )
+
+
+@router.post("/generate", response_model=GenerateResponse)
+async def generate(
+    req: GenerateRequest,
+    request: Request,
+    response: Response,
+    idempotency_key: str | None = Header(default=None, alias="Idempotency-Key"),
+    db: AsyncSession = Depends(get_db),
+    auth: AuthContext = Depends(get_auth_context),
+):
+    rid = getattr(request.state, "request_id", None) or ""
+
+    _validate(req, auth)
+    fp = _fingerprint(req)
+    if idempotency_key:
+        replay = await _begin_idempotency(auth, idempotency_key, fp)
+        if replay is not None:
+            # 完了済みの再送：LLMを呼ばず・課金せず保存済みの結果を返す
+            response.headers["Idempotent-Replayed"] = "true"
+            return GenerateResponse(**replay)
+
+    try:
+        out = await _generate(req, rid, db, auth)
+    except BaseException:
+        if idempotency_key:
+            await idempotency.release(auth.user_id, idempotency_key)
+        raise
+
+    if idempotency_key:
+        with metrics.stage("store"):
+            await idempotency.complete(auth.user_id, idempotency_key, fp, out.model_dump())
+    return out
+
+
+def _frame(obj: dict) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _replay_frames(resp: dict) -> AsyncIterator[bytes]:
+    async def body() -> AsyncIterator[bytes]:
+        for c in resp.get("candidates") or []:
+            yield _frame({"event": "candidate", "label": c.get("label"), "text": c.get("text")})
+        done = {k: v for k, v in resp.items() if k != "candidates"}
+        yield _frame({"event": "done", **done})
+
+    return body()
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """送出が終わる/切断される/キャンセルされる、のどれでもボディのジェネレータを aclose() し on_close を呼ぶ。
+
+    Starlette は途中で止まったボディを閉じないので、上流ストリームの close や枠の返却が GC まで走らない。
+    一度も読まれなかったジェネレータは aclose() しても finally が走らないので、後始末は on_close でも行う。
+    """
+
+    def __init__(self, *args, on_close: Callable[[], Awaitable[None]] | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+                if self._on_close is not None:
+                    await self._on_close()
+
+
+@router.post("/generate/stream")
+async def generate_stream(
+    req: GenerateRequest,
+    request: Request,
+    idempotency_key: str | None = Header(default=None, alias="Idempotency-Key"),
+    db: AsyncSession = Depends(get_db),
+    auth: AuthContext = Depends(get_auth_context),
+):
+    """NDJSONで A/B/C を確定した順に1行ずつ返し、最後に daily を含む done 行を返す"""
+    rid = getattr(request.state, "request_id", None) or ""
+    headers = {"X-Accel-Buffering": "no"}
+
+    _validate(req, auth)
+    fp = _fingerprint(req)
+    if idempotency_key:
+        replay = await _begin_idempotency(auth, idempotency_key, fp)
+        if replay is not None:
+            headers["Idempotent-Replayed"] = "true"
+            return StreamingResponse(_replay_frames(replay), media_type="application/x-ndjson", headers=headers)
+
+    try:
+        res, limit = await _check_limits(auth, db)
+    except BaseException:
+        if idempotency_key:
+            await idempotency.release(auth.user_id, idempotency_key)
+        raise
+
+    try:
+        with metrics.stage("safety"):
+            why = await safety_check(req.history_text)
+        ctx = None if why else (await _load_context(db, auth, req))[0]
+        history = "" if why else _compact_history(req.history_text, rid)
+    except BaseException:
+        await quota.refund(auth.user_id, auth.plan, res)
+        if idempotency_key:
+            await idempotency.release(auth.user_id, idempotency_key)
+        raise
+
+    completed = False
+    charged = True
+    settled = False
+
+    async def settle() -> None:
+        """エラー/切断：確保した枠と冪等キーを返す（1回だけ。ボディが一度も読まれなかった場合もここで返す）"""
+        nonlocal settled
+        if settled or completed:
+            return
+        settled = True
+        if charged:
+            await quota.refund(auth.user_id, auth.plan, res)
+        if idempotency_key:
+            await idempotency.release(auth.user_id, idempotency_key)
+
+    async def body() -> AsyncIterator[bytes]:
+        nonlocal completed, charged
+        texts: list[str] = []
+        try:
+            if why:
+                await quota.refund(auth.user_id, auth.plan, res)
+                charged = False
+                texts = _blocked_candidates(why)
+                for label, text in zip(LABELS, texts):
+                    yield _frame({"event": "candidate", "label": label, "text": text})
+                daily, model_hint, meta_pro = _daily(limit, res.used - 1), "blocked", None
+            else:
+                by_label: dict[str, str] = {}
+                stream = get_ai_client().generate_abc_stream(history, ctx)
+                try:
+                    # ストリームはクライアントへの送出待ちも含む
+                    with metrics.stage("ai"):
+                        async for label, text in stream:
+                            by_label[label] = text
+                            yield _frame({"event": "candidate", "label": label, "text": text})
+                    if len(by_label) != len(LABELS):
+                        raise err("INTERNAL_ERROR", "生成に失敗しました", status_code=500)
+                except HTTPException as e:
+                    yield _frame({"event": "error", **e.detail})
+                    return
+                except Exception:
+                    log.exception("generate_stream_error", extra={"request_id": rid})
+                    yield _frame({"event": "error", "error": {"code": "INTERNAL_ERROR", "message": "内部エラーです", "detail": {}}})
+                    return
+                finally:
+                    await stream.aclose()
+                texts = [by_label[label] for label in LABELS]
+                daily, model_hint, meta_pro = _daily(limit, res.used), settings.ai_provider, _meta_pro(auth.plan)
+
+            out = GenerateResponse(
+                request_id=rid,
+                plan=auth.plan,
+                daily=daily,
+                candidates=[Candidate(label=label, text=text) for label, text in zip(LABELS, texts)],
+                model_hint=model_hint,
+                timestamp=dt.datetime.now(dt.timezone.utc).isoformat(),
+                meta_pro=meta_pro,
+            ).model_dump()
+            if idempotency_key:
+                with metrics.stage("store"):
+                    await idempotency.complete(auth.user_id, idempotency_key, fp, out)
+            completed = True
+            done = {k: v for k, v in out.items() if k != "candidates"}
+            yield _frame({"event": "done", **done})
+        finally:
+            await settle()
+
+    return _ClosingStreamingResponse(body(), media_type="application/x-ndjson", headers=headers, on_close=settle)
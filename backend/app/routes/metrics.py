@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import hmac
+
+from fastapi import APIRouter, Header
+from fastapi.responses import PlainTextResponse
+
+from app import metrics
+from app.config import settings
+from app.errors import err
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: str | None = Header(default=None)):
+    # token 未設定なら公開しない（既定で拒否）
+    if not settings.metrics_token:
+        raise err("NOT_FOUND", "見つかりません", status_code=404)
+    if not hmac.compare_digest(authorization or "", f"Bearer {settings.metrics_token}"):
+        raise err("AUTH_REQUIRED", "認証が必要です", status_code=401)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
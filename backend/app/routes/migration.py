@@ -7,7 +7,7 @@ from app.db import get_db
 from app.security import get_auth_context, AuthContext, create_session, invalidate_all_sessions
 from app.schemas import MigrationStartResponse, MigrationCompleteRequest, MigrationCompleteResponse
 from app.config import settings
-from app.ratelimit import fixed_window_limit
+from app.limiter import Rule, enforce
 from app.redis_client import redis_client
 from app.utils import new_ticket_id, new_migration_code_12digits, sha256_hex
 from app.errors import err
@@ -26,8 +26,12 @@ async def migration_start(
     auth: AuthContext = Depends(get_auth_context),
 ):
     ip = _client_ip(request)
-    await fixed_window_limit(f"rl:mig_start:user:{auth.user_id}:1d", settings.rl_mig_start_user_limit, settings.rl_mig_start_user_window_seconds)
-    await fixed_window_limit(f"rl:mig_start:ip:{ip}:1d", settings.rl_mig_start_ip_limit, settings.rl_mig_start_ip_window_seconds)
+    await enforce(
+        [
+            Rule(f"rl:mig_start:user:{auth.user_id}", settings.rl_mig_start_user_limit, settings.rl_mig_start_user_window_seconds),
+            Rule(f"rl:mig_start:ip:{ip}", settings.rl_mig_start_ip_limit, settings.rl_mig_start_ip_window_seconds),
+        ]
+    )
 
     ticket_id = new_ticket_id()
     code = new_migration_code_12digits()
@@ -57,11 +61,7 @@ async def migration_complete(
 ):
     ip = _client_ip(request)
     # serverside spec v2 fixed: IP 5/min
-    await fixed_window_limit(
-        f"rl:mig_complete:ip:{ip}:1m",
-        settings.rl_mig_complete_ip_limit,
-        settings.rl_mig_complete_ip_window_seconds,
-    )
+    await enforce([Rule(f"rl:mig_complete:ip:{ip}", settings.rl_mig_complete_ip_limit, settings.rl_mig_complete_ip_window_seconds)])
 
     code_hash = sha256_hex(req.migration_code)
 
@@ -1,26 +1,41 @@
 from __future__ import annotations
 
 import datetime as dt
-from fastapi import APIRouter, Depends, Header, Response
+from fastapi import APIRouter, Body, Depends, Header, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 
 from app.db import get_db
 from app.models import UserSettings
 from app.schemas import SettingsResponse, SettingsUpdateRequest
 from app.security import get_auth_context, AuthContext
-from app.utils import etag_for_json
+from app.services import profile_cache, settings_cache
+from app.utils import etag_for_json, merge_patch
 from app.errors import err
 
 router = APIRouter()
 
+# 端末ごとに必ず再検証させる（共有キャッシュには載せない）
+_CACHE_CONTROL = "private, no-cache"
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": _CACHE_CONTROL})
+
 
 @router.get("/me/settings", response_model=SettingsResponse)
 async def get_settings(
     response: Response,
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
     db: AsyncSession = Depends(get_db),
     auth: AuthContext = Depends(get_auth_context),
 ):
+    # アプリ復帰ごとのポーリングは大半がここで終わる（DB に触れない）
+    if if_none_match:
+        cached = await settings_cache.get_etag(auth.user_id)
+        if cached and settings_cache.if_none_match(if_none_match, cached):
+            return _not_modified(cached)
+
     row = await db.execute(select(UserSettings).where(UserSettings.user_id == auth.user_id))
     st = row.scalar_one_or_none()
     if not st:
@@ -37,7 +52,12 @@ async def get_settings(
         db.add(st)
         await db.commit()
 
+    await settings_cache.store(auth.user_id, st.etag, st.updated_at)
+    if settings_cache.if_none_match(if_none_match, st.etag):
+        return _not_modified(st.etag)
+
     response.headers["ETag"] = st.etag
+    response.headers["Cache-Control"] = _CACHE_CONTROL
     return SettingsResponse(settings=st.settings_json)
 
 
@@ -52,6 +72,35 @@ async def put_settings(
     if not if_match:
         raise err("VALIDATION_FAILED", "If-Matchが必要です", status_code=422)
 
+    st = await _load_for_update(db, auth, if_match)
+    s = dict(req.settings or {})
+    return await _write(db, auth, response, st, if_match, s)
+
+
+@router.patch("/me/settings", response_model=SettingsResponse)
+async def patch_settings(
+    response: Response,
+    patch: dict = Body(..., media_type="application/merge-patch+json"),
+    if_match: str | None = Header(default=None, alias="If-Match"),
+    db: AsyncSession = Depends(get_db),
+    auth: AuthContext = Depends(get_auth_context),
+):
+    """RFC 7396 JSON Merge Patch。差分だけ送り、内容が変わったときだけ書き込む"""
+    if not if_match:
+        raise err("VALIDATION_FAILED", "If-Matchが必要です", status_code=422)
+
+    st = await _load_for_update(db, auth, if_match)
+    current = st.settings_json if isinstance(st.settings_json, dict) else {}
+    s = merge_patch(current, patch)
+    if s == current:
+        # 変化なし：書き込まず現在の ETag を返す
+        response.headers["ETag"] = st.etag
+        response.headers["Cache-Control"] = _CACHE_CONTROL
+        return SettingsResponse(settings=current)
+    return await _write(db, auth, response, st, if_match, s)
+
+
+async def _load_for_update(db: AsyncSession, auth: AuthContext, if_match: str) -> UserSettings:
     row = await db.execute(select(UserSettings).where(UserSettings.user_id == auth.user_id))
     st = row.scalar_one_or_none()
     if not st:
@@ -59,20 +108,39 @@ async def put_settings(
 
     if st.etag != if_match:
         raise err("SETTINGS_VERSION_CONFLICT", "設定が競合しました", status_code=409)
+    return st
 
+
+async def _write(
+    db: AsyncSession, auth: AuthContext, response: Response, st: UserSettings, if_match: str, s: dict
+) -> SettingsResponse:
     # settings_schema_version必須（未知フィールド許容）
-    s = dict(req.settings or {})
     if "settings_schema_version" not in s:
         # サーバがSSOTなので補完（ただしクライアントのバージョン管理を壊さない最小）
         s["settings_schema_version"] = st.settings_schema_version or 1
 
     new_etag = etag_for_json(s)
-    st.settings_json = s
-    st.settings_schema_version = int(s.get("settings_schema_version") or 1)
-    st.etag = new_etag
-    st.updated_at = dt.datetime.now(dt.timezone.utc)
+    now = dt.datetime.now(dt.timezone.utc)
 
+    # If-Match の検査と書き込みを1文で（同時 PUT の後勝ち上書きを防ぐ）
+    result = await db.execute(
+        update(UserSettings)
+        .where(UserSettings.user_id == auth.user_id, UserSettings.etag == if_match)
+        .values(
+            settings_json=s,
+            settings_schema_version=int(s.get("settings_schema_version") or 1),
+            etag=new_etag,
+            updated_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        raise err("SETTINGS_VERSION_CONFLICT", "設定が競合しました", status_code=409)
     await db.commit()
+    await settings_cache.store(auth.user_id, new_etag, now)
+    profile_cache.invalidate(auth.user_id)
 
     response.headers["ETag"] = new_etag
-    return SettingsResponse(settings=st.settings_json)
+    response.headers["Cache-Control"] = _CACHE_CONTROL
+    return SettingsResponse(settings=s)
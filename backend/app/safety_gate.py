@@ -1,17 +1,226 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
+import os
 import re
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from pathlib import Path
+
+from app.config import settings
+from app.text_match import PhraseMatcher, fold_text
 
 # 「中ゲート」前提。サーバは軽量に「明確NG」を止める（MUST）
-PATTERNS = [
-    (re.compile(r"(住所|電話番号|マイナンバー|クレカ|クレジットカード|口座番号)"), "個人情報の不正取得/晒し"),
-    (re.compile(r"(殺す|脅す|脅迫|爆破|放火)"), "脅迫/危害"),
-    (re.compile(r"(未成年|中学生|小学生).*(性|エロ|H|セックス)"), "未成年性的内容"),
-]
+# 語彙は JSON ファイル（SAFETY_LEXICON_PATH）で管理し、更新は再起動なしで反映する。
+# 全カテゴリの語を1つのオートマトンにまとめ、本文は1回だけ正規化（NFKC/全角半角/大文字小文字）して1パスで走査する。
+# カタカナとひらがなは寄せない（"エロ" が "教えろ" に当たる等、短い語の誤検知が増えるため）。
+#
+# 語彙ファイル:
+#   {"categories": [{"reason": "...", "terms": [...]},                       # どれかを含む
+#                   {"reason": "...", "all_of": [[...], [...]]}]}             # 同じ行にこの順で全グループを含む
+# 語は文字列か {"term": "H", "fold": false}。fold=false の語は大文字小文字を区別し（全角半角のみ寄せる）、
+# 英数字で始まる/終わる側に英数字が続く位置には当てない（"happy" の h 等を拾わない）。
+DEFAULT_LEXICON_PATH = Path(__file__).with_name("safety_lexicon.json")
+
+log = logging.getLogger(__name__)
+
+
+def _ahocorasick_available() -> bool:
+    try:
+        import ahocorasick  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+
+class _CAutomaton:
+    """pyahocorasick（任意依存）が入っていればそちらで走査する"""
+
+    def __init__(self, keys: list[str]) -> None:
+        import ahocorasick
+
+        self._a = ahocorasick.Automaton()
+        for pid, key in enumerate(keys):
+            self._a.add_word(key, (pid, len(key)))
+        self._a.make_automaton()
+
+    def scan(self, folded: str):
+        for end, (pid, n) in self._a.iter(folded):
+            yield pid, end + 1 - n, end + 1
+
+
+@dataclass(frozen=True)
+class _Category:
+    reason: str
+    groups: int  # terms のみなら 1
+
+
+class Lexicon:
+    def __init__(self, data: dict, mtime: float = 0.0) -> None:
+        self.mtime = mtime
+        self.categories: list[_Category] = []
+        keys: dict[str, int] = {}
+        # 正規化後の語 -> その語が属する (カテゴリ番号, グループ番号)
+        self._owners: list[list[tuple[int, int]]] = []
+        # fold=false の語（大文字小文字を区別）-> 同上
+        exact: dict[str, list[tuple[int, int]]] = {}
+        for c in data.get("categories", []):
+            groups = c.get("all_of") or [c.get("terms") or []]
+            ci = len(self.categories)
+            self.categories.append(_Category(reason=str(c["reason"]), groups=len(groups)))
+            for gi, terms in enumerate(groups):
+                for term in terms:
+                    if isinstance(term, dict):
+                        raw, folded = str(term.get("term") or ""), term.get("fold", True) is not False
+                    else:
+                        raw, folded = str(term), True
+                    if not folded:
+                        key = fold_text(raw, lower=False)
+                        if key:
+                            exact.setdefault(key, []).append((ci, gi))
+                        continue
+                    key = fold_text(raw)
+                    if not key:
+                        continue
+                    pid = keys.setdefault(key, len(keys))
+                    if pid == len(self._owners):
+                        self._owners.append([])
+                    self._owners[pid].append((ci, gi))
+        key_list = list(keys)
+        self.size = len(key_list) + len(exact)
+        self._automaton = _CAutomaton(key_list) if _ahocorasick_available() else PhraseMatcher(key_list)
+        self._exact_owners = list(exact.values())
+        self._exact = _compile_exact(list(exact)) if exact else None
+
+    @classmethod
+    def load(cls, path: Path) -> "Lexicon":
+        mtime = path.stat().st_mtime
+        with path.open(encoding="utf-8") as f:
+            return cls(json.load(f), mtime)
+
+    def check_all(self, text: str) -> list[str]:
+        """該当する全カテゴリの理由を語彙ファイルの順で返す"""
+        if self._exact is None:
+            folded = fold_text(text)
+        else:
+            # 大文字小文字を残した正規化。lower() で長さが変わるのは İ 等ごく一部なので、位置はそのまま使う
+            cased = fold_text(text, lower=False)
+            folded = cased.lower()
+        hits: dict[tuple[int, int], list[tuple[int, int]]] = {}
+        for pid, s, e in self._automaton.scan(folded):
+            for owner in self._owners[pid]:
+                hits.setdefault(owner, []).append((s, e))
+        if self._exact is not None:
+            for m in self._exact.finditer(cased):
+                for owner in self._exact_owners[int(m.lastgroup[1:])]:
+                    hits.setdefault(owner, []).append((m.start(), m.end()))
+        if not hits:
+            return []
+
+        newlines: list[int] | None = None
+        reasons: list[str] = []
+        for ci, cat in enumerate(self.categories):
+            if cat.groups == 1:
+                if (ci, 0) in hits:
+                    reasons.append(cat.reason)
+                continue
+            if any((ci, gi) not in hits for gi in range(cat.groups)):
+                continue
+            if newlines is None:
+                newlines = [i for i, ch in enumerate(folded) if ch == "\n"]
+            if _ordered_on_one_line([hits[(ci, gi)] for gi in range(cat.groups)], newlines):
+                reasons.append(cat.reason)
+        return reasons
+
+
+def _compile_exact(keys: list[str]) -> re.Pattern[str]:
+    """fold=false の語を1つの正規表現にする（グループ名 t<番号> で語を引く）"""
+    parts = []
+    for i, key in enumerate(keys):
+        head = r"(?<![0-9A-Za-z])" if _is_alnum(key[0]) else ""
+        tail = r"(?![0-9A-Za-z])" if _is_alnum(key[-1]) else ""
+        parts.append(f"(?P<t{i}>{head}{re.escape(key)}{tail})")
+    return re.compile("|".join(parts))
+
+
+def _is_alnum(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+def _ordered_on_one_line(groups: list[list[tuple[int, int]]], newlines: list[int]) -> bool:
+    """各グループの語が同じ行にこの順で現れるか（旧実装の "(A).*(B)" と同じ判定）"""
+    by_line: dict[int, list[list[tuple[int, int]]]] = {}
+    for gi, spans in enumerate(groups):
+        for s, e in spans:
+            line = bisect_left(newlines, s)
+            by_line.setdefault(line, [[] for _ in groups])[gi].append((s, e))
+    for per_group in by_line.values():
+        pos = 0
+        for spans in per_group:
+            ends = [e for s, e in spans if s >= pos]
+            if not ends:
+                break
+            pos = min(ends)
+        else:
+            return True
+    return False
+
+
+_lock = threading.Lock()
+_lexicon: Lexicon | None = None
+_checked_at = 0.0
+_failed_mtime: float | None = None
+
+
+def _path() -> Path:
+    return Path(settings.safety_lexicon_path) if settings.safety_lexicon_path else DEFAULT_LEXICON_PATH
+
+
+def _stale() -> bool:
+    return _lexicon is None or time.monotonic() - _checked_at >= settings.safety_lexicon_reload_seconds
+
+
+def _current() -> Lexicon:
+    """語彙を返す。一定間隔でファイルの更新時刻を見て、変わっていれば読み直す"""
+    global _lexicon, _checked_at, _failed_mtime
+    if not _stale():
+        return _lexicon
+    with _lock:
+        if not _stale():
+            return _lexicon
+        path = _path()
+        mtime = None
+        try:
+            mtime = os.stat(path).st_mtime
+            if _lexicon is None or (mtime != _lexicon.mtime and mtime != _failed_mtime):
+                lexicon = Lexicon.load(path)
+                log.info("safety_lexicon_loaded", extra={"path": str(path), "terms": lexicon.size})
+                _lexicon = lexicon
+        except Exception:
+            if _lexicon is None:
+                raise
+            # 壊れたファイルを置かれても直前の語彙で動き続ける（同じファイルは再試行しない）
+            _failed_mtime = mtime
+            log.warning("safety_lexicon_reload_failed", extra={"path": str(path)}, exc_info=True)
+        _checked_at = time.monotonic()
+        return _lexicon
+
+
+def check_all(text: str) -> list[str]:
+    return _current().check_all(text)
 
 
 def check(text: str) -> str | None:
-    for rx, why in PATTERNS:
-        if rx.search(text):
-            return why
-    return None
+    reasons = check_all(text)
+    return reasons[0] if reasons else None
+
+
+async def check_async(text: str) -> str | None:
+    """長文（SAFETY_OFFLOAD_MIN_CHARS 以上）や語彙の読み直しはスレッドで行いイベントループを塞がない"""
+    if len(text) >= settings.safety_offload_min_chars or _stale():
+        return await asyncio.to_thread(check, text)
+    return check(text)
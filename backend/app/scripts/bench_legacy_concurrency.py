@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import types
+
+import httpx
+
+# 旧実装は import 時に logs/talk_assist.log（追跡対象）を開くので、ベンチのログは一時ディレクトリへ
+os.environ.setdefault("TALK_ASSIST_LOG_DIR", tempfile.mkdtemp(prefix="bench-talk-assist-"))
+
+import main as legacy  # noqa: E402
+
+# 旧 /api/talk/assist の同時実行ベンチマーク（backend/ で python -m app.scripts.bench_legacy_concurrency）
+# 上流は固定の待ちで模擬する（実際の API は呼ばない）。N 件を同時に投げ、
+# 壁時計時間が「1件分の待ち」程度に収まる（= リクエスト同士が重なっている）かを見る。
+#   --blocking: 旧実装と同じく同期クライアントでイベントループを止める上流を模擬して比べる
+
+
+def _fake_client(latency: float, blocking: bool):
+    async def create(**kw):
+        if blocking:
+            time.sleep(latency)
+        else:
+            await asyncio.sleep(latency)
+        text = "要約: 模擬の要約です。\n返信案:\n- 案1\n- 案2\n- 案3"
+        return types.SimpleNamespace(output=[types.SimpleNamespace(content=[types.SimpleNamespace(text=text)])])
+
+    async def close() -> None:
+        return None
+
+    return types.SimpleNamespace(responses=types.SimpleNamespace(create=create), close=close)
+
+
+async def _run(n: int, latency: float, blocking: bool) -> float:
+    legacy._client = _fake_client(latency, blocking)
+    async with legacy.lifespan(legacy.app):
+        transport = httpx.ASGITransport(app=legacy.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+            body = {"text": "12:00\t花子\t今日はありがとう！また行くね", "tone": "night"}
+            t0 = time.perf_counter()
+            res = await asyncio.gather(*(c.post("/api/talk/assist", json=body) for _ in range(n)))
+            wall = time.perf_counter() - t0
+    assert all(r.status_code == 200 and r.json()["replies"] for r in res)
+    return wall
+
+
+async def main(n: int, latency: float, blocking: bool) -> None:
+    modes = [("async", False)] + ([("blocking", True)] if blocking else [])
+    print(f"requests={n} upstream latency={latency * 1e3:.0f} ms")
+    for label, b in modes:
+        wall = await _run(n, latency, b)
+        print(f"  {label:>8}: wall={wall * 1e3:8.0f} ms  overlap={n * latency / wall:5.1f}x  (serial would be {n * latency * 1e3:.0f} ms)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="旧 /api/talk/assist の同時実行ベンチマーク")
+    ap.add_argument("-n", type=int, default=50)
+    ap.add_argument("--latency-ms", type=float, default=500)
+    ap.add_argument("--blocking", action="store_true", help="同期クライアント相当の上流とも比べる")
+    a = ap.parse_args()
+    asyncio.run(main(a.n, a.latency_ms / 1e3, a.blocking))
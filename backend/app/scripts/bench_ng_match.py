@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import time
+import unicodedata
+
+from app.text_match import PhraseMatcher
+
+# NG表現チェックのマイクロベンチマーク（python -m app.scripts.bench_ng_match）
+# 3候補 × 1回のチェックにかかる時間を、フレーズ数ごとに比較する。
+
+_KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+_SAMPLE = "今日はありがとう！また近いうちにご飯いこうね。来週の水曜とかどうかな？無理なら全然大丈夫だよ。"
+
+
+def _naive(texts: list[str], phrases: list[str]) -> bool:
+    # 旧実装（_contains_any）：フレーズごとに部分文字列検索。正規化なし
+    for t in texts:
+        for p in phrases:
+            if p and p in t:
+                return True
+    return False
+
+
+def _naive_nfkc(texts: list[str], phrases: list[str]) -> bool:
+    # 旧実装に全角/半角の同一視を足した場合（フレーズは事前正規化）
+    for t in texts:
+        ft = unicodedata.normalize("NFKC", t).lower()
+        for p in phrases:
+            if p and p in ft:
+                return True
+    return False
+
+
+def _phrases(n: int, rng: random.Random) -> list[str]:
+    return ["".join(rng.choice(_KANA) for _ in range(rng.randint(3, 8))) + "ぽ" for _ in range(n)]
+
+
+def _timeit(fn, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e6
+
+
+def main(sizes: list[int], repeat: int, text_len: int) -> None:
+    rng = random.Random(0)
+    base = (_SAMPLE * (text_len // len(_SAMPLE) + 1))[:text_len]
+    texts = [base, base[::-1], base[1:] + base[:1]]
+    print(f"candidates=3 x {text_len} chars, repeat={repeat}, no match (worst case)")
+    print(f"{'phrases':>8} {'naive':>10} {'naive+nfkc':>11} {'regex':>10} {'ac':>10} {'ac build':>10}  (us)")
+    for n in sizes:
+        phrases = _phrases(n, rng)
+        folded = [unicodedata.normalize("NFKC", p).lower() for p in phrases]
+        rx = re.compile("|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True)))
+        t0 = time.perf_counter()
+        matcher = PhraseMatcher(phrases)
+        build = (time.perf_counter() - t0) * 1e6
+        assert not any(matcher.search(t) for t in texts) and not _naive(texts, phrases)
+
+        r_naive = _timeit(lambda: _naive(texts, phrases), repeat)
+        r_nfkc = _timeit(lambda: _naive_nfkc(texts, folded), repeat)
+        r_rx = _timeit(lambda: any(rx.search(t) for t in texts), repeat)
+        r_ac = _timeit(lambda: any(matcher.search(t) for t in texts), repeat)
+        print(f"{n:>8} {r_naive:>10.1f} {r_nfkc:>11.1f} {r_rx:>10.1f} {r_ac:>10.1f} {build:>10.0f}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="NG表現マッチャのベンチマーク")
+    ap.add_argument("--sizes", default="10,100,500,2000", help="フレーズ数（カンマ区切り）")
+    ap.add_argument("--repeat", type=int, default=300)
+    ap.add_argument("--text-len", type=int, default=200, help="候補1件の文字数")
+    a = ap.parse_args()
+    main([int(x) for x in a.sizes.split(",")], a.repeat, a.text_len)
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import time
+
+from app import safety_gate
+from app.text_match import PhraseMatcher, fold_text
+
+# safety gate のベンチマーク（python -m app.scripts.bench_safety）
+# 合成した語彙（terms 語）で、GENERATE_MAX_CHARS 相当の本文を1回チェックする時間を測る。
+
+_KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+_KANJI = "殺爆住所電話番号脅迫放火薬物詐欺売春援交晒拡散特定"
+_SAMPLE = (
+    "今日はありがとう！また近いうちにご飯いこうね。来週の水曜とかどうかな？"
+    "無理なら全然大丈夫だよ。ｶﾞﾝﾊﾞってね、ワタシも頑張るから。\n"
+)
+
+
+def _lexicon(n: int, rng: random.Random) -> dict:
+    terms = ["".join(rng.choice(_KANA + _KANJI) for _ in range(rng.randint(3, 7))) for _ in range(n)]
+    per = max(1, n // 4)
+    cats = [{"reason": f"cat{i}", "terms": terms[i * per:(i + 1) * per]} for i in range(4)]
+    cats.append({"reason": "combo", "all_of": [["未成年", "中学生"], ["エロ", "セックス"]]})
+    return {"categories": cats}
+
+
+def _timeit(fn, repeat: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e3
+
+
+def main(terms: int, chars: int, repeat: int) -> None:
+    rng = random.Random(0)
+    data = _lexicon(terms, rng)
+    text = (_SAMPLE * (chars // len(_SAMPLE) + 1))[:chars]
+
+    old = [re.compile("(" + "|".join(re.escape(t) for t in c["terms"]) + ")") for c in data["categories"] if "terms" in c]
+
+    def _old_check() -> None:
+        for rx in old:
+            if rx.search(text):
+                return
+
+    t0 = time.perf_counter()
+    lex = safety_gate.Lexicon(data)
+    build = (time.perf_counter() - t0) * 1e3
+    folded = fold_text(text)
+
+    print(f"lexicon={lex.size} terms, text={chars} chars, repeat={repeat}")
+    print(f"  automaton: {type(lex._automaton).__name__} (build {build:.1f} ms)")
+    print(f"  old (regex per category, no normalization): {_timeit(_old_check, repeat):8.3f} ms")
+    print(f"  normalize only:                             {_timeit(lambda: fold_text(text), repeat):8.3f} ms")
+    print(f"  scan only:                                  {_timeit(lambda: list(lex._automaton.scan(folded)), repeat):8.3f} ms")
+    print(f"  check_all (normalize + scan + rules):       {_timeit(lambda: lex.check_all(text), repeat):8.3f} ms")
+    if not isinstance(lex._automaton, PhraseMatcher):
+        py = PhraseMatcher(list({fold_text(t) for c in data["categories"] for t in c.get("terms", [])}))
+        print(f"  scan only (pure Python fallback):           {_timeit(lambda: list(py.scan(folded)), repeat):8.3f} ms")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="safety gate のベンチマーク")
+    ap.add_argument("--terms", type=int, default=3000)
+    ap.add_argument("--chars", type=int, default=20000)
+    ap.add_argument("--repeat", type=int, default=30)
+    a = ap.parse_args()
+    main(a.terms, a.chars, a.repeat)
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+from app.services import summary_cache
+from app.token_budget import estimate_tokens
+
+# 長い履歴の要約の壁時計時間を比べる（python -m app.scripts.bench_summarize）
+# 上流は「固定の待ち + 入力トークン比例の待ち」で模擬する（実際の API は呼ばない）。
+# キャッシュ（REDIS_DISABLED=true ならプロセス内）を毎回使わないよう、実行ごとに本文を変える。
+
+_LINE = "今日はありがとう！また近いうちにご飯いこうね。来週の水曜とかどうかな？無理なら全然大丈夫だよ。"
+
+
+def _history(chars: int, salt: int) -> str:
+    lines: list[str] = []
+    n = 0
+    i = 0
+    while n < chars:
+        line = f"{12 + i % 10}:{i % 60:02d}\t{'花子' if i % 2 else '太郎'}\t{_LINE}（{salt}-{i}）"
+        lines.append(line)
+        n += len(line) + 1
+        i += 1
+    return "\n".join(lines)
+
+
+def _fake_upstream(base_ms: float, per_1k_ms: float):
+    calls = 0
+
+    async def summarize(previous: str | None, text: str) -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep((base_ms + per_1k_ms * estimate_tokens(text) / 1000) / 1e3)
+        return "要約" * 50
+
+    async def reduce(previous: str | None, partials: list[str]) -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep((base_ms + per_1k_ms * estimate_tokens("".join(partials)) / 1000) / 1e3)
+        return "要約" * 50
+
+    return summarize, reduce, lambda: calls
+
+
+async def main(chars: int, base_ms: float, per_1k_ms: float) -> None:
+    for label, use_reduce, salt in (("single call", False, 1), ("map-reduce", True, 2)):
+        summarize, reduce, calls = _fake_upstream(base_ms, per_1k_ms)
+        text = _history(chars, salt)
+        t0 = time.perf_counter()
+        r = await summary_cache.rolling_summary(text, summarize, reduce if use_reduce else None)
+        wall = (time.perf_counter() - t0) * 1e3
+        s = r.stats
+        print(
+            f"{label:>12}: wall={wall:7.0f} ms calls={calls()} segments={s.segments} fan_out={s.fan_out} "
+            f"map={s.map_ms:.0f} ms reduce={s.reduce_ms:.0f} ms"
+        )
+
+        # 同じ履歴に数行足して再実行（先頭はキャッシュの要約を使う）
+        more = text + "\n" + "\n".join(f"23:{i:02d}\t花子\tおやすみ（{salt}-x{i}）" for i in range(20))
+        t0 = time.perf_counter()
+        r = await summary_cache.rolling_summary(more, summarize, reduce if use_reduce else None)
+        print(f"{'+ new lines':>12}: wall={(time.perf_counter() - t0) * 1e3:7.0f} ms cached_chunks={r.cached_chunks}/{r.chunks}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="長い履歴の要約（単発 vs map-reduce）のベンチマーク")
+    ap.add_argument("--chars", type=int, default=50000)
+    ap.add_argument("--base-ms", type=float, default=400, help="上流1回あたりの固定の待ち")
+    ap.add_argument("--per-1k-ms", type=float, default=150, help="入力1000トークンあたりの待ち")
+    a = ap.parse_args()
+    asyncio.run(main(a.chars, a.base_ms, a.per_1k_ms))
@@ -1,13 +1,13 @@
 from __future__ import annotations
 
 import asyncio
-from app.db import engine, Base
+
+from app.migrations import migrate
 
 
-import app.models  # モデル登録（create_all用）
 async def main():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # create_all + バージョン管理されたマイグレーション（インデックス等）
+    await migrate()
 
 
 if __name__ == "__main__":
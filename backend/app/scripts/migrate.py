@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+import asyncio
+
+from app.migrations import MIGRATIONS, current_version, migrate
+
+
+async def main():
+    before = await current_version()
+    applied = await migrate()
+    latest = MIGRATIONS[-1][0]
+    print(f"schema version: {before} -> {max([before, *applied])} (latest {latest}), applied: {applied or 'none'}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import argparse
+import time
+
+from app import profiler
+from app.config import settings
+
+# X-Profile-Token を発行する（python -m app.scripts.profile_token --ttl 300）
+# 例: curl -H "X-Profile-Token: $(python -m app.scripts.profile_token)" ...
+
+
+def main(ttl: int) -> None:
+    if not settings.profile_secret:
+        raise SystemExit("PROFILE_SECRET is not set")
+    print(profiler.sign(int(time.time()) + ttl))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="X-Profile-Token を発行する")
+    ap.add_argument("--ttl", type=int, default=300, help="有効期間（秒）")
+    a = ap.parse_args()
+    main(a.ttl)
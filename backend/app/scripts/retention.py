@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from app.services.retention import run
+
+
+async def main(dry_run: bool):
+    r = await run(dry_run=dry_run)
+    print(
+        f"usage_rows={r.usage_rows} users={r.users} orphan_settings={r.orphan_settings} "
+        f"orphan_plans={r.orphan_plans} batches={r.batches} dry_run={r.dry_run}"
+    )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="保持期間を過ぎた usage_daily / 放置匿名ユーザーを小分けに削除する")
+    ap.add_argument("--dry-run", action="store_true", help="件数だけ数えて削除しない")
+    asyncio.run(main(ap.parse_args().dry_run))
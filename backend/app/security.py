@@ -3,15 +3,16 @@ from __future__ import annotations
 import secrets
 from dataclasses import dataclass
 
-from fastapi import Header, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Header
 from sqlalchemy import select
 
+from app import metrics
 from app.redis_client import redis_client
 from app.config import settings
-from app.db import get_db
+from app.db import SessionLocal
 from app.models import User, PlanStatus
 from app.errors import err
+from app.services import auth_cache
 
 
 @dataclass(frozen=True)
@@ -50,29 +51,44 @@ async def invalidate_all_sessions(user_id: str) -> int:
         pipe.delete(f"sess:{t}")
     pipe.delete(key)
     res = await pipe.execute()
+    await auth_cache.invalidate_user(user_id, tokens)
     # delete returns 0/1
     return sum(int(x) for x in res if isinstance(x, int))
 
 
 async def get_auth_context(
-    db: AsyncSession = Depends(get_db),
     authorization: str | None = Header(default=None),
 ) -> AuthContext:
     token = _bearer_token(authorization)
     if not token:
         raise err("AUTH_REQUIRED", "認証が必要です", status_code=401)
+    with metrics.stage("auth"):
+        return await _resolve(token)
 
-    user_id = await redis_client.get(f"sess:{token}")
+
+async def _resolve(token: str) -> AuthContext:
+    # ホットパス：プロセス内キャッシュ → Redis 1回。SQLはキャッシュミス時のみ
+    cached = await auth_cache.lookup(token)
+    if cached:
+        return AuthContext(user_id=cached[0], plan=cached[1])
+
+    pipe = redis_client.pipeline()
+    pipe.get(f"sess:{token}")
+    pipe.ttl(f"sess:{token}")
+    user_id, sess_ttl = await pipe.execute()
     if not user_id:
         raise err("AUTH_INVALID", "認証が無効です", status_code=401)
 
-    row = await db.execute(select(User).where(User.user_id == user_id))
-    user = row.scalar_one_or_none()
-    if not user:
+    async with SessionLocal() as db:
+        row = await db.execute(
+            select(User.user_id, PlanStatus.plan)
+            .outerjoin(PlanStatus, PlanStatus.user_id == User.user_id)
+            .where(User.user_id == user_id)
+        )
+        found = row.first()
+    if not found:
         raise err("AUTH_INVALID", "認証が無効です", status_code=401)
 
-    pr = await db.execute(select(PlanStatus).where(PlanStatus.user_id == user_id))
-    ps = pr.scalar_one_or_none()
-    plan = ps.plan if ps else "free"
-
+    plan = found.plan or "free"
+    await auth_cache.store(token, user_id, plan, sess_ttl)
     return AuthContext(user_id=user_id, plan=plan)
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from app.redis_client import redis_client
+from app.config import settings
+
+# token -> (user_id, plan) の2段キャッシュ（プロセス内 TTL/LRU + Redis）
+# プラン変更/セッション失効は Redis pub/sub で全ワーカーのプロセス内キャッシュへ伝える
+# Redis 側の値は sess:{token} が残っている間だけ使う（読むときも書いた直後も sess を確かめる）。
+# 失効処理（sess 削除 → authctx 削除）と並行してセッションを解決していたリクエストが、
+# 失効後に古い値を書き戻しても、書いた直後の確認で消える。
+CHANNEL = "authctx:invalidate"
+
+log = logging.getLogger(__name__)
+
+_local: OrderedDict[str, tuple[str, str, float]] = OrderedDict()
+_by_user: dict[str, set[str]] = {}
+_listener: asyncio.Task | None = None
+# プロセス内キャッシュを捨てるたびに進める。Redis 往復の間に失効が届いたら、その結果はプロセス内に置かない
+_epoch = 0
+
+
+def _key(token: str) -> str:
+    return f"authctx:{token}"
+
+
+def _sess_key(token: str) -> str:
+    # security.create_session と同じキー
+    return f"sess:{token}"
+
+
+def _put_local(token: str, user_id: str, plan: str) -> None:
+    _local[token] = (user_id, plan, time.monotonic() + settings.auth_cache_local_ttl_seconds)
+    _local.move_to_end(token)
+    _by_user.setdefault(user_id, set()).add(token)
+    while len(_local) > settings.auth_cache_local_max_entries:
+        old_token, (old_user, _, _) = _local.popitem(last=False)
+        _discard_index(old_user, old_token)
+
+
+def _discard_index(user_id: str, token: str) -> None:
+    tokens = _by_user.get(user_id)
+    if tokens is not None:
+        tokens.discard(token)
+        if not tokens:
+            _by_user.pop(user_id, None)
+
+
+def _drop_local_user(user_id: str) -> None:
+    global _epoch
+    _epoch += 1
+    for token in _by_user.pop(user_id, set()):
+        _local.pop(token, None)
+
+
+def _clear_local() -> None:
+    global _epoch
+    _epoch += 1
+    _local.clear()
+    _by_user.clear()
+
+
+async def lookup(token: str) -> tuple[str, str] | None:
+    hit = _local.get(token)
+    if hit is not None:
+        user_id, plan, exp = hit
+        if exp > time.monotonic():
+            _local.move_to_end(token)
+            return user_id, plan
+        _local.pop(token, None)
+        _discard_index(user_id, token)
+
+    epoch = _epoch
+    pipe = redis_client.pipeline()
+    pipe.get(_key(token))
+    pipe.exists(_sess_key(token))
+    raw, alive = await pipe.execute()
+    if not raw:
+        return None
+    if not alive:
+        # セッションは失効済み（並行した書き戻しの残り等）
+        await redis_client.delete(_key(token))
+        return None
+    user_id, _, plan = raw.partition("|")
+    if not user_id or not plan:
+        return None
+    if epoch == _epoch:
+        _put_local(token, user_id, plan)
+    return user_id, plan
+
+
+async def store(token: str, user_id: str, plan: str, session_ttl: int | None = None) -> None:
+    ttl = settings.auth_cache_ttl_seconds
+    if session_ttl is not None and session_ttl > 0:
+        # セッションより長生きさせない
+        ttl = min(ttl, int(session_ttl))
+    epoch = _epoch
+    pipe = redis_client.pipeline()
+    pipe.set(_key(token), f"{user_id}|{plan}", ex=ttl)
+    pipe.exists(_sess_key(token))
+    _, alive = await pipe.execute()
+    if not alive:
+        # 読んだ後に失効した → 書いた値を取り消す（失効側の authctx 削除より後に書いた場合もここで消える）
+        await redis_client.delete(_key(token))
+        return
+    if epoch == _epoch:
+        _put_local(token, user_id, plan)
+
+
+async def invalidate_user(user_id: str, tokens: set[str] | None = None) -> None:
+    """プラン変更/全セッション失効時に呼ぶ。Redis側を消し、全ワーカーへ通知する"""
+    if tokens is None:
+        tokens = await redis_client.smembers(f"sess_u:{user_id}")
+    if tokens:
+        pipe = redis_client.pipeline()
+        for t in tokens:
+            pipe.delete(_key(t))
+        await pipe.execute()
+    _drop_local_user(user_id)
+    await redis_client.publish(CHANNEL, user_id)
+
+
+async def _listen() -> None:
+    backoff = 0.5
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CHANNEL)
+            backoff = 0.5
+            async for msg in pubsub.listen():
+                if msg.get("type") == "message" and msg.get("data"):
+                    _drop_local_user(str(msg["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 購読が切れている間に失効を取りこぼすため、プロセス内キャッシュは捨てる
+            log.warning("auth_cache_listener_error", exc_info=True)
+            _clear_local()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+async def start() -> None:
+    global _listener
+    if _listener is None:
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+    _clear_local()
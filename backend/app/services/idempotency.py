@@ -1,15 +1,106 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import secrets
+import time
+from dataclasses import dataclass
+
 from app.redis_client import redis_client
 from app.config import settings
 
+# 状態: inflight（処理中）/ done（完了・レスポンス保持）。失敗時はキー削除（release）
+# inflight は短い TTL で置き、処理中はリーダーが延長し続ける（落ちたワーカーのキーは TTL で外れる）
+STATE_INFLIGHT = "inflight"
+STATE_DONE = "done"
+
+_POLL_SECONDS = 0.2
+
+# Redis キー -> inflight を延長しているタスク（このプロセスが処理権を持つキーのみ）
+_keepers: dict[str, asyncio.Task] = {}
+
+
+@dataclass(frozen=True)
+class IdemResult:
+    acquired: bool = False  # このリクエストが処理権を得た
+    response: dict | None = None  # 完了済みレスポンス（リプレイ用）
+    mismatch: bool = False  # 同じキーで別内容のリクエスト
+    in_progress: bool = False  # 待機しても先行リクエストが終わらなかった
+
+
+def _key(user_id: str, idem_key: str) -> str:
+    return f"idem:gen:{user_id}:{idem_key}"
+
+
+def _load(raw: str | None) -> dict | None:
+    if not raw:
+        return None
+    try:
+        v = json.loads(raw)
+    except Exception:
+        return None
+    return v if isinstance(v, dict) else None
+
+
+async def _keep_alive(key: str, value: str) -> None:
+    """自分の inflight が残っている間、TTL を延長する（上限 idempotency_inflight_max_seconds）"""
+    ttl = settings.idempotency_inflight_ttl_seconds
+    until = time.monotonic() + settings.idempotency_inflight_max_seconds
+    while time.monotonic() < until:
+        # TTL の 1/3 ごとに延長する（短い TTL でも失効前に間に合うよう下限は小さく）
+        await asyncio.sleep(max(0.1, ttl / 3))
+        if await redis_client.get(key) != value:
+            return
+        await redis_client.expire(key, ttl)
+
+
+async def _stop_keeper(key: str) -> None:
+    task = _keepers.pop(key, None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+
+async def acquire(user_id: str, idem_key: str, fingerprint: str) -> IdemResult:
+    """処理権を取るか、先行リクエストの完了を待ってその結果を返す"""
+    key = _key(user_id, idem_key)
+    inflight = json.dumps({"s": STATE_INFLIGHT, "fp": fingerprint, "o": secrets.token_hex(8)}, separators=(",", ":"))
+    deadline = time.monotonic() + settings.idempotency_wait_seconds
+
+    while True:
+        ok = await redis_client.set(key, inflight, nx=True, ex=settings.idempotency_inflight_ttl_seconds)
+        if ok:
+            _keepers[key] = asyncio.create_task(_keep_alive(key, inflight))
+            return IdemResult(acquired=True)
+
+        raw = await redis_client.get(key)
+        cur = _load(raw)
+        if cur is not None:
+            if cur.get("fp") != fingerprint:
+                return IdemResult(mismatch=True)
+            if cur.get("s") == STATE_DONE and isinstance(cur.get("r"), dict):
+                return IdemResult(response=cur["r"])
+        elif raw:
+            # 読めない値（旧形式の "1" 等）は古い枠として消して取り直す
+            await redis_client.delete(key)
+        # cur も raw も無い = 直前に release/失効した → 待ってから取り直す
+        if time.monotonic() >= deadline:
+            return IdemResult(in_progress=True)
+        await asyncio.sleep(_POLL_SECONDS)
+
 
-async def acquire(user_id: str, idem_key: str) -> bool:
-    key = f"idem:gen:{user_id}:{idem_key}"
-    ok = await redis_client.set(key, "1", nx=True, ex=settings.idempotency_ttl_seconds)
-    return bool(ok)
+async def complete(user_id: str, idem_key: str, fingerprint: str, response: dict) -> None:
+    key = _key(user_id, idem_key)
+    await _stop_keeper(key)
+    value = json.dumps({"s": STATE_DONE, "fp": fingerprint, "r": response}, ensure_ascii=False, separators=(",", ":"))
+    await redis_client.set(key, value, ex=settings.idempotency_ttl_seconds)
 
 
 async def release(user_id: str, idem_key: str) -> None:
-    key = f"idem:gen:{user_id}:{idem_key}"
+    key = _key(user_id, idem_key)
+    await _stop_keeper(key)
     await redis_client.delete(key)
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.ai_client import GenerateContext, get_ai_client
+from app.config import settings
+from app.models import UserSettings
+from app.services import settings_cache
+from app.text_match import PhraseMatcher
+
+# (user_id, settings etag) 単位の生成プロファイル。設定の正規化・プロンプト断片の組み立て・
+# NG表現マッチャのコンパイルを1回だけ行い、同じ設定での再生成では DB も組み立ても行わない。
+# 現在の etag は settings_cache（Redis 側）で引くので、他ワーカーでの PUT/PATCH もここで検知できる。
+
+
+@dataclass(frozen=True)
+class CompiledProfile:
+    etag: str | None
+    ctx: GenerateContext  # combo_id/tuning はリクエストごとに差し替える
+
+
+_local: OrderedDict[str, CompiledProfile] = OrderedDict()
+
+
+def _to_list(v) -> list[str]:
+    if v is None:
+        return []
+    if isinstance(v, list):
+        return [str(x) for x in v]
+    return [str(v)]
+
+
+def compile_ng(phrases: list[str]) -> PhraseMatcher | None:
+    """NG表現を1つの Aho-Corasick オートマトンにまとめる（全角/半角を区別しない）"""
+    matcher = PhraseMatcher(phrases)
+    return matcher or None
+
+
+def compile_profile(settings_json: dict, etag: str | None) -> CompiledProfile:
+    s = settings_json if isinstance(settings_json, dict) else {}
+    ng_free_phrases = _to_list(s.get("ng_free_phrases"))
+    ctx = GenerateContext(
+        true_self_type=s.get("true_self_type"),
+        night_self_type=s.get("night_self_type"),
+        relationship_type=s.get("relationship_type"),
+        reply_length_pref=s.get("reply_length_pref"),
+        combo_id=0,
+        ng_tags=_to_list(s.get("ng_tags")),
+        ng_free_phrases=ng_free_phrases,
+        tuning=None,
+        ng_matcher=compile_ng(ng_free_phrases),
+    )
+    ctx = replace(ctx, profile_prompt=get_ai_client().render_profile_prompt(ctx))
+    return CompiledProfile(etag=etag, ctx=ctx)
+
+
+def _get_local(user_id: str, etag: str) -> CompiledProfile | None:
+    hit = _local.get(user_id)
+    if hit is None or hit.etag != etag:
+        return None
+    _local.move_to_end(user_id)
+    return hit
+
+
+def _put_local(user_id: str, profile: CompiledProfile) -> None:
+    _local[user_id] = profile
+    _local.move_to_end(user_id)
+    while len(_local) > settings.profile_cache_max_entries:
+        _local.popitem(last=False)
+
+
+def invalidate(user_id: str) -> None:
+    _local.pop(user_id, None)
+
+
+async def load(db: AsyncSession, user_id: str) -> CompiledProfile:
+    """現在の設定に対応するプロファイルを返す（etag が変わっていなければ DB を読まない）"""
+    etag = await settings_cache.get_etag(user_id)
+    if etag:
+        hit = _get_local(user_id, etag)
+        if hit is not None:
+            return hit
+
+    row = await db.execute(select(UserSettings).where(UserSettings.user_id == user_id))
+    st = row.scalar_one_or_none()
+    if st is None:
+        return compile_profile({}, None)
+
+    profile = compile_profile(st.settings_json, st.etag)
+    _put_local(user_id, profile)
+    await settings_cache.store(user_id, st.etag, st.updated_at)
+    return profile
+
+
+def for_request(profile: CompiledProfile, combo_id: int, tuning: dict | None) -> GenerateContext:
+    return replace(profile.ctx, combo_id=combo_id, tuning=tuning)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.redis_client import redis_client
+from app.config import settings
+from app.db import SessionLocal
+from app.services.usage import load_generate_count, upsert_counts
+from app.utils_time import jst_today_ymd
+
+# 日次生成回数の台帳。Redis（またはローカル状態ストア）上のカウンタを正とし、
+# AI呼び出し前に枠を確保（reserve）、失敗時に返却（refund）する。
+# usage_daily へはバックグラウンドでまとめて書き戻す（write-behind）。
+#
+# 許容している誤差:
+# - カウンタがストアから消えた（再起動/退避）ときは usage_daily から種をまき直す。DB は最大で
+#   QUOTA_FLUSH_INTERVAL_SECONDS 分遅れているので、その間の確保分だけ一時的に上限を超えて通ることがある。
+#   退避されるのは直近に触られていないカウンタで、確保のたびに最近使われた扱いになるため、実際に起きるのは
+#   最後の確保から1回の書き戻しまでの間に退避された場合に限られる。
+# - 同時の同一リクエスト（single-flight のフォロワー）は確保後に refund するので、回数は上流呼び出し1回分。
+DIRTY_KEY = "quota:dirty"
+
+log = logging.getLogger(__name__)
+
+_RESERVE_LUA = """
+local v = redis.call('GET', KEYS[1])
+if not v then return {-1, 0} end
+v = tonumber(v)
+if v >= tonumber(ARGV[1]) then return {0, v} end
+v = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {1, v}
+"""
+
+_script = None
+_flusher: asyncio.Task | None = None
+
+
+@dataclass(frozen=True)
+class Reservation:
+    allowed: bool
+    used: int  # 確保後（拒否時は現在）の使用回数
+    date: str
+
+
+def _key(user_id: str, date: str) -> str:
+    return f"quota:{date}:{user_id}"
+
+
+async def _incr_below(key: str, limit: int) -> tuple[int, int]:
+    ttl = settings.quota_counter_ttl_seconds
+    if hasattr(redis_client, "incr_below"):
+        status, value = await redis_client.incr_below(key, limit, ttl)
+    else:
+        global _script
+        if _script is None:
+            _script = redis_client.register_script(_RESERVE_LUA)
+        status, value = await _script(keys=[key], args=[limit, ttl])
+    return int(status), int(value)
+
+
+async def reserve(db: AsyncSession, user_id: str, plan: str, limit: int) -> Reservation:
+    """上限未満なら1回分を原子的に確保する"""
+    date = jst_today_ymd()
+    key = _key(user_id, date)
+    status, value = await _incr_below(key, limit)
+    if status < 0:
+        # その日の初回だけ usage_daily から種をまく（SELECT のみ）
+        seed = await load_generate_count(db, user_id, date)
+        await redis_client.set(key, str(seed), nx=True, ex=settings.quota_counter_ttl_seconds)
+        status, value = await _incr_below(key, limit)
+    if status == 1:
+        await redis_client.sadd(DIRTY_KEY, f"{user_id}|{date}|{plan}")
+    return Reservation(allowed=status == 1, used=value, date=date)
+
+
+async def refund(user_id: str, plan: str, res: Reservation) -> None:
+    """確保済みの枠を返す（上流失敗・ブロック・切断時）"""
+    pipe = redis_client.pipeline()
+    pipe.decr(_key(user_id, res.date))
+    pipe.sadd(DIRTY_KEY, f"{user_id}|{res.date}|{plan}")
+    await pipe.execute()
+
+
+async def flush(batch_size: int | None = None) -> int:
+    """変更のあったカウンタを usage_daily へ一括 UPSERT する。戻り値は書き込んだ行数"""
+    batch_size = batch_size or settings.quota_flush_batch_size
+    total = 0
+    while True:
+        members = await redis_client.spop(DIRTY_KEY, batch_size)
+        if not members:
+            return total
+        latest: dict[tuple[str, str], str] = {}
+        for m in members:
+            user_id, date, plan = m.split("|", 2)
+            latest[(user_id, date)] = plan
+        pipe = redis_client.pipeline()
+        keys = list(latest)
+        for user_id, date in keys:
+            pipe.get(_key(user_id, date))
+        values = await pipe.execute()
+
+        rows = [
+            {"user_id": user_id, "date": date, "generate_count": int(v), "plan_at_time": latest[(user_id, date)]}
+            for (user_id, date), v in zip(keys, values)
+            if v is not None
+        ]
+        try:
+            async with SessionLocal() as db:
+                await upsert_counts(db, rows)
+        except Exception:
+            # 書き戻せなかった分は次回に回す
+            for user_id, date in keys:
+                await redis_client.sadd(DIRTY_KEY, f"{user_id}|{date}|{latest[(user_id, date)]}")
+            raise
+        total += len(rows)
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(settings.quota_flush_interval_seconds)
+        try:
+            await flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning("quota_flush_failed", exc_info=True)
+
+
+async def start() -> None:
+    global _flusher
+    if _flusher is None:
+        _flusher = asyncio.create_task(_flush_loop())
+
+
+async def stop() -> None:
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher = None
+    try:
+        await flush()
+    except Exception:
+        log.warning("quota_flush_failed", exc_info=True)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import delete, exists, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.db import SessionLocal
+from app.models import PlanStatus, UsageDaily, User, UserSettings
+from app.redis_client import redis_client
+from app.utils_time import JST
+
+# 保持期間を過ぎた行を小さなバッチで消す。1バッチ=1トランザクションで、
+# バッチ間に間を空けて書き込みロックを長く握らない。途中で止めても続きから再開できる。
+log = logging.getLogger(__name__)
+
+CURSOR_KEY = "retention:users_cursor"
+
+
+@dataclass
+class RetentionReport:
+    usage_rows: int = 0
+    users: int = 0
+    orphan_settings: int = 0
+    orphan_plans: int = 0
+    batches: int = 0
+    dry_run: bool = False
+
+
+async def _pause() -> None:
+    await asyncio.sleep(settings.retention_pause_ms / 1000)
+
+
+async def _get_state(db: AsyncSession, k: str) -> str | None:
+    row = await db.execute(text("SELECT v FROM maintenance_state WHERE k = :k"), {"k": k})
+    return row.scalar_one_or_none()
+
+
+async def _set_state(db: AsyncSession, k: str, v: str | None) -> None:
+    await db.execute(text("DELETE FROM maintenance_state WHERE k = :k"), {"k": k})
+    if v is not None:
+        await db.execute(text("INSERT INTO maintenance_state (k, v) VALUES (:k, :v)"), {"k": k, "v": v})
+
+
+async def purge_usage(report: RetentionReport, cutoff_date: str, batch: int) -> None:
+    """usage_daily の cutoff_date より前の行を消す"""
+    while True:
+        async with SessionLocal() as db:
+            rows = (
+                await db.execute(
+                    select(UsageDaily.user_id, UsageDaily.date).where(UsageDaily.date < cutoff_date).limit(batch)
+                )
+            ).all()
+            if not rows:
+                return
+            if not report.dry_run:
+                await db.execute(
+                    delete(UsageDaily).where(tuple_(UsageDaily.user_id, UsageDaily.date).in_([tuple(r) for r in rows]))
+                )
+                await db.commit()
+        report.usage_rows += len(rows)
+        report.batches += 1
+        if report.dry_run or len(rows) < batch:
+            return
+        await _pause()
+
+
+async def _has_live_session(user_ids: list[str]) -> set[str]:
+    pipe = redis_client.pipeline()
+    for uid in user_ids:
+        pipe.ttl(f"sess_u:{uid}")
+    res = await pipe.execute()
+    return {uid for uid, ttl in zip(user_ids, res) if int(ttl) != -2}
+
+
+async def purge_inactive_users(report: RetentionReport, cutoff: dt.datetime, cutoff_date: str, batch: int) -> None:
+    """放置された匿名（free）ユーザーとその settings/plan/usage を消す。
+
+    条件: 作成が cutoff より前 / free（plan_status 無しを含む）/ cutoff_date 以降の利用なし /
+    settings 更新が cutoff より前 / 有効なセッションなし。
+    """
+    async with SessionLocal() as db:
+        cursor = await _get_state(db, CURSOR_KEY)
+
+    while True:
+        async with SessionLocal() as db:
+            q = (
+                select(User.user_id, User.created_at)
+                .where(User.created_at < cutoff)
+                .where(~exists().where(PlanStatus.user_id == User.user_id, PlanStatus.plan != "free"))
+                .where(~exists().where(UsageDaily.user_id == User.user_id, UsageDaily.date >= cutoff_date))
+                .where(~exists().where(UserSettings.user_id == User.user_id, UserSettings.updated_at >= cutoff))
+                .order_by(User.created_at, User.user_id)
+                .limit(batch)
+            )
+            if cursor:
+                c_at, _, c_uid = cursor.partition("|")
+                c_dt = dt.datetime.fromisoformat(c_at)
+                q = q.where(tuple_(User.created_at, User.user_id) > tuple_(c_dt, c_uid))
+            rows = (await db.execute(q)).all()
+            if not rows:
+                if not report.dry_run:
+                    await _set_state(db, CURSOR_KEY, None)
+                    await db.commit()
+                return
+
+            ids = [r.user_id for r in rows]
+            live = await _has_live_session(ids)
+            victims = [uid for uid in ids if uid not in live]
+            last = rows[-1]
+            cursor = f"{last.created_at.isoformat()}|{last.user_id}"
+
+            if not report.dry_run:
+                if victims:
+                    await db.execute(delete(UsageDaily).where(UsageDaily.user_id.in_(victims)))
+                    await db.execute(delete(UserSettings).where(UserSettings.user_id.in_(victims)))
+                    await db.execute(delete(PlanStatus).where(PlanStatus.user_id.in_(victims)))
+                    await db.execute(delete(User).where(User.user_id.in_(victims)))
+                await _set_state(db, CURSOR_KEY, cursor)
+                await db.commit()
+        report.users += len(victims)
+        report.batches += 1
+        if len(rows) < batch:
+            if not report.dry_run:
+                async with SessionLocal() as db:
+                    await _set_state(db, CURSOR_KEY, None)
+                    await db.commit()
+            return
+        await _pause()
+
+
+async def purge_orphans(report: RetentionReport, batch: int) -> None:
+    """users に存在しない user_settings / plan_status の行を消す"""
+    for model, attr in ((UserSettings, "orphan_settings"), (PlanStatus, "orphan_plans")):
+        while True:
+            async with SessionLocal() as db:
+                ids = (
+                    await db.execute(
+                        select(model.user_id).where(~exists().where(User.user_id == model.user_id)).limit(batch)
+                    )
+                ).scalars().all()
+                if not ids:
+                    break
+                if not report.dry_run:
+                    await db.execute(delete(model).where(model.user_id.in_(ids)))
+                    await db.commit()
+            setattr(report, attr, getattr(report, attr) + len(ids))
+            report.batches += 1
+            if report.dry_run or len(ids) < batch:
+                break
+            await _pause()
+
+
+async def run(dry_run: bool = False, now: dt.datetime | None = None) -> RetentionReport:
+    now = now or dt.datetime.now(dt.timezone.utc)
+    batch = settings.retention_batch_size
+    report = RetentionReport(dry_run=dry_run)
+
+    usage_cutoff = (now - dt.timedelta(days=settings.retention_usage_days)).astimezone(JST).strftime("%Y-%m-%d")
+    user_cutoff = now - dt.timedelta(days=settings.retention_anonymous_inactive_days)
+    user_cutoff_date = user_cutoff.astimezone(JST).strftime("%Y-%m-%d")
+
+    await purge_usage(report, usage_cutoff, batch)
+    await purge_inactive_users(report, user_cutoff, user_cutoff_date, batch)
+    await purge_orphans(report, batch)
+    log.info(
+        "retention_done",
+        extra={
+            "usage_rows": report.usage_rows,
+            "users": report.users,
+            "orphan_settings": report.orphan_settings,
+            "orphan_plans": report.orphan_plans,
+            "batches": report.batches,
+            "dry_run": dry_run,
+        },
+    )
+    return report
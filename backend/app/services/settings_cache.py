@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import datetime as dt
+
+from app.redis_client import redis_client
+from app.config import settings
+
+# user_id -> 現在の settings ETag。条件付き GET（If-None-Match）を DB なしで返すために使う。
+# 値は "version|etag"（version = updated_at のマイクロ秒）で、より新しい version でしか上書きしない。
+# これにより PUT 同士や「GET の読み直し」と PUT が競合しても古い ETag で上書きされない。
+
+_SET_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v then
+  local cur = tonumber(string.match(v, '^(%d+)|'))
+  if cur and cur >= tonumber(ARGV[1]) then return 0 end
+end
+redis.call('SET', KEYS[1], ARGV[1] .. '|' .. ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+_script = None
+
+
+def _key(user_id: str) -> str:
+    return f"setag:{user_id}"
+
+
+def _version(updated_at: dt.datetime | None) -> int:
+    if updated_at is None:
+        return 0
+    if updated_at.tzinfo is None:
+        # SQLite は tz を落として返す（保存値は UTC）
+        updated_at = updated_at.replace(tzinfo=dt.timezone.utc)
+    return int(updated_at.timestamp() * 1_000_000)
+
+
+async def get_etag(user_id: str) -> str | None:
+    raw = await redis_client.get(_key(user_id))
+    if not raw:
+        return None
+    return raw.split("|", 1)[1] if "|" in raw else None
+
+
+async def store(user_id: str, etag: str, updated_at: dt.datetime | None) -> None:
+    """updated_at が保存中より新しいときだけ原子的に置き換える"""
+    version, ttl = _version(updated_at), settings.settings_etag_cache_ttl_seconds
+    if hasattr(redis_client, "set_if_newer"):
+        await redis_client.set_if_newer(_key(user_id), version, etag, ttl)
+        return
+    global _script
+    if _script is None:
+        _script = redis_client.register_script(_SET_LUA)
+    await _script(keys=[_key(user_id)], args=[version, etag, ttl])
+
+
+def if_none_match(header: str | None, etag: str) -> bool:
+    """If-None-Match が etag に一致するか（弱い比較・引用符あり/なし・複数値・* を許容）"""
+    if not header:
+        return False
+    for part in header.split(","):
+        tag = part.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"') == etag:
+            return True
+    return False
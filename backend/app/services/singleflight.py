@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import asyncio
+import secrets
+import time
+from typing import Awaitable, Callable
+
+from app.redis_client import redis_client
+from app.config import settings
+from app.utils import etag_for_json
+
+# 同一内容の同時生成を1回の上流呼び出しにまとめる（プロセス内で結果を共有）。
+# ワーカー間では Redis のロックで同じ生成が同時に上流へ重ならないようにするだけで、結果（本文）は共有しない。
+# Redis に置くのはハッシュのキーとトークンのみ（本文は保存しない: logging_conf.NoBodyFilter と同じ方針）
+_POLL_SECONDS = 0.1
+
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def flight_key(user_id: str, history_text: str, combo_id: int, settings_etag: str | None, tuning: dict | None = None) -> str:
+    return etag_for_json({"u": user_id, "h": history_text, "c": combo_id, "e": settings_etag or "", "t": tuning})
+
+
+async def _run_locked(key: str, fn: Callable[[], Awaitable[list[str]]]) -> list[str]:
+    """他ワーカーが同じ生成を実行中なら終わるまで待ってから自分で呼ぶ（待ちは singleflight_wait_seconds まで）"""
+    lock_key = f"sf:gen:{key}"
+    token = secrets.token_hex(8)
+    deadline = time.monotonic() + settings.singleflight_wait_seconds
+    while not await redis_client.set(lock_key, token, nx=True, ex=settings.singleflight_wait_seconds):
+        if time.monotonic() >= deadline:
+            # 先行が終わらない/落ちたワーカーのロックが残っている → ロックなしで呼ぶ
+            return await fn()
+        await asyncio.sleep(_POLL_SECONDS)
+    try:
+        return await fn()
+    finally:
+        if await redis_client.get(lock_key) == token:
+            await redis_client.delete(lock_key)
+
+
+def _drop(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        _inflight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # 全員キャンセル時の "never retrieved" 警告抑止
+
+
+async def run(key: str, fn: Callable[[], Awaitable[list[str]]]) -> tuple[list[str], bool]:
+    """(結果, 他のリクエストの上流呼び出しを共有したか) を返す。共有した側は上流コストを発生させていない"""
+    task = _inflight.get(key)
+    owner = task is None
+    if owner:
+        task = asyncio.ensure_future(_run_locked(key, fn))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _drop(key, t))
+    # 先に来た呼び出し元が切断されても共有タスクは止めない
+    texts = await asyncio.shield(task)
+    return texts, not owner
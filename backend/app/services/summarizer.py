@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from app.config import settings
+
+# 長い履歴の map-reduce 要約。
+#   map: 発言境界で区切ったトークン上限付きのまとまりを、同時実行数を絞って並列に要約する
+#   reduce: 部分要約（と、あればそれ以前の要約）を1つに繋ぐ
+# 壁時計時間はおおむね「1まとまり分の要約 + reduce 1回」になる。
+
+# (これまでの要約 or None, 新しい部分の本文) -> 要約
+Summarizer = Callable[[str | None, str], Awaitable[str]]
+# (これまでの要約 or None, 時系列順の部分要約) -> 繋いだ要約
+Reducer = Callable[[str | None, list[str]], Awaitable[str]]
+
+
+@dataclass(frozen=True)
+class MapReduceStats:
+    segments: int  # map で要約したまとまりの数
+    fan_out: int  # 実際の同時実行数
+    map_ms: float
+    reduce_ms: float  # reduce しなかった場合は 0
+
+    @property
+    def total_ms(self) -> float:
+        return self.map_ms + self.reduce_ms
+
+
+def pack(parts: list[tuple[str, int]], max_tokens: int) -> list[str]:
+    """(本文, トークン数) の並びを順序を保ったまま max_tokens 以下のまとまりに詰める"""
+    out: list[str] = []
+    buf: list[str] = []
+    used = 0
+    for text, tokens in parts:
+        if buf and used + tokens > max_tokens:
+            out.append("\n".join(buf))
+            buf, used = [], 0
+        buf.append(text)
+        used += tokens
+    if buf:
+        out.append("\n".join(buf))
+    return out
+
+
+async def map_reduce(
+    segments: list[str],
+    summarize: Summarizer,
+    reduce: Reducer | None,
+    previous: str | None = None,
+    concurrency: int | None = None,
+) -> tuple[str, MapReduceStats]:
+    """segments（時系列順）を要約して previous に繋ぐ（reduce は segments が2つ以上のときだけ使う）"""
+    if not segments:
+        return previous or "", MapReduceStats(0, 0, 0.0, 0.0)
+    if len(segments) == 1:
+        # 1まとまりなら繋ぐところまで1回で済ませる
+        t0 = time.perf_counter()
+        out = await summarize(previous, segments[0])
+        return out, MapReduceStats(1, 1, (time.perf_counter() - t0) * 1e3, 0.0)
+
+    if reduce is None:
+        raise ValueError("reduce is required for multiple segments")
+    limit = max(1, concurrency or settings.summary_map_concurrency)
+    sem = asyncio.Semaphore(limit)
+
+    async def _one(text: str) -> str:
+        async with sem:
+            return await summarize(None, text)
+
+    t0 = time.perf_counter()
+    tasks = [asyncio.ensure_future(_one(s)) for s in segments]
+    try:
+        partials = await asyncio.gather(*tasks)
+    except BaseException:
+        # 1つでも失敗/キャンセルされたら残りは待たない
+        for t in tasks:
+            t.cancel()
+        raise
+    t1 = time.perf_counter()
+    out = await reduce(previous, list(partials))
+    t2 = time.perf_counter()
+    return out, MapReduceStats(len(segments), min(limit, len(segments)), (t1 - t0) * 1e3, (t2 - t1) * 1e3)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+from dataclasses import dataclass
+
+from app.config import settings
+from app.line_history import format_turn, parse_turns
+from app.redis_client import redis_client
+from app.services.summarizer import MapReduceStats, Reducer, Summarizer, map_reduce, pack
+from app.token_budget import estimate_tokens
+
+# 長いトーク履歴の要約を、既に見た先頭部分についてはキャッシュから再利用する。
+# - 履歴を発言境界で「内容で決まるチャンク」に区切る（境界は各発言のハッシュで決めるので、
+#   末尾に新しいメッセージが増えても手前のチャンク割りは変わらない）
+# - 先頭からの連鎖ハッシュ（digest）をキーに「そこまでの要約」を短い TTL で保存する
+# - 次回は一致する最長の先頭部分の要約を取り出し、新しく確定したチャンクだけを要約して繋ぐ
+# 保存するのはハッシュと要約だけで、本文は保存しない。
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    text: str
+    tokens: int
+    digest: str  # 先頭からこのチャンクまでの連鎖ハッシュ
+    closed: bool  # 境界で閉じたか（False は末尾の確定していない部分）
+
+
+@dataclass(frozen=True)
+class RollingSummary:
+    summary: str | None  # 確定チャンクの要約（確定チャンクが無ければ None）
+    tail: str  # 要約に含めていない末尾（そのまま渡す）
+    chunks: int
+    cached_chunks: int  # キャッシュの要約で済んだ確定チャンク数
+    summarized_chunks: int  # 今回要約したチャンク数
+    stats: MapReduceStats  # 今回の要約の並列度と所要時間
+
+    @property
+    def text(self) -> str:
+        if not self.summary:
+            return self.tail
+        if not self.tail:
+            return self.summary
+        return f"【これまでの要約】\n{self.summary}\n【直近のやりとり】\n{self.tail}"
+
+
+def _h(data: str) -> str:
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def chunk_history(raw: str) -> list[Chunk]:
+    """発言境界で内容依存のチャンクに分ける"""
+    min_t, max_t = settings.summary_chunk_min_tokens, settings.summary_chunk_max_tokens
+    avg = max(1, settings.summary_chunk_avg_turns)
+    chunks: list[Chunk] = []
+    digest = _h(settings.summary_cache_namespace)
+    lines: list[str] = []
+    tokens = 0
+    for turn in parse_turns(raw):
+        line = format_turn(turn)
+        lines.append(line)
+        tokens += estimate_tokens(line) + 1
+        boundary = int(_h(line)[:8], 16) % avg == 0
+        if (boundary and tokens >= min_t) or tokens >= max_t:
+            text = "\n".join(lines)
+            digest = _h(digest + text)
+            chunks.append(Chunk(text, tokens, digest, True))
+            lines, tokens = [], 0
+    if lines:
+        text = "\n".join(lines)
+        chunks.append(Chunk(text, tokens, _h(digest + text), False))
+    return chunks
+
+
+def _key(digest: str) -> str:
+    return f"sumc:{digest}"
+
+
+async def _longest_cached(closed: list[Chunk]) -> tuple[int, str | None]:
+    """キャッシュにある最長の先頭部分（確定チャンク数, その要約）"""
+    if not closed:
+        return 0, None
+    try:
+        pipe = redis_client.pipeline()
+        for c in closed:
+            pipe.get(_key(c.digest))
+        found = await pipe.execute()
+    except Exception as e:
+        log.warning("summary_cache_unavailable", extra={"type": e.__class__.__name__})
+        return 0, None
+    for i in range(len(closed), 0, -1):
+        if found[i - 1]:
+            return i, found[i - 1]
+    return 0, None
+
+
+async def _store(digest: str, summary: str) -> None:
+    try:
+        await redis_client.set(_key(digest), summary, ex=settings.summary_cache_ttl_seconds)
+    except Exception as e:
+        log.warning("summary_cache_unavailable", extra={"type": e.__class__.__name__})
+
+
+async def rolling_summary(raw: str, summarize: Summarizer, reduce: Reducer | None = None) -> RollingSummary:
+    """確定チャンクを（キャッシュを使って）要約し、末尾の未確定部分はそのまま返す。
+
+    reduce を渡すと、新しく要約する部分が長い場合に map-reduce で並列に要約する。
+    """
+    chunks = chunk_history(raw)
+    closed = [c for c in chunks if c.closed]
+    tail = "" if not chunks or chunks[-1].closed else chunks[-1].text
+
+    hit, summary = await _longest_cached(closed)
+    new = closed[hit:]
+    stats = MapReduceStats(0, 0, 0.0, 0.0)
+    if new:
+        if reduce is None:
+            segments = ["\n".join(c.text for c in new)]
+        else:
+            segments = pack([(c.text, c.tokens) for c in new], settings.summary_map_tokens)
+        summary, stats = await map_reduce(segments, summarize, reduce, previous=summary)
+        await _store(new[-1].digest, summary)
+
+    out = RollingSummary(
+        summary=summary,
+        tail=tail,
+        chunks=len(chunks),
+        cached_chunks=hit,
+        summarized_chunks=len(new),
+        stats=stats,
+    )
+    log.info(
+        "rolling_summary",
+        extra={
+            "chunks": out.chunks,
+            "cached_chunks": out.cached_chunks,
+            "summarized_chunks": out.summarized_chunks,
+            "segments": stats.segments,
+            "fan_out": stats.fan_out,
+            "map_ms": round(stats.map_ms, 1),
+            "reduce_ms": round(stats.reduce_ms, 1),
+        },
+    )
+    return out
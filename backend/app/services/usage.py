@@ -4,16 +4,32 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.models import UsageDaily
-from app.utils_time import jst_today_ymd
-
-
-async def get_or_create_usage(db: AsyncSession, user_id: str, plan: str) -> UsageDaily:
-    d = jst_today_ymd()
-    row = await db.execute(select(UsageDaily).where(UsageDaily.user_id == user_id, UsageDaily.date == d))
-    u = row.scalar_one_or_none()
-    if u:
-        return u
-    u = UsageDaily(user_id=user_id, date=d, generate_count=0, plan_at_time=plan)
-    db.add(u)
-    await db.flush()
-    return u
+
+
+async def load_generate_count(db: AsyncSession, user_id: str, date: str) -> int:
+    row = await db.execute(
+        select(UsageDaily.generate_count).where(UsageDaily.user_id == user_id, UsageDaily.date == date)
+    )
+    return int(row.scalar_one_or_none() or 0)
+
+
+def _insert_for(db: AsyncSession):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+async def upsert_counts(db: AsyncSession, rows: list[dict]) -> None:
+    """usage_daily へ (user_id, date) 単位で generate_count/plan_at_time を一括 UPSERT（値は上書き）"""
+    if not rows:
+        return
+    insert = _insert_for(db)
+    stmt = insert(UsageDaily).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UsageDaily.user_id, UsageDaily.date],
+        set_={"generate_count": stmt.excluded.generate_count, "plan_at_time": stmt.excluded.plan_at_time},
+    )
+    await db.execute(stmt)
+    await db.commit()
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Sequence
+
+# 複数フレーズの部分一致（Aho-Corasick）。フレーズ集合ごとに1回だけオートマトンを作り、
+# 本文は1パスで走査する。照合は NFKC + 小文字化した文字列同士で行う（全角/半角・大文字小文字を区別しない）。
+# 位置は元の文字列のインデックスで返す。
+
+_VOICED = {"゙", "゚"}  # 結合濁点/半濁点（半角ｶﾞ等の NFKC 結果）
+_KATA_START, _KATA_END = ord("ァ"), ord("ヶ")
+# これ以下のフレーズ数なら search は str.find の繰り返しの方が速い
+_LINEAR_MAX = 32
+
+
+def fold_char(ch: str, kana: bool = False) -> str:
+    f = unicodedata.normalize("NFKC", ch).lower()
+    if kana:
+        f = "".join(chr(ord(x) - 0x60) if _KATA_START <= ord(x) <= _KATA_END else x for x in f)
+    return f
+
+
+# 1文字ごとの正規化結果のキャッシュ（出現する文字種は限られるので上限付きの dict で十分）
+_FOLD_CACHE_MAX = 65536
+_fold_cache: dict[str, str] = {}
+_fold_cache_kana: dict[str, str] = {}
+
+
+# NFKC で変化しない文字（ASCII/かな/CJK統合漢字/主な和文記号）。fold / fold_text はそれ以外の連続部分だけを正規化する
+_STABLE_BASE = "\x00-\x7f、-。々-】ぁ-ゖゝ-ゞ一-鿿"
+_UNSTABLE_RUN = re.compile(f"[^{_STABLE_BASE}ァ-ヺー-ヾ]+")
+_UNSTABLE_RUN_KANA = re.compile(f"[^{_STABLE_BASE}]+")  # カタカナもひらがなへ寄せる
+_KANA_TABLE = {cp: chr(cp - 0x60) for cp in range(_KATA_START, _KATA_END + 1)}
+
+
+def fold(text: str, kana: bool = False) -> tuple[str, Sequence[int]]:
+    """照合用に正規化した文字列と、各文字の元インデックスを返す"""
+    if not kana and unicodedata.is_normalized("NFKC", text):
+        low = text.lower()
+        if len(low) == len(text):
+            return low, range(len(text))
+    runs = (_UNSTABLE_RUN_KANA if kana else _UNSTABLE_RUN).finditer(text)
+    m = next(runs, None)
+    if m is None:
+        # 全て NFKC で変化しない文字（lower も1対1）→ 位置はそのまま
+        return text.lower(), range(len(text))
+
+    # 変化しない部分はまとめてコピーし、1文字ずつ正規化するのは変化し得る連続部分だけ
+    cache = _fold_cache_kana if kana else _fold_cache
+    out: list[str] = []
+    index: list[int] = []
+    pos = 0
+    while m is not None:
+        start, end = m.span()
+        if start > pos:
+            out.extend(text[pos:start].lower())
+            index.extend(range(pos, start))
+        for i in range(start, end):
+            ch = text[i]
+            f = cache.get(ch)
+            if f is None:
+                f = fold_char(ch, kana)
+                if len(cache) < _FOLD_CACHE_MAX:
+                    cache[ch] = f
+            for x in f:
+                if x in _VOICED and out:
+                    composed = unicodedata.normalize("NFC", out[-1] + x)
+                    if len(composed) == 1:
+                        out[-1] = composed
+                        continue
+                out.append(x)
+                index.append(i)
+        pos = end
+        m = next(runs, None)
+    if pos < len(text):
+        out.extend(text[pos:].lower())
+        index.extend(range(pos, len(text)))
+    return "".join(out), index
+
+
+def _nfkc_run(m: re.Match[str]) -> str:
+    return unicodedata.normalize("NFKC", m.group())
+
+
+def _nfkc_kana_run(m: re.Match[str]) -> str:
+    return unicodedata.normalize("NFKC", m.group()).translate(_KANA_TABLE)
+
+
+def fold_text(text: str, kana: bool = False, lower: bool = True) -> str:
+    """fold と同じ正規化を、位置の対応なしで高速に行う（一致判定用）。lower=False なら大文字小文字を残す"""
+    if not kana and unicodedata.is_normalized("NFKC", text):
+        return text.lower() if lower else text
+    s = _UNSTABLE_RUN_KANA.sub(_nfkc_kana_run, text) if kana else _UNSTABLE_RUN.sub(_nfkc_run, text)
+    if lower:
+        s = s.lower()
+    if "\u3099" in s or "\u309a" in s:
+        # 直前の（正規化不要な）かなと離れて残った濁点/半濁点を合成する
+        s = unicodedata.normalize("NFC", s)
+    return s
+
+
+@dataclass(frozen=True)
+class PhraseMatch:
+    phrase: str  # 登録時の（正規化前の）フレーズ
+    start: int  # 元の文字列での開始位置
+    end: int  # 元の文字列での終了位置（含まない）
+
+
+class PhraseMatcher:
+    """フレーズ集合をコンパイルした Aho-Corasick オートマトン"""
+
+    def __init__(self, phrases: Iterable[str], kana: bool = False) -> None:
+        self.kana = kana
+        self.phrases: list[str] = []
+        self._keys: list[str] = []  # 正規化後のフレーズ（phrases と同じ並び）
+        # goto[state] = {文字: 次状態}, fail[state], out[state] = (phrase_id, 照合長) の並び
+        self._goto: list[dict[str, int]] = [{}]
+        out: list[list[tuple[int, int]]] = [[]]
+        seen: set[str] = set()
+        for p in phrases:
+            key = fold_text(p, kana) if p else ""
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            pid = len(self.phrases)
+            self.phrases.append(p)
+            self._keys.append(key)
+            state = 0
+            for ch in key:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append((pid, len(key)))
+
+        fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for s in queue:
+            for ch, nxt in self._goto[s].items():
+                queue.append(nxt)
+                f = fail[s]
+                while f and ch not in self._goto[f]:
+                    f = fail[f]
+                fail[nxt] = self._goto[f].get(ch, 0)
+                out[nxt].extend(out[fail[nxt]])
+        self._fail = fail
+        self._out: list[tuple[tuple[int, int], ...]] = [tuple(o) for o in out]
+
+    def __bool__(self) -> bool:
+        return bool(self.phrases)
+
+    def __len__(self) -> int:
+        return len(self.phrases)
+
+    def scan(self, folded: str) -> Iterator[tuple[int, int, int]]:
+        """正規化済みの文字列を走査し (phrase_id, 開始, 終了) を返す（座標は正規化後）"""
+        goto, fail, out = self._goto, self._fail, self._out
+        root = goto[0]
+        state = 0
+        for i, ch in enumerate(folded):
+            if not state and ch not in root:
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for pid, n in out[state]:
+                    yield pid, i + 1 - n, i + 1
+
+    def _first(self, folded: str) -> tuple[int, int, int] | None:
+        """正規化済みの文字列で最初の一致（終了位置が最も手前のもの）を (phrase_id, 開始, 終了) で返す"""
+        if len(self._keys) <= _LINEAR_MAX:
+            best: tuple[int, int] | None = None  # (終了位置, phrase_id)
+            for pid, key in enumerate(self._keys):
+                s = folded.find(key)
+                if s >= 0 and (best is None or s + len(key) < best[0]):
+                    best = (s + len(key), pid)
+            if best is None:
+                return None
+            e, pid = best
+            return pid, e - len(self._keys[pid]), e
+        for hit in self.scan(folded):
+            return hit
+        return None
+
+    def _hit(self, text: str) -> int | None:
+        """一致の有無だけを判定する（位置の対応は作らない）。一致したフレーズの phrase_id を返す"""
+        hit = self._first(fold_text(text, self.kana))
+        return None if hit is None else hit[0]
+
+    def search(self, text: str) -> PhraseMatch | None:
+        """最初に見つかった一致（終了位置が最も手前のもの）を返す"""
+        if not self.phrases:
+            return None
+        text = text or ""
+        # 大半は一致しないので、1文字ずつの位置の対応（fold）は一致したときだけ作る
+        pid = self._hit(text)
+        if pid is None:
+            return None
+        folded, index = fold(text, self.kana)
+        hit = self._first(folded)
+        if hit is None:
+            # 結合文字の並びで1文字ずつの正規化と結果が変わる稀なケース。位置は本文全体とする
+            return PhraseMatch(self.phrases[pid], 0, len(text))
+        pid, s, e = hit
+        return PhraseMatch(self.phrases[pid], index[s], index[e - 1] + 1)
+
+    def find_all(self, text: str) -> list[PhraseMatch]:
+        """重なりを含む全ての一致を返す"""
+        if not self.phrases:
+            return []
+        text = text or ""
+        pid = self._hit(text)
+        if pid is None:
+            return []
+        folded, index = fold(text, self.kana)
+        found = [PhraseMatch(self.phrases[p], index[s], index[e - 1] + 1) for p, s, e in self.scan(folded)]
+        return found or [PhraseMatch(self.phrases[pid], 0, len(text))]
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import logging
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+
+from app.config import settings
+
+# 入力/出力をトークン数で管理する。文字数は日本語と英数字でトークン換算が大きく違うため目安にならない。
+# - estimate_tokens: 常に使える高速な見積もり（トリミングの内側ループ用）
+# - count_tokens: tiktoken が入っていれば正確な数、無ければ見積もり（最終確認/ログ用）
+# 予算はモデルごとに Settings.model_token_budgets で設定する（未登録のモデルは default_token_budget）。
+
+log = logging.getLogger(__name__)
+
+# tiktoken がモデル名を知らない場合に使うエンコーディング（gpt-4o 以降の系列）
+_FALLBACK_ENCODING = "o200k_base"
+
+
+def _tiktoken_available() -> bool:
+    try:
+        import tiktoken  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+
+def estimate_tokens(text: str) -> int:
+    """ざっくりしたトークン数の見積もり（日本語は概ね1文字1トークン弱、ASCII は4文字で1トークン）"""
+    # 日本語の大半は UTF-8 で3バイトなので、バイト数の差から非 ASCII 文字数を見積もる（C で数えるので速い）
+    wide = (len(text.encode("utf-8")) - len(text)) // 2
+    return math.ceil(wide * 0.9 + (len(text) - wide) / 4)
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    if not _tiktoken_available():
+        return None
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    try:
+        return tiktoken.get_encoding(_FALLBACK_ENCODING)
+    except Exception as e:
+        # BPE ファイルを取得できない環境など。見積もりで続行する
+        log.warning("tokenizer_unavailable", extra={"model": model, "type": e.__class__.__name__})
+        return None
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """トークン数（tiktoken があれば正確に、無ければ見積もり）"""
+    enc = _encoding(model or settings.openai_model)
+    if enc is None:
+        return estimate_tokens(text)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def is_exact(model: str | None = None) -> bool:
+    return _encoding(model or settings.openai_model) is not None
+
+
+@dataclass(frozen=True)
+class ModelBudget:
+    model: str
+    context: int  # コンテキスト長（入力+出力）
+    output: int  # 出力上限（max_tokens / max_output_tokens に渡す）
+    history: int  # トーク履歴に割り当てる入力トークン
+    summarize_over: int  # 履歴がこれを超えたら要約に切り替える（旧 /api/talk/assist）
+
+    @property
+    def history_recent(self) -> int:
+        """そのまま残す直近分"""
+        return self.history - self.history_older
+
+    @property
+    def history_older(self) -> int:
+        """短縮して残す古い分"""
+        return int(self.history * settings.history_older_ratio)
+
+
+@lru_cache(maxsize=16)
+def budget_for(model: str | None = None) -> ModelBudget:
+    model = model or settings.openai_model
+    conf = {**settings.default_token_budget, **settings.model_token_budgets.get(model, {})}
+    context = int(conf["context"])
+    output = min(int(conf["output"]), context // 2)
+    # 履歴はコンテキストから出力と固定プロンプト分を引いた残りを超えない
+    history = min(int(conf["history"]), context - output - settings.prompt_reserve_tokens)
+    summarize_over = max(int(conf.get("summarize_over", history * 2)), history)
+    return ModelBudget(model=model, context=context, output=output, history=history, summarize_over=summarize_over)
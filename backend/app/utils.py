@@ -14,6 +14,19 @@ def etag_for_json(obj: dict) -> str:
     return sha256_hex(raw)
 
 
+def merge_patch(target, patch):
+    """RFC 7396 JSON Merge Patch。null はキー削除、オブジェクト同士は再帰、それ以外は置き換え"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = merge_patch(result.get(k), v)
+    return result
+
+
 def new_ticket_id() -> str:
     return secrets.token_urlsafe(16)
 
@@ -1,17 +1,63 @@
-from typing import List, Literal, Tuple
+from typing import Awaitable, List, Literal, Optional, Tuple, TypeVar
+import asyncio
+import atexit
+import logging
 import os
-import json
-from datetime import datetime
+from contextlib import asynccontextmanager
 from pathlib import Path
 import re
 
 
-from fastapi import FastAPI
+import httpx
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+from app.config import settings
+from app.line_history import compact_to_budget
+from app.logging_conf import LogPipeline
+from app.services import summary_cache
+from app.token_budget import budget_for, count_tokens
+
+# ========== 
+# OpenAI クライアント（プロセスで1つの AsyncOpenAI を lifespan で作って共有）
+# ==========
+MODEL_NAME = "gpt-4.1-mini"
+
+# 1リクエスト全体（要約 + 返信生成）の上限
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("TALK_ASSIST_TIMEOUT_SECONDS", "90"))
+
+_client: Optional[AsyncOpenAI] = None
+
+
+def get_client() -> AsyncOpenAI:
+    if _client is None:
+        raise RuntimeError("OpenAI client is not started (lifespan not running)")
+    return _client
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global _client
+    if _client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            # 起動時に気づけるように明示的に落とす
+            raise RuntimeError("OPENAI_API_KEY is not set in environment variables.")
+        _client = AsyncOpenAI(
+            api_key=api_key,
+            timeout=httpx.Timeout(settings.openai_timeout_seconds, connect=settings.openai_connect_timeout_seconds),
+            max_retries=settings.openai_max_retries,
+        )
+    try:
+        yield
+    finally:
+        client, _client = _client, None
+        await client.close()
+
 
 # ========== 
 # FastAPI アプリ 
@@ -20,6 +66,7 @@ app = FastAPI(
     title="Talk Assist API",
     description="LINEトーク要約＆返信生成API",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # プロジェクトルート / static パス
@@ -55,40 +102,34 @@ app.add_middleware(
 )
 
 # ========== 
-# OpenAI クライアント 
+# 長文対策の予算（トークン数。app.config の MODEL_TOKEN_BUDGETS で調整）
 # ==========
-api_key = os.environ.get("OPENAI_API_KEY")
-if not api_key:
-    # 起動時に気づけるように明示的に落とす
-    raise RuntimeError("OPENAI_API_KEY is not set in environment variables.")
-
-client = OpenAI(api_key=api_key)
-
-MODEL_NAME = "gpt-4.1-mini"
-
-# ========== 
-# 長文対策用のしきい値 
-# ==========
-# 生テキストのハード上限（これを超えたらまず頭+尻だけにトリム）
-MAX_RAW_CHARS = 8000
-# モデルに渡す文字数の目安
-MAX_USED_CHARS = 4000
+BUDGET = budget_for(MODEL_NAME)
 
 # ========== 
 # ログ設定（簡易） 
 # ==========
-LOG_DIR = Path("logs")
-LOG_DIR.mkdir(exist_ok=True)
+# TALK_ASSIST_LOG_DIR でログの置き場所を変えられる（ベンチ等で追跡対象の logs/ を汚さないため）
+LOG_DIR = Path(os.environ.get("TALK_ASSIST_LOG_DIR", "logs"))
+LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOG_FILE = LOG_DIR / "talk_assist.log"
 
 
+# JSON 1行1レコード。書き込みはバックグラウンドのスレッドがまとめて行う（app.logging_conf.LogPipeline）
+_log_pipeline = LogPipeline(LOG_FILE)
+atexit.register(_log_pipeline.stop)
+_talk_log = logging.getLogger("talk_assist")
+_talk_log.setLevel(logging.INFO)
+_talk_log.propagate = False
+_talk_log.addHandler(_log_pipeline.handler)
+
+
 def write_log(record: dict) -> None:
-    """エラーになっても処理を止めない、超簡易ログ"""
+    """エラーになっても処理を止めない、超簡易ログ（キューに積むだけでブロックしない）"""
     try:
         record = {**record}
-        record["ts"] = datetime.utcnow().isoformat()
-        with LOG_FILE.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        event = record.pop("event", "talk_assist")
+        _talk_log.info(event, extra=record)
     except Exception:
         # ログ失敗は黙殺
         pass
@@ -234,8 +275,8 @@ def build_user_prompt(text: str, mode: str) -> str:
 
 入力モード: {mode}
   - full: 全文
-  - trimmed: 一部トリミング（頭と末尾のみ）
-  - summarized: 非常に長いためモデル内で要約済み
+  - trimmed: 一部トリミング（直近は全文、それより前は抜粋）
+  - summarized: 非常に長いため前半は要約済み（直近はそのまま）
 
 --- トーク履歴 ---
 {text}
@@ -246,31 +287,22 @@ def build_user_prompt(text: str, mode: str) -> str:
 # 長文前処理 
 # ==========
 
-def summarize_conversation(raw_text: str, tone: ToneLiteral) -> str:
-    """
-    非常に長い場合に使う要約フェーズ。
-    tone は今はほぼ使わないが、将来拡張用に受け取っておく。
-    """
-    system_prompt = (
-        "あなたは会話ログを要約するアシスタントです。\n"
-        "入力されるのはLINEなどのチャット履歴です。\n\n"
-        "# 目的\n"
-        "- 会話の流れと重要なポイントが分かるように、重要な発言のみを時系列で簡潔にまとめてください。\n"
-        "- 感情のニュアンス（怒っている・喜んでいる・困っている等）が分かるように含めてください。\n\n"
-        "# 出力\n"
-        "- 箇条書きや見出しは使わず、2〜6文程度の自然な日本語にしてください。"
-    )
-
-    user_prompt = f"""以下が会話の全文です。上記の指示に従って要約してください。
+SUMMARY_SYSTEM_PROMPT = (
+    "あなたは会話ログを要約するアシスタントです。\n"
+    "入力されるのはLINEなどのチャット履歴です。\n\n"
+    "# 目的\n"
+    "- 会話の流れと重要なポイントが分かるように、重要な発言のみを時系列で簡潔にまとめてください。\n"
+    "- 感情のニュアンス（怒っている・喜んでいる・困っている等）が分かるように含めてください。\n\n"
+    "# 出力\n"
+    "- 箇条書きや見出しは使わず、2〜6文程度の自然な日本語にしてください。"
+)
 
---- 会話全文 ---
-{raw_text}
-"""
 
-    completion = client.responses.create(
+async def _summarize_call(user_prompt: str) -> str:
+    completion = await get_client().responses.create(
         model=MODEL_NAME,
         input=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
         max_output_tokens=256,
@@ -281,32 +313,86 @@ def summarize_conversation(raw_text: str, tone: ToneLiteral) -> str:
     return content
 
 
-def preprocess_text(raw_text: str, tone: ToneLiteral) -> Tuple[str, str, int, int]:
+async def summarize_conversation(raw_text: str, tone: ToneLiteral, previous_summary: str | None = None) -> str:
+    """
+    非常に長い場合に使う要約フェーズ（map-reduce の map も兼ねる）。
+    previous_summary があれば「それ以前の要約」として渡し、続きの会話と繋いだ要約を作る。
+    tone は今はほぼ使わないが、将来拡張用に受け取っておく。
+    """
+    user_prompt = f"""以下が会話（全体または一部）です。上記の指示に従って要約してください。
+
+--- 会話 ---
+{raw_text}
+"""
+    if previous_summary:
+        user_prompt = f"""以下は会話の前半の要約と、その続きの会話です。前半の要約と続きを合わせ、上記の指示に従って会話全体を要約してください。
+
+--- 前半の要約 ---
+{previous_summary}
+
+--- 続きの会話 ---
+{raw_text}
+"""
+    return await _summarize_call(user_prompt)
+
+
+async def reduce_summaries(partials: List[str], tone: ToneLiteral, previous_summary: str | None = None) -> str:
+    """
+    会話を時系列順に区切って要約したもの（map の結果）を1つの要約にまとめる。
+    """
+    parts = "\n".join(f"（{i}）{p}" for i, p in enumerate(partials, 1))
+    head = f"--- 前半の要約 ---\n{previous_summary}\n\n" if previous_summary else ""
+    user_prompt = f"""以下は1つの会話を時系列順に区切って要約したものです。重複を除いて繋ぎ、上記の指示に従って会話全体の要約にしてください。
+
+{head}--- 区切りごとの要約（古い順） ---
+{parts}
+"""
+    return await _summarize_call(user_prompt)
+
+
+async def preprocess_text(raw_text: str, tone: ToneLiteral) -> Tuple[str, str, int, int]:
     """
     長文対策の前処理。
     戻り値: (used_text, mode, original_len, used_len)
       mode: "full" | "trimmed" | "summarized"
+      original_len / used_len はトークン数
     """
     text = raw_text.strip()
-    original_len = len(text)
+    original_len = count_tokens(text, MODEL_NAME)
 
-    # 生テキストが短ければそのまま
-    if original_len <= MAX_USED_CHARS:
+    # 履歴予算に収まればそのまま
+    if original_len <= BUDGET.history:
         return text, "full", original_len, original_len
 
-    # まずは頭 + 尻でトリミング
-    head = text[: MAX_USED_CHARS // 2]
-    tail = text[-MAX_USED_CHARS // 2 :]
-    trimmed = head + "\n...\n" + tail
+    # まずはトーク履歴を圧縮（システム行などを捨て、直近を優先して残す）
+    trimmed = compact_to_budget(text, BUDGET).text
 
-    if original_len <= MAX_RAW_CHARS:
-        used_len = len(trimmed)
-        return trimmed, "trimmed", original_len, used_len
+    if original_len <= BUDGET.summarize_over:
+        return trimmed, "trimmed", original_len, count_tokens(trimmed, MODEL_NAME)
 
     # さらに長い場合は要約フェーズ（summarized）
     try:
-        summary = summarize_conversation(text, tone)
-        used_text = summary
+        # 既に要約した先頭部分はキャッシュを使い、新しく増えた部分だけを要約して繋ぐ
+        # 長い部分は区切って並列に要約してからまとめる（map-reduce）
+        async def summarize(previous: str | None, new_text: str) -> str:
+            return await summarize_conversation(new_text, tone, previous)
+
+        async def reduce(previous: str | None, partials: List[str]) -> str:
+            return await reduce_summaries(partials, tone, previous)
+
+        rolled = await summary_cache.rolling_summary(text, summarize, reduce)
+        used_text = rolled.text
+        write_log(
+            {
+                "event": "summarized",
+                "chunks": rolled.chunks,
+                "cached_chunks": rolled.cached_chunks,
+                "segments": rolled.stats.segments,
+                "fan_out": rolled.stats.fan_out,
+                "map_ms": round(rolled.stats.map_ms, 1),
+                "reduce_ms": round(rolled.stats.reduce_ms, 1),
+            }
+        )
         mode = "summarized"
     except Exception as e:
         # 要約に失敗したらトリム版で妥協
@@ -314,7 +400,7 @@ def preprocess_text(raw_text: str, tone: ToneLiteral) -> Tuple[str, str, int, in
         used_text = trimmed
         mode = "trimmed-fallback"
 
-    used_len = len(used_text)
+    used_len = count_tokens(used_text, MODEL_NAME)
     return used_text, mode, original_len, used_len
 
 
@@ -397,8 +483,41 @@ async def health() -> dict:
     return {"status": "ok"}
 
 
+T = TypeVar("T")
+
+
+async def _until_disconnect(request: Request, work: Awaitable[T], poll_seconds: float = 0.5) -> Optional[T]:
+    """クライアントが切断したら work をキャンセルする（上流呼び出しも止まる）。切断時は None"""
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_seconds)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                write_log({"event": "client_disconnected"})
+                return None
+    finally:
+        if not task.done():
+            task.cancel()
+
+
 @app.post("/api/talk/assist", response_model=TalkResponse)
-async def talk_assist(req: TalkRequest) -> TalkResponse:
+async def talk_assist(req: TalkRequest, request: Request) -> TalkResponse:
+    try:
+        res = await asyncio.wait_for(_until_disconnect(request, _talk_assist(req)), REQUEST_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        write_log({"event": "timeout", "timeout_seconds": REQUEST_TIMEOUT_SECONDS})
+        return TalkResponse(
+            summary="（AI呼び出しがタイムアウトしました。しばらく時間をおいて再度お試しください。）",
+            replies=[],
+        )
+    # 切断済みなら返しても届かない
+    return res if res is not None else TalkResponse(summary="", replies=[])
+
+
+async def _talk_assist(req: TalkRequest) -> TalkResponse:
     raw_text = (req.text or "").strip()
     tone_raw = (req.tone or "standard").lower()
 
@@ -412,21 +531,21 @@ async def talk_assist(req: TalkRequest) -> TalkResponse:
         tone = tone_raw  # type: ignore[assignment]
 
     # 長文前処理
-    used_text, mode, original_len, used_len = preprocess_text(raw_text, tone)
+    used_text, mode, original_len, used_len = await preprocess_text(raw_text, tone)
 
     system_prompt = build_system_prompt(tone)
     user_prompt = build_user_prompt(used_text, mode)
     _, temperature = build_tone_desc_and_temp(tone)
 
     try:
-        completion = client.responses.create(
+        completion = await get_client().responses.create(
             model=MODEL_NAME,
             input=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
             temperature=temperature,
-            max_output_tokens=512,
+            max_output_tokens=BUDGET.output,
         )
 
         # Responses API の結果からテキストを取り出す
@@ -440,8 +559,8 @@ async def talk_assist(req: TalkRequest) -> TalkResponse:
                 {
                     "event": "parsed_without_replies",
                     "tone": tone,
-                    "original_len": original_len,
-                    "used_len": used_len,
+                    "original_tokens": original_len,
+                    "used_tokens": used_len,
                     "mode": mode,
                     "raw_content_preview": content[:120],
                 }
@@ -450,8 +569,8 @@ async def talk_assist(req: TalkRequest) -> TalkResponse:
             {
                 "event": "success",
                 "tone": tone,
-                "original_len": original_len,
-                "used_len": used_len,
+                "original_tokens": original_len,
+                "used_tokens": used_len,
                 "mode": mode,
                 "summary_preview": summary[:50],
                 "replies_count": len(replies),
@@ -467,8 +586,8 @@ async def talk_assist(req: TalkRequest) -> TalkResponse:
             {
                 "event": "error",
                 "tone": tone,
-                "original_len": original_len,
-                "used_len": used_len,
+                "original_tokens": original_len,
+                "used_tokens": used_len,
                 "mode": mode,
                 "error": str(e),
             }
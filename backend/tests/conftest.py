@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# app を import する前に、外部サービスなし（プロセス内ストア + 一時 SQLite）の設定にする
+_TMP = tempfile.mkdtemp(prefix="permy-test-")
+os.environ.update(
+    STATE_BACKEND="memory",
+    REDIS_DISABLED="true",
+    AI_PROVIDER="dummy",
+    DATABASE_URL=f"sqlite+aiosqlite:///{_TMP}/test.db",
+    PROFILE_DIR=f"{_TMP}/profiles",
+)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def run():
+    """コルーチンを新しいイベントループで実行する（pytest-asyncio は使わない）"""
+    from app.db import engine
+
+    def _run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                # aiosqlite の接続はループをまたいで使えないので毎回閉じる
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return _run
+
+
+@pytest.fixture(scope="session")
+def migrated():
+    from app.db import engine
+    from app.migrations import migrate
+
+    async def main():
+        try:
+            await migrate()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import types
+
+import pytest
+
+from app.ai_client import GenerateContext
+from app.ai_client_openai import OpenAiChatClient
+from app.routes.generate import _ClosingStreamingResponse
+
+CTX = GenerateContext(None, None, None, None, 0, [], [], None)
+
+
+class _FakeStream:
+    """chat.completions.create(stream=True) の代わり。close されたかを記録する"""
+
+    def __init__(self, payload: dict, step: int = 5) -> None:
+        text = json.dumps(payload, ensure_ascii=False)
+        self._parts = [text[i : i + step] for i in range(0, len(text), step)]
+        self.closed = False
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def _gen(self):
+        for p in self._parts:
+            delta = types.SimpleNamespace(content=p)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], usage=None)
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def _client(stream: _FakeStream) -> OpenAiChatClient:
+    async def create(**kw):
+        return stream
+
+    client = OpenAiChatClient.__new__(OpenAiChatClient)
+    client._client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    return client
+
+
+def test_upstream_stream_closed_after_all_candidates(run):
+    stream = _FakeStream({"A": "おはよう", "B": "こんにちは", "C": "またね"})
+
+    async def main():
+        return [x async for x in _client(stream).generate_abc_stream("12:00\t花子\tやあ", CTX)]
+
+    assert run(main()) == [("A", "おはよう"), ("B", "こんにちは"), ("C", "またね")]
+    assert stream.closed
+
+
+def test_upstream_stream_closed_when_caller_stops_early(run):
+    stream = _FakeStream({"A": "おはよう", "B": "こんにちは", "C": "またね"})
+
+    async def main():
+        gen = _client(stream).generate_abc_stream("12:00\t花子\tやあ", CTX)
+        first = await gen.__anext__()
+        await gen.aclose()
+        return first
+
+    assert run(main()) == ("A", "おはよう")
+    assert stream.closed
+
+
+async def _receive():
+    return {"type": "http.disconnect"}
+
+
+def _scope() -> dict:
+    return {"type": "http", "asgi": {"spec_version": "2.4"}}
+
+
+@pytest.mark.parametrize("fail_on", ["http.response.start", "http.response.body"])
+def test_closing_response_cleans_up_on_disconnect(run, fail_on):
+    events: list[str] = []
+
+    async def body():
+        try:
+            yield b"1\n"
+            yield b"2\n"
+        finally:
+            events.append("body_finally")
+
+    async def on_close():
+        events.append("on_close")
+
+    async def send(message):
+        if message["type"] == fail_on:
+            raise OSError("client went away")
+
+    async def main():
+        resp = _ClosingStreamingResponse(body(), on_close=on_close)
+        with pytest.raises(Exception):
+            await resp(_scope(), _receive, send)
+
+    run(main())
+    # 一度も読まれなかったボディは finally が走らないので、on_close が後始末を受け持つ
+    expected = ["on_close"] if fail_on == "http.response.start" else ["body_finally", "on_close"]
+    assert events == expected
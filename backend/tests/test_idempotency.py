@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+
+from app.config import settings
+from app.redis_client import redis_client
+from app.services import idempotency
+
+
+def _ids() -> tuple[str, str]:
+    return f"u-{uuid.uuid4().hex}", f"k-{uuid.uuid4().hex}"
+
+
+def test_acquire_complete_then_replay(run):
+    user, key = _ids()
+
+    async def main():
+        first = await idempotency.acquire(user, key, "fp1")
+        await idempotency.complete(user, key, "fp1", {"ok": 1})
+        replay = await idempotency.acquire(user, key, "fp1")
+        other = await idempotency.acquire(user, key, "fp2")
+        return first, replay, other
+
+    first, replay, other = run(main())
+    assert first.acquired
+    assert not replay.acquired and replay.response == {"ok": 1}
+    assert other.mismatch and other.response is None
+
+
+def test_inflight_times_out_then_release_frees_key(run, monkeypatch):
+    monkeypatch.setattr(settings, "idempotency_wait_seconds", 0.2)
+    monkeypatch.setattr(idempotency, "_POLL_SECONDS", 0.02)
+    user, key = _ids()
+
+    async def main():
+        leader = await idempotency.acquire(user, key, "fp")
+        waiting = await idempotency.acquire(user, key, "fp")
+        mismatch = await idempotency.acquire(user, key, "other")
+        await idempotency.release(user, key)
+        again = await idempotency.acquire(user, key, "fp")
+        await idempotency.release(user, key)
+        return leader, waiting, mismatch, again
+
+    leader, waiting, mismatch, again = run(main())
+    assert leader.acquired
+    assert waiting.in_progress and not waiting.acquired
+    assert mismatch.mismatch
+    assert again.acquired
+
+
+def test_follower_waits_for_leader_response(run, monkeypatch):
+    monkeypatch.setattr(settings, "idempotency_wait_seconds", 2)
+    monkeypatch.setattr(idempotency, "_POLL_SECONDS", 0.02)
+    user, key = _ids()
+
+    async def main():
+        assert (await idempotency.acquire(user, key, "fp")).acquired
+        follower = asyncio.create_task(idempotency.acquire(user, key, "fp"))
+        await asyncio.sleep(0.1)
+        assert not follower.done()
+        await idempotency.complete(user, key, "fp", {"candidates": ["a", "b", "c"]})
+        return await follower
+
+    res = run(main())
+    assert res.response == {"candidates": ["a", "b", "c"]}
+
+
+def test_unreadable_value_is_treated_as_stale(run):
+    user, key = _ids()
+
+    async def main():
+        await redis_client.set(idempotency._key(user, key), "1", ex=60)
+        res = await idempotency.acquire(user, key, "fp")
+        await idempotency.release(user, key)
+        return res
+
+    assert run(main()).acquired
+
+
+def test_leader_keeps_inflight_alive_past_ttl(run, monkeypatch):
+    monkeypatch.setattr(settings, "idempotency_inflight_ttl_seconds", 1)
+    user, key = _ids()
+    rkey = idempotency._key(user, key)
+
+    async def main():
+        assert (await idempotency.acquire(user, key, "fp")).acquired
+        await asyncio.sleep(1.5)
+        alive = await redis_client.get(rkey)
+        await idempotency.release(user, key)
+        return alive, await redis_client.get(rkey), dict(idempotency._keepers)
+
+    alive, after, keepers = run(main())
+    assert alive is not None
+    assert after is None
+    assert rkey not in keepers
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import uuid
+
+from app.limiter import Rule, check
+from app.redis_client import gcra_decide
+
+
+def _rule(limit: int, window_seconds: int = 60) -> Rule:
+    return Rule(key=f"test:{uuid.uuid4().hex}", limit=limit, window_seconds=window_seconds)
+
+
+def test_gcra_decide_spaces_requests_by_interval():
+    # 2回/1000ms → 間隔 500ms。バーストは2回まで
+    allowed, retry, remaining, tats = gcra_decide(1000, [None], [2, 1000])
+    assert (allowed, retry, remaining, tats) == (1, 0, 1, [1500.0])
+    allowed, retry, remaining, tats = gcra_decide(1000, ["1500"], [2, 1000])
+    assert (allowed, retry, remaining, tats) == (1, 0, 0, [2000.0])
+    allowed, retry, remaining, _ = gcra_decide(1000, ["2000"], [2, 1000])
+    assert (allowed, retry, remaining) == (0, 500, 0)
+    # 500ms 後には1回分空く
+    allowed, _, _, _ = gcra_decide(1500, ["2000"], [2, 1000])
+    assert allowed == 1
+
+
+def test_check_allows_burst_then_rejects(run):
+    rule = _rule(3)
+
+    async def main():
+        return [await check([rule]) for _ in range(4)]
+
+    results = run(main())
+    assert [r.allowed for r in results] == [True, True, True, False]
+    assert [r.remaining for r in results[:3]] == [2, 1, 0]
+    assert results[3].retry_after_ms > 0
+    assert 1 <= results[3].retry_after_seconds <= 20
+
+
+def test_check_consumes_nothing_when_any_rule_rejects(run):
+    tight, loose = _rule(1), _rule(5)
+
+    async def main():
+        first = await check([tight, loose])
+        second = await check([tight, loose])
+        only_loose = await check([loose])
+        return first, second, only_loose
+
+    first, second, only_loose = run(main())
+    assert first.allowed and not second.allowed
+    # 拒否された2回目は loose を消費していない（5回枠のうち使用済みは2回）
+    assert only_loose.allowed and only_loose.remaining == 3
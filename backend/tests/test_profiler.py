@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from app import profiler
+from app.config import settings
+from app.middleware.profiler import ProfilerMiddleware
+
+
+async def _stream(request):
+    async def body():
+        yield b"a"
+        yield b"b"
+
+    return StreamingResponse(body())
+
+
+def _app() -> ProfilerMiddleware:
+    return ProfilerMiddleware(Starlette(routes=[Route("/s", _stream)]))
+
+
+def _scope() -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/s",
+        "raw_path": b"/s",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [],
+        "client": ("127.0.0.1", 1),
+        "server": ("test", 80),
+    }
+
+
+async def _receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+@pytest.fixture
+def sampled(monkeypatch):
+    monkeypatch.setattr(settings, "profile_sample_rate", 1.0)
+    monkeypatch.setattr(settings, "profile_max_concurrent", 1)
+    monkeypatch.setattr(settings, "profile_slow_ms", 1e9)  # 書き出しはしない
+
+
+def test_slot_released_after_normal_response(run, sampled):
+    sent: list[dict] = []
+
+    async def send(message):
+        sent.append(message)
+
+    run(_app()(_scope(), _receive, send))
+    assert b"".join(m.get("body", b"") for m in sent) == b"ab"
+    assert profiler._active == 0
+
+
+@pytest.mark.parametrize("fail_on", ["http.response.start", "http.response.body"])
+def test_slot_released_when_client_disconnects(run, sampled, fail_on):
+    async def send(message):
+        if message["type"] == fail_on:
+            raise OSError("client went away")
+
+    async def main():
+        # 上限1でも、切断のたびに枠が戻っていれば何度でも採取できる
+        for _ in range(3):
+            with pytest.raises(Exception):
+                await _app()(_scope(), _receive, send)
+            assert profiler._active == 0
+
+    run(main())
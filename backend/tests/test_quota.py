@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import uuid
+
+import pytest
+
+from app.db import SessionLocal
+from app.services import quota
+from app.services.usage import load_generate_count, upsert_counts
+from app.utils_time import jst_today_ymd
+
+pytestmark = pytest.mark.usefixtures("migrated")
+
+
+def _user() -> str:
+    return f"u-{uuid.uuid4().hex}"
+
+
+def test_reserve_stops_at_limit_and_refund_returns_a_slot(run):
+    user = _user()
+
+    async def main():
+        async with SessionLocal() as db:
+            got = [await quota.reserve(db, user, "free", 2) for _ in range(3)]
+            await quota.refund(user, "free", got[0])
+            again = await quota.reserve(db, user, "free", 2)
+        return got, again
+
+    got, again = run(main())
+    assert [(r.allowed, r.used) for r in got] == [(True, 1), (True, 2), (False, 2)]
+    assert again.allowed and again.used == 2
+
+
+def test_reserve_seeds_from_usage_daily(run):
+    user = _user()
+
+    async def main():
+        async with SessionLocal() as db:
+            await upsert_counts(db, [{"user_id": user, "date": jst_today_ymd(), "generate_count": 5, "plan_at_time": "free"}])
+            return [await quota.reserve(db, user, "free", 6) for _ in range(2)]
+
+    first, second = run(main())
+    assert first.allowed and first.used == 6
+    assert not second.allowed and second.used == 6
+
+
+def test_flush_writes_counters_back(run):
+    user = _user()
+
+    async def main():
+        async with SessionLocal() as db:
+            a = await quota.reserve(db, user, "pro", 10)
+            await quota.reserve(db, user, "pro", 10)
+        written = await quota.flush()
+        async with SessionLocal() as db:
+            after_two = await load_generate_count(db, user, a.date)
+        await quota.refund(user, "pro", a)
+        await quota.flush()
+        async with SessionLocal() as db:
+            after_refund = await load_generate_count(db, user, a.date)
+        return written, after_two, after_refund
+
+    written, after_two, after_refund = run(main())
+    assert written >= 1
+    assert after_two == 2
+    assert after_refund == 1
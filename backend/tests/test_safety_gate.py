@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import pytest
+
+from app import safety_gate
+
+MINOR = "未成年性的内容"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # 英単語の中の h/H は「H」ではない
+        "中学生の頃はhappyだった",
+        "小学生の子がhomeworkしてる",
+        "中学生のHappy",
+        "中学生でHTMLを覚えた",
+        # 命令形の「〜えろ」は「エロ」ではない（カナの同一視をしない）
+        "中学生なら自分で考えろ",
+        "中学生に勉強を教えろ",
+        "中学生にかんがえろと言った",
+        # どちらか一方のグループだけ
+        "Hな話",
+        "中学生です",
+    ],
+)
+def test_benign_text_passes(text):
+    assert safety_gate.check_all(text) == []
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "中学生とHした",
+        "中学生とＨした",
+        "中学生 H",
+        "中学生のエロ画像",
+        "中学生のｴﾛ画像",
+        "未成年とセックス",
+    ],
+)
+def test_minor_sexual_content_is_blocked(text):
+    assert safety_gate.check_all(text) == [MINOR]
+
+
+def test_all_of_terms_must_share_a_line():
+    assert safety_gate.check_all("中学生です\nエロ") == []
+
+
+def test_single_group_categories_and_order():
+    assert safety_gate.check_all("住所を教えて") == ["個人情報の不正取得/晒し"]
+    assert safety_gate.check_all("住所を晒して殺す") == ["個人情報の不正取得/晒し", "脅迫/危害"]
+    assert safety_gate.check("ｸﾚｶの番号") == "個人情報の不正取得/晒し"
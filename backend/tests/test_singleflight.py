@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+
+import pytest
+
+from app.config import settings
+from app.redis_client import redis_client
+from app.services import singleflight
+
+
+def _key() -> str:
+    return singleflight.flight_key(f"u-{uuid.uuid4().hex}", "12:00\t花子\tこんにちは", 0, None)
+
+
+def test_concurrent_callers_share_one_call(run):
+    key = _key()
+    calls = 0
+
+    async def fn():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return ["a", "b", "c"]
+
+    async def main():
+        return await asyncio.gather(*(singleflight.run(key, fn) for _ in range(3)))
+
+    results = run(main())
+    assert calls == 1
+    assert [texts for texts, _ in results] == [["a", "b", "c"]] * 3
+    assert [shared for _, shared in results] == [False, True, True]
+
+
+def test_leader_error_reaches_every_caller_and_frees_the_key(run):
+    key = _key()
+    calls = 0
+
+    async def boom():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream failed")
+
+    async def ok():
+        return ["x", "y", "z"]
+
+    async def main():
+        results = await asyncio.gather(*(singleflight.run(key, boom) for _ in range(3)), return_exceptions=True)
+        # 失敗後はロックも結果も残らず、次の呼び出しは自分で上流を呼ぶ
+        lock = await redis_client.get(f"sf:gen:{key}")
+        again = await singleflight.run(key, ok)
+        return results, lock, again
+
+    results, lock, again = run(main())
+    assert calls == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert lock is None
+    assert again == (["x", "y", "z"], False)
+
+
+def test_nothing_but_the_lock_is_kept_in_redis(run):
+    key = _key()
+    seen: list[str] = []
+
+    async def fn():
+        # 実行中に置かれているのはハッシュのキーとトークンだけ
+        seen.extend(k for k in redis_client._data if key in k)
+        return ["秘密の本文", "b", "c"]
+
+    run(singleflight.run(key, fn))
+    assert seen == [f"sf:gen:{key}"]
+    assert not any(key in k for k in redis_client._data)
+    assert not any("秘密の本文" in str(v) for v in redis_client._data.values())
+
+
+def test_waits_for_other_worker_then_calls_upstream_itself(run, monkeypatch):
+    monkeypatch.setattr(singleflight, "_POLL_SECONDS", 0.02)
+    key = _key()
+    calls = 0
+
+    async def fn():
+        nonlocal calls
+        calls += 1
+        return ["own", "own", "own"]
+
+    async def main():
+        await redis_client.set(f"sf:gen:{key}", "other", ex=30)
+        task = asyncio.create_task(singleflight.run(key, fn))
+        await asyncio.sleep(0.1)
+        waited = calls == 0 and not task.done()
+        await redis_client.delete(f"sf:gen:{key}")
+        return waited, await asyncio.wait_for(task, 2)
+
+    waited, result = run(main())
+    assert waited
+    assert result == (["own", "own", "own"], False)
+    assert calls == 1
+
+
+def test_stale_lock_is_ignored_after_the_wait(run, monkeypatch):
+    monkeypatch.setattr(settings, "singleflight_wait_seconds", 1)
+    monkeypatch.setattr(singleflight, "_POLL_SECONDS", 0.05)
+    key = _key()
+
+    async def fn():
+        return ["a", "b", "c"]
+
+    async def main():
+        await redis_client.set(f"sf:gen:{key}", "dead-worker", ex=30)
+        try:
+            return await asyncio.wait_for(singleflight.run(key, fn), 3)
+        finally:
+            await redis_client.delete(f"sf:gen:{key}")
+
+    assert run(main()) == (["a", "b", "c"], False)
+
+
+def test_cancelled_caller_does_not_cancel_shared_call(run):
+    key = _key()
+
+    async def main():
+        finished = asyncio.Event()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            finished.set()
+            return ["a", "b", "c"]
+
+        first = asyncio.create_task(singleflight.run(key, fn))
+        second = asyncio.create_task(singleflight.run(key, fn))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, finished.is_set()
+
+    (texts, shared), finished = run(main())
+    assert texts == ["a", "b", "c"] and shared
+    assert finished